@@ -21,7 +21,8 @@ with open(os.path.join(ROOT, "swag_client", "__about__.py")) as f:
 
 install_requires = [
     'marshmallow>=3.5.0',
-    'boto3>=1.3.7',
+    'boto3>=1.35.69',
+    'botocore>=1.35.69',
     'tabulate>=0.7.7',
     'dogpile.cache>=0.6.4',
     'click>=6.7',
@@ -51,7 +52,11 @@ setup(
     zip_safe=False,
     install_requires=install_requires,
     extras_require={
-        'tests': tests_require
+        'tests': tests_require,
+        'async': ['aiobotocore>=2.16.0'],
+        'orjson': ['orjson>=3.0.0'],
+        'ujson': ['ujson>=5.4.0'],
+        'zstd': ['zstandard>=0.15.0']
     },
     entry_points={
         'console_scripts': [
@@ -60,7 +65,8 @@ setup(
         'swag_client.backends': [
             'file = swag_client.backends.file:FileSWAGManager',
             's3 = swag_client.backends.s3:S3SWAGManager',
-            'dynamodb = swag_client.backends.dynamodb:DynamoDBSWAGManager'
+            'dynamodb = swag_client.backends.dynamodb:DynamoDBSWAGManager',
+            'snapshot = swag_client.backends.snapshot:SnapshotSWAGManager'
         ]
     },
     keywords=['aws', 'account_management']
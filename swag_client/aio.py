@@ -0,0 +1,409 @@
+"""
+.. module:: swag_client.aio
+    :platform: Unix
+"""
+import asyncio
+import contextlib
+import functools
+import logging
+import time
+
+from botocore.exceptions import ClientError
+
+from swag_client.backend import SWAGManager, apply_fields, apply_service, found_copy, one, validate_fields
+from swag_client.backends.s3 import DELTA_READ_ATTEMPTS, NOT_MODIFIED, DeltaLog, decompress, get_generation
+
+try:
+    from aiobotocore.session import get_session
+except ImportError:  # pragma: no cover
+    get_session = None
+
+try:
+    from boto3.dynamodb.types import TypeDeserializer
+except ImportError:  # pragma: no cover
+    TypeDeserializer = None
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncBackend(object):
+    """Asyncio front end for a SWAG backend.
+
+    Blocking backend calls run in an executor. The result of get_all is cached
+    for `cache_expires` seconds and concurrent loads share a single in-flight
+    request.
+    """
+    def __init__(self, backend, cache_expires=60, executor=None):
+        self.backend = backend
+        self.cache_expires = cache_expires
+        self.executor = executor
+        self._value = None
+        self._loaded_at = None
+        self._generation = 0
+        self._inflight = {}
+
+    async def _run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    async def get_all(self):
+        """Gets all items, coalescing concurrent loads."""
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.cache_expires:
+            return self._value
+
+        loop = asyncio.get_running_loop()
+        future = self._inflight.get(loop)
+
+        if future is None:
+            future = asyncio.ensure_future(self._load())
+            self._inflight[loop] = future
+
+            def done(f):
+                if self._inflight.get(loop) is f:
+                    del self._inflight[loop]
+
+            future.add_done_callback(done)
+
+        # A cancelled caller must not cancel the load other callers are waiting on.
+        return await asyncio.shield(future)
+
+    async def _load(self):
+        generation = self._generation
+        value = await self._fetch()
+
+        # A load that started before a write may return data older than the write, it is not cached.
+        if generation == self._generation:
+            self._value, self._loaded_at = value, time.monotonic()
+
+        return value
+
+    async def _fetch(self):
+        return await self._run(self.backend.get_all)
+
+    def invalidate(self):
+        """Drops the cached result of get_all, including the backend's own cache."""
+        self._generation += 1
+        self._value = None
+        self._loaded_at = None
+        self._inflight.clear()
+
+        if hasattr(self.backend, 'invalidate'):
+            self.backend.invalidate()
+
+    async def close(self):
+        """Releases the connections held by the backend."""
+
+    async def _write(self, fn, *args, **kwargs):
+        dry_run = kwargs.get('dry_run')
+        try:
+            return await self._run(fn, *args, **kwargs)
+        finally:
+            if not dry_run:
+                self.invalidate()
+
+    async def create(self, item, dry_run=None):
+        return await self._write(self.backend.create, item, dry_run=dry_run)
+
+    async def delete(self, item, dry_run=None):
+        return await self._write(self.backend.delete, item, dry_run=dry_run)
+
+    async def update(self, item, dry_run=None):
+        return await self._write(self.backend.update, item, dry_run=dry_run)
+
+    async def create_many(self, items, dry_run=None):
+        return await self._write(self.backend.create_many, items, dry_run=dry_run)
+
+    async def delete_many(self, items, dry_run=None):
+        return await self._write(self.backend.delete_many, items, dry_run=dry_run)
+
+    async def update_many(self, items, dry_run=None):
+        return await self._write(self.backend.update_many, items, dry_run=dry_run)
+
+    async def health_check(self):
+        return await self._run(self.backend.health_check)
+
+
+class AsyncAWSBackend(AsyncBackend):
+    """Asyncio front end that reads from AWS with aiobotocore clients.
+
+    get_all and health_check do not leave the event loop. Writes still run the
+    backend's own conditional write logic in an executor. Clients are bound to
+    the event loop that created them, one is opened per loop.
+    """
+    service = None
+
+    def __init__(self, backend, region_name, **kwargs):
+        super(AsyncAWSBackend, self).__init__(backend, **kwargs)
+        self.region_name = region_name
+        self._clients = {}
+
+    async def _client(self):
+        loop = asyncio.get_running_loop()
+
+        if loop not in self._clients:
+            stack = contextlib.AsyncExitStack()
+            client = await stack.enter_async_context(
+                get_session().create_client(self.service, region_name=self.region_name)
+            )
+
+            if loop in self._clients:
+                await stack.aclose()
+            else:
+                self._clients[loop] = (stack, client)
+
+        return self._clients[loop][1]
+
+    async def close(self):
+        """Closes the client opened for the running event loop."""
+        entry = self._clients.pop(asyncio.get_running_loop(), None)
+        if entry:
+            await entry[0].aclose()
+
+
+class AsyncS3Backend(AsyncAWSBackend):
+    """Reads an S3 backend's object, and its delta log, without leaving the event loop.
+
+    Like the S3 backend, an expired copy is revalidated against its ETag and
+    only the deltas newer than the generation already held are downloaded.
+    """
+    service = 's3'
+
+    def __init__(self, backend, **kwargs):
+        super(AsyncS3Backend, self).__init__(backend, backend.client.meta.region_name, **kwargs)
+        self._data = None
+        self._etag = None
+        self._deltas = DeltaLog(backend.bucket_name, backend.delta_prefix, backend.namespace, backend.version)
+
+    async def _get(self, key, **kwargs):
+        client = await self._client()
+        response = await client.get_object(Bucket=self.backend.bucket_name, Key=key, **kwargs)
+
+        async with response['Body'] as stream:
+            body = await stream.read()
+
+        return decompress(body, response.get('ContentEncoding')), response
+
+    async def _get_if_modified(self, key, etag=None):
+        """Returns a `(data, etag, generation)` tuple like `load_base_if_modified`."""
+        try:
+            body, response = await self._get(key, **({'IfNoneMatch': etag} if etag else {}))
+
+        except ClientError as ce:
+            if ce.response['Error']['Code'] in NOT_MODIFIED:
+                return None, etag, None
+
+            if ce.response['Error']['Code'] == 'NoSuchKey':
+                return {}, None, 0
+
+            raise ce
+
+        return self.backend.codec.loads(body), response.get('ETag'), get_generation(response)
+
+    async def _load_deltas(self, log):
+        client = await self._client()
+        paginator = client.get_paginator('list_objects_v2')
+
+        keys = log.follow([page async for page in paginator.paginate(**log.listing())])
+        if keys is None:
+            return None
+
+        bodies = await asyncio.gather(*[self._get(key) for key in keys])
+        return [self.backend.codec.loads(body) for body, _ in bodies]
+
+    async def _fetch(self):
+        data_file = self.backend.data_file
+
+        if self.backend.write_mode != 'delta':
+            data, etag, _ = await self._get_if_modified(data_file, etag=self._etag)
+            if data is not None:
+                self._data, self._etag = data, etag
+            return self._data
+
+        log = self._deltas
+        for attempt in range(DELTA_READ_ATTEMPTS):
+            log.set_base(*await self._get_if_modified(data_file, etag=log.etag))
+
+            deltas = await self._load_deltas(log)
+            if deltas is not None:
+                return log.apply(deltas)
+
+        raise log.changed()
+
+    async def health_check(self):
+        """Uses head object to make sure the file exists in S3."""
+        client = await self._client()
+
+        try:
+            await client.head_object(Bucket=self.backend.bucket_name, Key=self.backend.data_file)
+            return True
+        except ClientError:
+            logger.debug('Error encountered with S3.  Assume unhealthy')
+            return False
+
+
+class AsyncDynamoDBBackend(AsyncAWSBackend):
+    """Scans a DynamoDB backend's table without leaving the event loop.
+
+    The segments of a parallel scan are read concurrently on the loop.
+    """
+    service = 'dynamodb'
+
+    def __init__(self, backend, **kwargs):
+        super(AsyncDynamoDBBackend, self).__init__(backend, backend.table.meta.client.meta.region_name, **kwargs)
+        self.deserializer = TypeDeserializer()
+
+    async def _scan_segment(self, segment=None):
+        client = await self._client()
+        kwargs = {'TableName': self.backend.table.name}
+        if segment is not None:
+            kwargs.update(Segment=segment, TotalSegments=self.backend.scan_segments)
+
+        rows = []
+        async for page in client.get_paginator('scan').paginate(**kwargs):
+            for item in page['Items']:
+                rows.append(dict((k, self.deserializer.deserialize(v)) for k, v in item.items()))
+
+        return rows
+
+    async def _fetch(self):
+        if self.backend.scan_segments > 1:
+            segments = await asyncio.gather(*[self._scan_segment(s) for s in range(self.backend.scan_segments)])
+            return [item for segment in segments for item in segment]
+
+        return await self._scan_segment()
+
+    async def health_check(self):
+        """Scans the table to determine if Dynamo is functioning."""
+        try:
+            await self.get_all()
+            return True
+
+        except ClientError as e:
+            logger.exception(e)
+            logger.error('Error encountered with Database. Assume unhealthy')
+            return False
+
+
+NATIVE_BACKENDS = {
+    's3': AsyncS3Backend,
+    'dynamodb': AsyncDynamoDBBackend
+}
+
+
+class AsyncSWAGManager(SWAGManager):
+    """Manages swag backends from asyncio code.
+
+    Mirrors SWAGManager with coroutines. With aiobotocore installed the S3 and
+    DynamoDB backends are read with native asyncio clients, other calls run in
+    an executor that the optional `executor` keyword controls.
+    """
+    def configure(self, *args, **kwargs):
+        """Configures a SWAG manager. Overrides existing configuration."""
+        executor = kwargs.pop('executor', None)
+        super(AsyncSWAGManager, self).configure(*args, **kwargs)
+
+        backend = AsyncBackend
+        if get_session is not None:
+            backend = NATIVE_BACKENDS.get(kwargs['type'], AsyncBackend)
+
+        self.backend = backend(self.backend, cache_expires=kwargs['cache_expires'], executor=executor)
+
+    async def close(self):
+        """Releases the connections held by the backend."""
+        await self.backend.close()
+
+    async def create(self, item, dry_run=None):
+        """Create a new item in backend."""
+        return await self.backend.create(self._validate(item), dry_run=dry_run)
+
+    async def delete(self, item, dry_run=None):
+        """Delete an item in backend."""
+        return await self.backend.delete(item, dry_run=dry_run)
+
+    async def update(self, item, dry_run=None):
+        """Update an item in backend."""
+        return await self.backend.update(self._validate(item), dry_run=dry_run)
+
+    async def create_many(self, items, dry_run=None):
+        """Create several new items in backend with a single write."""
+        return await self.backend.create_many(self._validate(items, many=True), dry_run=dry_run)
+
+    async def delete_many(self, items, dry_run=None):
+        """Delete several items in backend with a single write."""
+        return await self.backend.delete_many(items, dry_run=dry_run)
+
+    async def update_many(self, items, dry_run=None):
+        """Update several items in backend with a single write."""
+        return await self.backend.update_many(self._validate(items, many=True), dry_run=dry_run)
+
+    async def update_fields(self, item_id, changes, expected_version=None, dry_run=None):
+        """Set fields of an item, a value of None removes the field."""
+        changes = validate_fields(changes, version=self.version, context=self.context)
+
+        update = getattr(self.backend.backend, 'update_item_fields', None)
+        if update is not None:
+            return await self.backend._write(update, item_id, changes, expected_version=expected_version,
+                                             dry_run=dry_run)
+
+        self._check_versioned(expected_version)
+        item = found_copy(await self.get_by_id(item_id), item_id)
+        return await self.update(apply_fields(item, changes), dry_run=dry_run)
+
+    async def set_service(self, item_id, service, expected_version=None, dry_run=None):
+        """Add a service to an item, or replace the service of the same name."""
+        service = self._validate_service(service)
+
+        update = getattr(self.backend.backend, 'update_item_service', None)
+        if update is not None:
+            return await self.backend._write(update, item_id, service, expected_version=expected_version,
+                                             dry_run=dry_run)
+
+        self._check_versioned(expected_version)
+        item = found_copy(await self.get_by_id(item_id), item_id)
+        return await self.update(apply_service(item, service), dry_run=dry_run)
+
+    async def get(self, search_filter):
+        """Fetch one item from backend."""
+        return one(await self.get_all(search_filter))
+
+    async def get_all(self, search_filter=None):
+        """Fetch all data from backend."""
+        return self._search(await self.backend.get_all(), search_filter)
+
+    async def get_by_id(self, item_id):
+        """Fetch one item by id, None if there is no such item."""
+        return one(await self.get_many_by_id([item_id]))
+
+    async def get_many_by_id(self, item_ids):
+        """Fetch all items with the given ids, in the order of the ids. Missing ids are skipped."""
+        return self._search_by_id(await self.backend.get_all(), item_ids)
+
+    async def iter_all(self, search_filter=None):
+        """Iterate over all data from backend, one item at a time."""
+        for item in self._iter_search(self._unwrap(await self.backend.get_all()), search_filter):
+            yield item
+
+    async def health_check(self):
+        """Performs a health check specific to backend technology."""
+        return await self.backend.health_check()
+
+    async def get_service_enabled(self, name, accounts_list=None, search_filter=None, region=None):
+        """Get a list of accounts where a service has been enabled."""
+        items = None
+        if not accounts_list:
+            items = await self.backend.get_all()
+
+        return self._search_service_enabled(items, name, accounts_list=accounts_list, search_filter=search_filter,
+                                            region=region)
+
+    async def get_service(self, name, search_filter):
+        """Fetch service metadata."""
+        return self._search_service(await self.get(search_filter), name)
+
+    async def get_service_name(self, name, search_filter):
+        """Fetch account name as referenced by a particular service. """
+        return self._search_service_name(await self.get(search_filter), name)
+
+    async def get_by_name(self, name, alias=None):
+        """Fetch all accounts with name specified, optionally include aliases."""
+        return self._search_by_name(await self.backend.get_all(), name, alias=alias)
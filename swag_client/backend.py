@@ -3,37 +3,324 @@
     :platform: Unix
 .. author:: Kevin Glisson (kglisson@netflix.com)
 """
+import copy
 import logging
 import pkg_resources
 
-import jmespath
+import simplejson as json
+from marshmallow import RAISE, fields, missing
+from marshmallow.exceptions import ValidationError
 
+from swag_client.index import AccountIndex, get_index_fields, is_service_enabled, parse_equality_filter, plan_filter
 from swag_client.schemas import v1, v2
-from swag_client.util import parse_swag_config_options
-from swag_client.exceptions import InvalidSWAGDataException
+from swag_client.util import BoundedDict, parse_swag_config_options, search
+from swag_client.exceptions import InvalidSWAGDataException, SWAGConflictError, SWAGException
 
 logger = logging.getLogger(__name__)
 
+_schemas = BoundedDict(64)
+_fast_loaders = BoundedDict(64)
 
-def validate(item, namespace='accounts', version=2, context=None):
+
+def get_schema(version=2, context=None):
+    """Fetches the account schema for a version and context.
+
+    Schemas keep no state between loads, so a single instance is shared per
+    distinct context instead of building one (and its nested schemas) per item.
+    """
+    if version == 1:
+        context = None
+
+    key = (version, json.dumps(context or {}, sort_keys=True, default=str))
+    schema = _schemas.get(key)
+
+    if schema is None:
+        if version == 2:
+            schema = v2.AccountSchema(context=copy.deepcopy(context))
+        elif version == 1:
+            schema = v1.AccountSchema()
+        else:
+            raise InvalidSWAGDataException('Schema version is not supported. Version: {}'.format(version))
+
+        _schemas[key] = schema
+
+    return schema
+
+
+class _Fallback(Exception):
+    """Raised while fast loading when an item needs the full schema."""
+
+
+def _fallback():
+    raise _Fallback()
+
+
+def _load_default(field):
+    # Older marshmallow releases only know the deprecated name.
+    if hasattr(field, 'load_default'):
+        return field.load_default
+    return field.missing
+
+
+class FastLoader(object):
+    """Loads items of the common shape without marshmallow's load machinery.
+
+    Strings, emails, booleans, integers, plain dicts, lists and nested schemas
+    are type checked and run through their field validators, missing fields
+    get their defaults and schema level validators are called directly. Values
+    marshmallow would coerce (bytes, 'true', ...), unknown keys, errors and
+    any field or hook this does not know make `load` return None, the caller
+    then runs the full schema, which also builds the error messages.
+    """
+    def __init__(self, schema):
+        self.schema = schema
+
+        try:
+            self.fields, self.keys, self.validators = self._compile_schema(schema)
+        except _Fallback:
+            self.fields = None
+
+        if schema.many:
+            self.fields = None
+
+    def _compile_schema(self, schema):
+        if schema.unknown != RAISE:
+            _fallback()
+
+        compiled = []
+        for name, field in schema.load_fields.items():
+            default = _load_default(field)
+            if field.required or default is missing:
+                default = missing
+            compiled.append((field.data_key or name, field.attribute or name, field.required, default,
+                             self._compile(field)))
+
+        validators = []
+        for attr_name in dir(type(schema)):
+            config = getattr(getattr(type(schema), attr_name, None), '__marshmallow_hook__', None)
+            for key, kwargs in (config or {}).items():
+                tag, pass_many = key if isinstance(key, tuple) else (key, (kwargs or {}).get('pass_many', False))
+                if tag in ('pre_dump', 'post_dump'):
+                    continue
+                if tag != 'validates_schema' or pass_many or (kwargs or {}).get('pass_original'):
+                    _fallback()
+                validators.append(getattr(schema, attr_name))
+
+        return compiled, frozenset(key for key, _, _, _, _ in compiled), validators
+
+    def _compile(self, field):
+        """Builds a function loading one value of field, raising _Fallback when it cannot."""
+        checks = list(field.validators)
+
+        def validated(value):
+            try:
+                for check in checks:
+                    if check(value) is False:
+                        _fallback()
+            except ValidationError:
+                _fallback()
+            return value
+
+        def nullable(load):
+            def load_value(value):
+                if value is None:
+                    if not field.allow_none:
+                        _fallback()
+                    return None
+                return load(value)
+            return load_value
+
+        if type(field) in (fields.String, fields.Email):
+            return nullable(lambda value: validated(value) if type(value) is str else _fallback())
+
+        if type(field) is fields.Boolean:
+            return nullable(lambda value: validated(value) if type(value) is bool else _fallback())
+
+        if type(field) is fields.Integer:
+            return nullable(lambda value: validated(value) if type(value) is int else _fallback())
+
+        if type(field) is fields.Dict and field.key_field is None and field.value_field is None:
+            return nullable(lambda value: validated(dict(value)) if type(value) is dict else _fallback())
+
+        if type(field) is fields.List:
+            inner = self._compile(field.inner)
+            return nullable(lambda value: validated([inner(v) for v in value]) if type(value) is list else _fallback())
+
+        if type(field) is fields.Nested and not field.only and not field.exclude:
+            nested = field.schema
+            loaded = self._compile_schema(nested)
+
+            def load_one(value):
+                return self._load(value, *loaded)
+
+            if field.many:
+                return nullable(lambda value: validated([load_one(v) for v in value])
+                                if type(value) is list else _fallback())
+            return nullable(lambda value: validated(load_one(value)))
+
+        _fallback()
+
+    def _load(self, item, compiled, keys, validators):
+        if type(item) is not dict or not keys.issuperset(item):
+            _fallback()
+
+        result = {}
+        for key, attribute, required, default, load in compiled:
+            if key in item:
+                result[attribute] = load(item[key])
+            elif required:
+                _fallback()
+            elif default is not missing:
+                result[attribute] = copy.deepcopy(default() if callable(default) else default)
+
+        try:
+            for validator in validators:
+                validator(result, partial=None, many=False)
+        except ValidationError:
+            _fallback()
+
+        return result
+
+    def load(self, item):
+        """Loads an item, None when the full schema is needed."""
+        if self.fields is None:
+            return None
+
+        try:
+            return self._load(item, self.fields, self.keys, self.validators)
+        except _Fallback:
+            return None
+
+
+def fast_load(schema, item, many=False):
+    """Loads items on the fast path, running the full schema only for those that need it."""
+    loader = _fast_loaders.get(id(schema))
+    if loader is None or loader.schema is not schema:
+        loader = _fast_loaders[id(schema)] = FastLoader(schema)
+
+    if not many:
+        result = loader.load(item)
+        return result if result is not None else schema.load(item)
+
+    results = []
+    errors = {}
+    for position, i in enumerate(item):
+        result = loader.load(i)
+        if result is None:
+            try:
+                result = schema.load(i)
+            except ValidationError as e:
+                errors[position] = e.messages
+        results.append(result)
+
+    if errors:
+        raise ValidationError(errors)
+
+    return results
+
+
+def validate_fields(changes, version=2, context=None):
+    """Validate some fields of an item.
+
+    Every field is deserialized on its own. Of the schema level checks only
+    the schema context and the regions are validated, the others need the
+    whole item. A value of None removes an optional field, the id can not
+    be changed.
+    """
+    schema = get_schema(version, context)
+    errors = {}
+    result = {}
+
+    for name, value in changes.items():
+        field = schema.fields.get(name)
+
+        if field is None:
+            errors[name] = ['Unknown field.']
+            continue
+
+        if name == 'id':
+            errors[name] = ['The id of an item can not be changed.']
+            continue
+
+        if value is None:
+            if field.required:
+                errors[name] = [field.error_messages['required']]
+            else:
+                result[name] = None
+            continue
+
+        try:
+            result[name] = field.deserialize(value)
+        except ValidationError as e:
+            errors[name] = e.messages
+            continue
+
+        allowed_values = (context or {}).get(name) if version == 2 and name in v2.CONTEXT_FIELDS else None
+        if allowed_values and result[name] not in allowed_values:
+            errors[name] = ['Must be one of {}'.format(allowed_values)]
+
+        if version == 2 and name == 'regions':
+            region_errors = {}
+            for region, settings in result[name].items():
+                messages = v2.REGION_SCHEMA.validate(settings)
+                if messages:
+                    region_errors[region] = messages
+
+            if region_errors:
+                errors[name] = region_errors
+
+    if errors:
+        raise ValidationError(errors)
+
+    return result
+
+
+def validate(item, namespace='accounts', version=2, context=None, many=False, fast=False):
     """Validate item against version schema.
     
     Args:
-        item: data object
+        item: data object, or a list of them with many
         namespace: backend namespace
         version: schema version
         context: schema context object
+        many: validate a list of items in one pass
+        fast: load items of the common shape without the full schema, see `FastLoader`
     """
     if namespace == 'accounts':
-        if version == 2:
-            schema = v2.AccountSchema(context=context)
-            return schema.load(item)
-        elif version == 1:
-            return v1.AccountSchema().load(item)
-        raise InvalidSWAGDataException('Schema version is not supported. Version: {}'.format(version))
+        schema = get_schema(version, context)
+        if fast:
+            return fast_load(schema, item, many=many)
+        return schema.load(item, many=many)
     raise InvalidSWAGDataException('Namespace not supported. Namespace: {}'.format(namespace))
 
 
+def found_copy(item, item_id):
+    """Copies an item about to be changed, cached items are shared."""
+    if item is None:
+        raise SWAGConflictError('Item does not exist. Id: {}'.format(item_id))
+
+    return copy.deepcopy(item)
+
+
+def apply_fields(item, changes):
+    """Sets fields of an item, a value of None removes the field."""
+    item.update(changes)
+    return dict((k, v) for k, v in item.items() if v is not None)
+
+
+def apply_service(item, service):
+    """Replaces the service of the same name in an item, or appends it."""
+    services = item.setdefault('services', [])
+    names = [s.get('name') for s in services]
+
+    if service['name'] in names:
+        services[names.index(service['name'])] = service
+    else:
+        services.append(service)
+
+    return item
+
+
 def one(items):
     """Fetches one item from a list. Throws exception if there are multiple items."""
     if items:
@@ -51,6 +338,7 @@ def get(name):
 class SWAGManager(object):
     """Manages swag backends."""
     def __init__(self, *args, **kwargs):
+        self._index = None
         if kwargs:
             self.configure(*args, **kwargs)
 
@@ -61,10 +349,13 @@ class SWAGManager(object):
         self.namespace = kwargs['namespace']
         self.backend = get(kwargs['type'])(*args, **kwargs)
         self.context = kwargs.pop('schema_context', {})
+        self.fast_validation = kwargs.get('fast_validation', False)
+        self.index_fields = get_index_fields(kwargs.get('index_fields'), self.version)
+        self._index = None
 
     def create(self, item, dry_run=None):
         """Create a new item in backend."""
-        return self.backend.create(validate(item, version=self.version, context=self.context), dry_run=dry_run)
+        return self.backend.create(self._validate(item), dry_run=dry_run)
 
     def delete(self, item, dry_run=None):
         """Delete an item in backend."""
@@ -72,7 +363,79 @@ class SWAGManager(object):
 
     def update(self, item, dry_run=None):
         """Update an item in backend."""
-        return self.backend.update(validate(item, version=self.version, context=self.context), dry_run=dry_run)
+        return self.backend.update(self._validate(item), dry_run=dry_run)
+
+    def create_many(self, items, dry_run=None):
+        """Create several new items in backend with a single write."""
+        return self.backend.create_many(self._validate(items, many=True), dry_run=dry_run)
+
+    def delete_many(self, items, dry_run=None):
+        """Delete several items in backend with a single write."""
+        return self.backend.delete_many(items, dry_run=dry_run)
+
+    def update_many(self, items, dry_run=None):
+        """Update several items in backend with a single write."""
+        return self.backend.update_many(self._validate(items, many=True), dry_run=dry_run)
+
+    def _validate(self, item, many=False):
+        attribute = getattr(self.backend, 'version_attribute', None)
+        if not attribute:
+            return validate(item, version=self.version, context=self.context, many=many, fast=self.fast_validation)
+
+        # The backend's version counter is not part of the schema. It is carried over for the backend to check.
+        items = item if many else [item]
+        versions = [i.get(attribute) if isinstance(i, dict) else None for i in items]
+        items = [dict((k, v) for k, v in i.items() if k != attribute) if isinstance(i, dict) else i for i in items]
+
+        loaded = validate(items, version=self.version, context=self.context, many=True, fast=self.fast_validation)
+        for i, version in zip(loaded, versions):
+            if version is not None:
+                i[attribute] = version
+
+        return loaded if many else loaded[0]
+
+    def update_fields(self, item_id, changes, expected_version=None, dry_run=None):
+        """Update some fields of an item, a value of None removes the field.
+
+        Backends that support it change the fields in place, optionally only if
+        the item still has `expected_version`. Others update the whole item.
+        """
+        changes = validate_fields(changes, version=self.version, context=self.context)
+
+        update = getattr(self.backend, 'update_item_fields', None)
+        if update is not None:
+            return update(item_id, changes, expected_version=expected_version, dry_run=dry_run)
+
+        self._check_versioned(expected_version)
+        return self.update(apply_fields(self._get_by_id(item_id), changes), dry_run=dry_run)
+
+    def set_service(self, item_id, service, expected_version=None, dry_run=None):
+        """Add a service to an item, or replace the service of the same name.
+
+        Backends that support it change the service in place, optionally only
+        if the item still has `expected_version`. Others update the whole item.
+        """
+        service = self._validate_service(service)
+
+        update = getattr(self.backend, 'update_item_service', None)
+        if update is not None:
+            return update(item_id, service, expected_version=expected_version, dry_run=dry_run)
+
+        self._check_versioned(expected_version)
+        return self.update(apply_service(self._get_by_id(item_id), service), dry_run=dry_run)
+
+    def _validate_service(self, service):
+        if self.version != 2:
+            raise InvalidSWAGDataException('Services can only be set on version 2 items.')
+
+        return v2.SERVICE_SCHEMA.load(service)
+
+    def _check_versioned(self, expected_version):
+        if expected_version is not None:
+            raise SWAGException('Conditional updates are not supported by this backend.')
+
+    def _get_by_id(self, item_id):
+        return found_copy(self.get_by_id(item_id), item_id)
 
     def get(self, search_filter):
         """Fetch one item from backend."""
@@ -80,80 +443,194 @@ class SWAGManager(object):
 
     def get_all(self, search_filter=None):
         """Fetch all data from backend."""
-        items = self.backend.get_all()
+        if search_filter:
+            criteria = parse_equality_filter(search_filter, self.version)
+            if criteria:
+                items = self._get_items_by_key(*criteria)
+                if items is not None:
+                    return items
+
+            index = self._get_backend_index()
+            if index is not None:
+                plan = plan_filter(search_filter, self.version, index.fields)
+                if plan is not None:
+                    return index.search(plan)
+
+            items = self._get_items_by_filter(search_filter)
+            if items is not None:
+                return search(search_filter, items)
+
+        return self._search(self.backend.get_all(), search_filter)
+
+    def get_by_id(self, item_id):
+        """Fetch one item by id, None if there is no such item."""
+        return one(self.get_many_by_id([item_id]))
+
+    def get_many_by_id(self, item_ids):
+        """Fetch all items with the given ids, in the order of the ids. Missing ids are skipped."""
+        items = self._get_items_by_key('id', *item_ids)
+        if items is None:
+            items = self._search_by_id(None, item_ids)
+        return items
+
+    def _search_by_id(self, items, item_ids):
+        index = self._get_index(items)
+        return [item for item_id in dict.fromkeys(item_ids) for item in index.lookup('id', item_id)]
+
+    def _get_items_by_filter(self, search_filter):
+        """Fetches the items a backend preselects for a filter, when it can evaluate some of it itself."""
+        get_items = getattr(self.backend, 'get_items_by_filter', None)
+        if get_items is not None and self.version == 2:
+            return get_items(search_filter)
+
+    def _get_items_by_key(self, field, *values):
+        """Fetches items straight from the backend when field is its key, instead of loading every item."""
+        get_items = getattr(self.backend, 'get_items_by_key', None)
+        if get_items is not None and self.version == 2 and field == self.backend.key_attribute:
+            return get_items(values)
+
+    def iter_all(self, search_filter=None):
+        """Iterate over all data from backend, one item at a time.
+
+        Items are streamed from the backend when it supports it, bypassing its
+        cache. The search filter is applied to each item on its own, so it must
+        select items individually, like `[?environment=='prod']`.
+        """
+        iter_items = getattr(self.backend, 'iter_items', None)
+        if iter_items is None:
+            items = self._unwrap(self.backend.get_all())
+        else:
+            items = iter_items()
+
+        return self._iter_search(items, search_filter)
 
+    def _unwrap(self, items):
+        if self.version == 1:
+            return [item for values in (items or {}).values() for item in values]
+        return items or []
+
+    def _iter_search(self, items, search_filter=None):
+        for item in items:
+            if not search_filter:
+                yield item
+                continue
+
+            data = {self.namespace: [item]} if self.version == 1 else [item]
+            for match in search(search_filter, data) or []:
+                yield match
+
+    def _search(self, items, search_filter=None):
+        """Applies a search filter to a generation of backend data."""
         if not items:
             if self.version == 1:
                 return {self.namespace: []}
             return []
 
         if search_filter:
-            items = jmespath.search(search_filter, items)
+            index = self._get_backend_index()
+            plan = plan_filter(search_filter, self.version, self.index_fields if index is None else index.fields)
+            if plan is not None:
+                return self._get_index(items).search(plan)
+
+            items = search(search_filter, items)
 
         return items
 
+    def _get_index(self, items=None):
+        """Fetches the lookup index for the current generation of backend data.
+
+        The backend cache hands back the same object until it expires, so the
+        index is rebuilt whenever the object we are given is not the one it was
+        built from.
+        """
+        index = self._get_backend_index()
+        if index is not None:
+            return index
+
+        if items is None:
+            items = self.backend.get_all()
+
+        if self._index is None or self._index.source is not items:
+            self._index = AccountIndex(items, version=self.version, fields=self.index_fields)
+
+        return self._index
+
+    def _get_backend_index(self):
+        """Fetches an index the backend keeps itself, which answers lookups without loading every item."""
+        get_index = getattr(self.backend, 'get_index', None)
+        if get_index is not None:
+            return get_index()
+
     def health_check(self):
         """Performs a health check specific to backend technology."""
         return self.backend.health_check()
 
     def get_service_enabled(self, name, accounts_list=None, search_filter=None, region=None):
         """Get a list of accounts where a service has been enabled."""
+        items = None
+        if not accounts_list and (search_filter or self._get_backend_index() is None):
+            items = self.backend.get_all()
+
+        return self._search_service_enabled(items, name, accounts_list=accounts_list, search_filter=search_filter,
+                                            region=region)
+
+    def _search_service_enabled(self, items, name, accounts_list=None, search_filter=None, region=None):
+        if not accounts_list and not search_filter:
+            index = self._get_backend_index()
+            if index is None:
+                if not items:
+                    return []
+                index = self._get_index(items)
+
+            return index.service_enabled(name, region=region)
+
         if not accounts_list:
-            accounts = self.get_all(search_filter=search_filter)
+            accounts = self._search(items, search_filter=search_filter)
         else:
             accounts = accounts_list
 
         if self.version == 1:
             accounts = accounts['accounts']
 
-        enabled = []
-        for account in accounts:
-            if self.version == 1:
-                account_filter = "accounts[?id=='{id}']".format(id=account['id'])
-            else:
-                account_filter = "[?id=='{id}']".format(id=account['id'])
-
-            service = self.get_service(name, search_filter=account_filter)
-
-            if self.version == 1:
-                if service:
-                    service = service['enabled']  # no region information available in v1
-            else:
-                if not region:
-                    service_filter = "status[?enabled]"
-                else:
-                    service_filter = "status[?(region=='{region}' || region=='all') && enabled]".format(region=region)
-
-                service = jmespath.search(service_filter, service)
-
-            if service:
-                enabled.append(account)
-
-        return enabled
+        return [account for account in accounts if is_service_enabled(account, name, self.version, region=region)]
 
     def get_service(self, name, search_filter):
         """Fetch service metadata."""
+        return self._search_service(self.get(search_filter), name)
+
+    def _search_service(self, account, name):
         if self.version == 1:
             service_filter = "service.{name}".format(name=name)
-            return jmespath.search(service_filter, self.get(search_filter))
+            return search(service_filter, account)
         else:
-            service_filter = "services[?name=='{}']".format(name)
-            return one(jmespath.search(service_filter, self.get(search_filter)))
+            return one(search("services[?name==param('name')]", account, name=name))
 
     def get_service_name(self, name, search_filter):
         """Fetch account name as referenced by a particular service. """
-        service_filter = "services[?name=='{}'].metadata.name".format(name)
-        return one(jmespath.search(service_filter, self.get(search_filter)))
+        return self._search_service_name(self.get(search_filter), name)
+
+    def _search_service_name(self, account, name):
+        return one(search("services[?name==param('name')].metadata.name", account, name=name))
 
     def get_by_name(self, name, alias=None):
         """Fetch all accounts with name specified, optionally include aliases."""
-        search_filter = "[?name=='{}']".format(name)
+        items = None
+        if self._get_backend_index() is None:
+            items = self.backend.get_all()
 
-        if alias:
-            if self.version == 1:
-                search_filter = "accounts[?name=='{name}' || contains(alias, '{name}')]".format(name=name)
+        return self._search_by_name(items, name, alias=alias)
 
-            elif self.version == 2:
-                search_filter = "[?name=='{name}' || contains(aliases, '{name}')]".format(name=name)
+    def _search_by_name(self, items, name, alias=None):
+        index = self._get_backend_index()
+        if index is None:
+            if not items:
+                if self.version == 1:
+                    return {self.namespace: []}
+                return []
+
+            index = self._get_index(items)
+
+        if alias:
+            return index.lookup_any(('name', name, False), (index.alias_field, name, True))
 
-        return self.get_all(search_filter)
+        return index.lookup('name', name)
@@ -1,14 +1,388 @@
+import functools
 import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+import simplejson as json
 from botocore.exceptions import ClientError
-from dogpile.cache import make_region
+from dogpile.cache.api import NO_VALUE
+from jmespath.exceptions import JMESPathError
+from marshmallow.exceptions import ValidationError
 
 from swag_client.backend import SWAGManager
+from swag_client.compat import string_types
+from swag_client.exceptions import SWAGConflictError, SWAGException
+from swag_client.singleflight import single_flight_loader
+from swag_client.util import RefreshAheadCache, TokenBucket, expression_cache, make_cache_region
 
-logger = logging.getLogger(__file__)
+logger = logging.getLogger(__name__)
 
-dynamodb_region = make_region()
+BATCH_SIZE = 25
+BATCH_GET_SIZE = 100
+MAX_READ_ATTEMPTS = 8
+THROTTLING_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded')
+BURST_SECONDS = 300
+
+
+def get_write_units(item):
+    """Estimates the write capacity consumed by an item (one unit per started KB)."""
+    return len(json.dumps(item, default=str)) // 1024 + 1
+
+
+class ThrottledBatchWriter(object):
+    """Writes to a DynamoDB table in parallel batches without exceeding its write capacity.
+
+    Every batch reserves its estimated write units from a shared token bucket
+    before it is sent, unless `write_units` is None. Throttling errors and
+    unprocessed items are retried with exponential backoff and jitter.
+    """
+    def __init__(self, table, write_units, key_attribute='id', max_workers=4, max_attempts=8,
+                 backoff_base=0.05, backoff_max=5.0, report_interval=10, progress=None, burst_units=None):
+        self.table = table
+        self.key_attribute = key_attribute
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.report_interval = report_interval
+        self.progress = progress
+        self.bucket = TokenBucket(write_units, capacity=burst_units) if write_units else None
+
+        self._lock = threading.Lock()
+        self._total = 0
+        self._written = 0
+        self._retries = 0
+        self._started = None
+        self._reported = None
+
+    def put_items(self, items):
+        """Puts items, the last occurrence of a key wins."""
+        requests = [(item[self.key_attribute], {'PutRequest': {'Item': item}}) for item in items]
+        return self.write(requests)
+
+    def delete_items(self, items):
+        """Deletes items by key."""
+        requests = [(item[self.key_attribute], {'DeleteRequest': {'Key': {self.key_attribute: item[self.key_attribute]}}})
+                    for item in items]
+        return self.write(requests)
+
+    def write(self, requests):
+        """Sends `(key, request)` pairs and returns write statistics."""
+        # DynamoDB rejects batches that touch the same key twice.
+        unique = {}
+        for key, request in requests:
+            unique.pop(key, None)
+            unique[key] = request
+        requests = list(unique.values())
+
+        self._total = len(requests)
+        self._written = 0
+        self._retries = 0
+        self._started = self._reported = time.monotonic()
+
+        batches = [requests[i:i + BATCH_SIZE] for i in range(0, len(requests), BATCH_SIZE)]
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for _ in executor.map(self._write_batch, batches):
+                pass
+
+        stats = self.stats()
+        logger.info('Wrote {items} items to {table} in {seconds:.1f}s ({throughput:.1f} items/s, {retries} retries).'.format(
+            table=self.table.name,
+            **stats
+        ))
+        return stats
+
+    def stats(self):
+        """Reports progress of the current write."""
+        seconds = time.monotonic() - self._started
+        return {
+            'items': self._written,
+            'total': self._total,
+            'retries': self._retries,
+            'seconds': seconds,
+            'throughput': self._written / seconds if seconds else 0.0
+        }
+
+    def _backoff(self, attempt):
+        if attempt >= self.max_attempts:
+            raise SWAGException('Gave up writing to {table} after {attempts} throttled attempts.'.format(
+                table=self.table.name,
+                attempts=attempt
+            ))
+
+        with self._lock:
+            self._retries += 1
+
+        time.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt)))
+
+    def _write_batch(self, batch):
+        client = self.table.meta.client
+        pending = batch
+        attempt = 0
+
+        if self.bucket is not None:
+            self.bucket.consume(sum(get_write_units(r.get('PutRequest', r.get('DeleteRequest'))) for r in pending))
+
+        while pending:
+            try:
+                response = client.batch_write_item(RequestItems={self.table.name: pending})
+            except ClientError as e:
+                if e.response['Error']['Code'] not in THROTTLING_ERRORS:
+                    raise
+                self._backoff(attempt)
+                attempt += 1
+                continue
+
+            unprocessed = response.get('UnprocessedItems', {}).get(self.table.name, [])
+            self._record(len(pending) - len(unprocessed))
+
+            if unprocessed:
+                self._backoff(attempt)
+                attempt += 1
+
+            pending = unprocessed
+
+    def _record(self, count):
+        with self._lock:
+            self._written += count
+            now = time.monotonic()
+            report = now - self._reported >= self.report_interval or self._written == self._total
+            if report:
+                self._reported = now
+
+        if self.progress:
+            self.progress(self.stats())
+        elif report:
+            logger.info('Written {items} of {total} items ({throughput:.1f} items/s).'.format(**self.stats()))
+
+
+COMPARATORS = {'eq': '=', 'ne': '<>', 'lt': '<', 'lte': '<=', 'gt': '>', 'gte': '>='}
+FLIPPED = {'=': '=', '<>': '<>', '<': '>', '<=': '>=', '>': '<', '>=': '<='}
+FUNCTIONS = {'contains': 'contains', 'starts_with': 'begins_with'}
+
+
+def parse_filter(search_filter):
+    """Translates a JMESPath filter of the form `[?predicate]` into a predicate DynamoDB can evaluate.
+
+    Comparisons of a field with a string, integer or boolean literal, `contains`
+    and `starts_with` are translated, combined with `&&` and `||`. Parts of a
+    conjunction that cannot be translated are dropped, so the predicate may
+    match more items than the filter but never fewer, and the filter must
+    still be applied to the items it returns. Returns None when nothing can be
+    translated.
+
+    Predicates are tuples: `('compare', operator, path, value)`,
+    `('function', name, path, value)`, `('and', predicates)` and `('or', predicates)`.
+    """
+    try:
+        parsed = expression_cache.get(search_filter).parsed
+    except JMESPathError:
+        return
+
+    if parsed['type'] != 'filter_projection':
+        return
+
+    left, right, predicate = parsed['children']
+    if left['type'] != 'identity' or right['type'] != 'identity':
+        return
+
+    return _parse_predicate(predicate)
+
+
+def _parse_predicate(node):
+    if node['type'] in ('and_expression', 'or_expression'):
+        operator = 'and' if node['type'] == 'and_expression' else 'or'
+        children = []
+        for child in (_parse_predicate(c) for c in node['children']):
+            if child is None:
+                if operator == 'or':
+                    return
+                continue
+
+            children += child[1] if child[0] == operator else [child]
+
+        if not children:
+            return
+        return (operator, children) if len(children) > 1 else children[0]
+
+    if node['type'] == 'comparator':
+        operator = COMPARATORS[node['value']]
+        path, value = _parse_path(node['children'][0]), _parse_literal(node['children'][1])
+        if path is None:
+            operator = FLIPPED[operator]
+            path, value = _parse_path(node['children'][1]), _parse_literal(node['children'][0])
+
+        # JMESPath never treats 0 and 1 as booleans when testing for equality and only
+        # orders numbers and strings, which is how DynamoDB compares values too. Floats
+        # cannot be sent to DynamoDB.
+        if path is None or not isinstance(value, string_types + (int,)):
+            return
+
+        if isinstance(value, bool) and operator not in ('=', '<>'):
+            return
+
+        return ('compare', operator, path, value)
+
+    if node['type'] == 'function_expression' and node['value'] in FUNCTIONS and len(node['children']) == 2:
+        path, value = _parse_path(node['children'][0]), _parse_literal(node['children'][1])
+        if path is None or not isinstance(value, string_types):
+            return
+
+        return ('function', FUNCTIONS[node['value']], path, value)
+
+
+def _parse_path(node):
+    if node['type'] == 'field':
+        return (node['value'],)
+
+    if node['type'] == 'subexpression':
+        paths = [_parse_path(child) for child in node['children']]
+        if None not in paths:
+            return sum(paths, ())
+
+
+def _parse_literal(node):
+    if node['type'] == 'literal':
+        return node['value']
+
+
+def attribute_type(value):
+    """DynamoDB type of a literal from `parse_filter`."""
+    if isinstance(value, bool):
+        return 'BOOL'
+    if isinstance(value, string_types):
+        return 'S'
+    return 'N'
+
+
+def split_key_condition(predicate, key_schemas):
+    """Splits the conditions a Query can use off a predicate.
+
+    `key_schemas` are `(index_name, [(attribute, type), ...])` pairs, hash key
+    first, with None naming the table itself. Returns the index name, the key
+    conditions and the remaining predicates, or no key conditions when the
+    predicate does not fix the hash key of any of them.
+    """
+    conjuncts = predicate[1] if predicate[0] == 'and' else [predicate]
+
+    for index_name, keys in key_schemas:
+        hash_key = _find_key_condition(conjuncts, keys[0], ('=',))
+        if hash_key is None:
+            continue
+
+        conditions = [hash_key]
+        if len(keys) > 1:
+            range_key = _find_key_condition(conjuncts, keys[1], ('=', '<', '<=', '>', '>=', 'begins_with'))
+            if range_key is not None:
+                conditions.append(range_key)
+
+        return index_name, conditions, [c for c in conjuncts if c not in conditions]
+
+    return None, None, conjuncts
+
+
+def _find_key_condition(conjuncts, key, operators):
+    attribute, attribute_type = key
+    value_types = string_types if attribute_type == 'S' else (int,)
+
+    for conjunct in conjuncts:
+        kind, operator, path, value = conjunct if conjunct[0] in ('compare', 'function') else (None,) * 4
+        if kind is None or path != (attribute,) or operator not in operators:
+            continue
+
+        if isinstance(value, value_types) and not isinstance(value, bool):
+            return conjunct
+
+
+class ExpressionAttributes(object):
+    """Attribute name and value placeholders shared by the expressions of a request.
+
+    Attribute names and values always go through placeholders, so reserved
+    words and arbitrary values are safe to use.
+    """
+    def __init__(self):
+        self.names = {}
+        self.values = {}
+
+    def name(self, *path):
+        """Placeholder for an attribute path, integers index into lists."""
+        placeholders = {v: k for k, v in self.names.items()}
+        parts = []
+        for part in path:
+            if isinstance(part, int):
+                parts[-1] += '[{}]'.format(part)
+                continue
+
+            if part not in placeholders:
+                placeholders[part] = '#n{}'.format(len(self.names))
+                self.names[placeholders[part]] = part
+            parts.append(placeholders[part])
+
+        return '.'.join(parts)
+
+    def value(self, value):
+        placeholder = ':v{}'.format(len(self.values))
+        self.values[placeholder] = value
+        return placeholder
+
+    def render(self, predicate):
+        """Renders a predicate from `parse_filter` as a condition expression."""
+        kind = predicate[0]
+        if kind in ('and', 'or'):
+            return '({})'.format(' {} '.format(kind.upper()).join(self.render(p) for p in predicate[1]))
+
+        _, operator, path, value = predicate
+        name = self.name(*path)
+
+        if kind == 'function':
+            return '{}({}, {})'.format(operator, name, self.value(value))
+
+        # JMESPath reads a missing field as null, and values of another type, as different
+        # from every literal. DynamoDB fails comparisons with either, so they are tested
+        # for explicitly.
+        if operator == '<>':
+            return '(attribute_not_exists({name}) OR NOT attribute_type({name}, {type}) OR {name} <> {value})'.format(
+                name=name,
+                type=self.value(attribute_type(value)),
+                value=self.value(value)
+            )
+
+        return '{} {} {}'.format(name, operator, self.value(value))
+
+    def arguments(self):
+        kwargs = {}
+        if self.names:
+            kwargs['ExpressionAttributeNames'] = self.names
+        if self.values:
+            kwargs['ExpressionAttributeValues'] = self.values
+        return kwargs
+
+
+class UpdateExpression(ExpressionAttributes):
+    """Builds the expressions of an UpdateItem request."""
+    def __init__(self):
+        ExpressionAttributes.__init__(self)
+        self.set = []
+        self.remove = []
+        self.add = []
+        self.conditions = []
+
+    def build(self):
+        clauses = []
+        for action, expressions in (('SET', self.set), ('REMOVE', self.remove), ('ADD', self.add)):
+            if expressions:
+                clauses.append('{} {}'.format(action, ', '.join(expressions)))
+
+        kwargs = {'UpdateExpression': ' '.join(clauses)}
+        kwargs.update(self.arguments())
+        if self.conditions:
+            kwargs['ConditionExpression'] = ' AND '.join(self.conditions)
+
+        return kwargs
 
 
 class DynamoDBSWAGManager(SWAGManager):
@@ -17,12 +391,26 @@ class DynamoDBSWAGManager(SWAGManager):
         self.namespace = namespace
         resource = boto3.resource('dynamodb', region_name=kwargs['region'])
         self.table = resource.Table(namespace)
+        self.write_units = kwargs.get('write_units')
+        self.write_workers = kwargs.get('write_workers', 4)
+        self.scan_segments = kwargs.get('scan_segments', 1)
+        self.key_attribute = kwargs.get('key_attribute', 'id')
+        self.version_attribute = kwargs.get('version_attribute')
+        self.filter_pushdown = kwargs.get('filter_pushdown', True)
+        self._description = None
+        self._key_schemas = None
+        self._generation = 0
 
-        if not dynamodb_region.is_configured:
-            dynamodb_region.configure(
-                'dogpile.cache.memory',
-                expiration_time=kwargs['cache_expires']
-            )
+        self.cache_key = 'dynamodb:{region}/{table}'.format(region=kwargs['region'], table=namespace)
+        self.region = make_cache_region(kwargs['cache_expires'], kwargs.get('cache_size'))
+        # Lookups by key are cached apart, so many of them can not evict the table.
+        self.item_region = make_cache_region(kwargs['cache_expires'], kwargs.get('cache_size'))
+        self._load = single_flight_loader(self.cache_key, self._get_all, lock_dir=kwargs.get('single_flight_dir'),
+                                          max_age=kwargs['cache_expires'])
+
+        self.refresher = None
+        if kwargs.get('refresh_ahead'):
+            self.refresher = RefreshAheadCache(self._load, kwargs['cache_expires'], kwargs.get('max_staleness'))
 
     def create(self, item, dry_run=None):
         """Creates a new item in file."""
@@ -32,7 +420,10 @@ class DynamoDBSWAGManager(SWAGManager):
         ))
 
         if not dry_run:
-            self.table.put_item(Item=item)
+            try:
+                item = self._put_item(item)
+            finally:
+                self._forget([item])
 
         return item
 
@@ -45,6 +436,7 @@ class DynamoDBSWAGManager(SWAGManager):
 
         if not dry_run:
             self.table.delete_item(Key={'id': item['id']})
+            self._forget([item])
 
         return item
 
@@ -56,32 +448,493 @@ class DynamoDBSWAGManager(SWAGManager):
         ))
 
         if not dry_run:
+            try:
+                item = self._put_item(item)
+            finally:
+                self._forget([item])
+
+        return item
+
+    def create_many(self, items, dry_run=None):
+        """Creates several new items using batched writes.
+
+        Batched writes cannot be conditional, with a `version_attribute` every
+        item is put on its own instead, see `_put_item`.
+        """
+        logger.debug('Creating {number_items} new items. Table: {namespace}'.format(
+            number_items=len(items),
+            namespace=self.namespace
+        ))
+
+        if dry_run:
+            return items
+
+        try:
+            if self.version_attribute:
+                return self._put_items(items)
+
+            self.get_writer().put_items(items)
+            return items
+
+        finally:
+            self._forget(items)
+
+    def _put_item(self, item):
+        """Puts a whole item.
+
+        With a `version_attribute` the put replaces only the version the item
+        carries (or an item that was never versioned, when it carries none)
+        and stores the next version, so full updates are seen by, and check,
+        conditional updates. Returns the item as written.
+        """
+        if not self.version_attribute:
             self.table.put_item(Item=item)
+            return item
+
+        expression = ExpressionAttributes()
+        version = expression.name(self.version_attribute)
+        expected_version = item.get(self.version_attribute)
+
+        if expected_version is None:
+            condition = 'attribute_not_exists({})'.format(version)
+        else:
+            condition = '{} = {}'.format(version, expression.value(expected_version))
+
+        item = dict(item)
+        item[self.version_attribute] = (expected_version or 0) + 1
+
+        # The low level client is thread safe, unlike the table resource.
+        try:
+            self.table.meta.client.put_item(TableName=self.table.name, Item=item, ConditionExpression=condition,
+                                            **expression.arguments())
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            raise SWAGConflictError('Item was changed by another writer. Id: {}'.format(item[self.key_attribute]))
 
         return item
 
-    @dynamodb_region.cache_on_arguments()
+    def _put_items(self, items):
+        """Puts items one by one on the writer threads, conflicts are raised once all were tried."""
+        def put(item):
+            try:
+                return self._put_item(item)
+            except SWAGConflictError:
+                return None
+
+        with ThreadPoolExecutor(max_workers=self.write_workers) as executor:
+            written = list(executor.map(put, items))
+
+        conflicts = [item[self.key_attribute] for item, result in zip(items, written) if result is None]
+        if conflicts:
+            raise SWAGConflictError('Items were changed by another writer. Ids: {}'.format(', '.join(conflicts)))
+
+        return written
+
+    def delete_many(self, items, dry_run=None):
+        """Deletes several items using batched writes."""
+        logger.debug('Deleting {number_items} items. Table: {namespace}'.format(
+            number_items=len(items),
+            namespace=self.namespace
+        ))
+
+        if not dry_run:
+            self.get_writer().delete_items(items)
+            self._forget(items)
+
+        return items
+
+    def update_many(self, items, dry_run=None):
+        """Updates several items using batched writes."""
+        logger.debug('Updating {number_items} items. Table: {namespace}'.format(
+            number_items=len(items),
+            namespace=self.namespace
+        ))
+
+        return self.create_many(items, dry_run=dry_run)
+
+    def update_item_fields(self, item_id, changes, expected_version=None, dry_run=None):
+        """Sets top level attributes of an item with a single UpdateItem, None values are removed."""
+        logger.debug('Updating item fields. Id: {item_id} Fields: {fields} Table: {namespace}'.format(
+            item_id=item_id,
+            fields=', '.join(changes),
+            namespace=self.namespace
+        ))
+
+        if self.key_attribute in changes:
+            raise ValidationError({self.key_attribute: ['The key of an item can not be changed.']})
+
+        expression = UpdateExpression()
+        for field, value in changes.items():
+            if value is None:
+                expression.remove.append(expression.name(field))
+            else:
+                expression.set.append('{} = {}'.format(expression.name(field), expression.value(value)))
+
+        def apply(item):
+            item.update(changes)
+            return dict((k, v) for k, v in item.items() if v is not None)
+
+        return self._update_item(item_id, expression, apply, expected_version=expected_version, dry_run=dry_run)
+
+    def update_item_service(self, item_id, service, expected_version=None, dry_run=None):
+        """Replaces the service of the same name, or appends it, without rewriting the rest of the item.
+
+        Only the item's services are read to find the position to write to. The
+        write is conditional on that position still holding the service (or on
+        the list not having grown), so concurrent edits are never overwritten.
+        """
+        logger.debug('Setting service. Id: {item_id} Service: {service} Table: {namespace}'.format(
+            item_id=item_id,
+            service=service['name'],
+            namespace=self.namespace
+        ))
+
+        response = self.table.get_item(Key={self.key_attribute: item_id}, ConsistentRead=True,
+                                       ProjectionExpression='#s', ExpressionAttributeNames={'#s': 'services'})
+        if 'Item' not in response:
+            raise SWAGConflictError('Item does not exist. Id: {}'.format(item_id))
+
+        names = [s.get('name') for s in response['Item'].get('services', [])]
+        expression = UpdateExpression()
+        services = expression.name('services')
+
+        if service['name'] in names:
+            position = names.index(service['name'])
+            expression.set.append('{} = {}'.format(expression.name('services', position), expression.value(service)))
+            expression.conditions.append('{} = {}'.format(expression.name('services', position, 'name'),
+                                                          expression.value(service['name'])))
+        else:
+            expression.set.append('{services} = list_append(if_not_exists({services}, {empty}), {service})'.format(
+                services=services,
+                empty=expression.value([]),
+                service=expression.value([service])
+            ))
+
+            size = 'size({}) = {}'.format(services, expression.value(len(names)))
+            if not names:
+                size = '(attribute_not_exists({}) OR {})'.format(services, size)
+            expression.conditions.append(size)
+
+        def apply(item):
+            services = item.setdefault('services', [])
+            if service['name'] in names:
+                services[names.index(service['name'])] = service
+            else:
+                services.append(service)
+            return item
+
+        return self._update_item(item_id, expression, apply, expected_version=expected_version, dry_run=dry_run)
+
+    def _update_item(self, item_id, expression, apply, expected_version=None, dry_run=None):
+        """Runs an UpdateItem and returns the updated item.
+
+        A dry run returns the item as it would be after the update, built by
+        `apply` from the current item, like the backends without partial updates.
+        """
+        if dry_run:
+            return self._preview_update(item_id, apply, expected_version=expected_version)
+
+        expression.conditions.insert(0, 'attribute_exists({})'.format(expression.name(self.key_attribute)))
+
+        if self.version_attribute:
+            version = expression.name(self.version_attribute)
+            expression.add.append('{} {}'.format(version, expression.value(1)))
+
+            if expected_version == 0:
+                expression.conditions.append('attribute_not_exists({})'.format(version))
+            elif expected_version is not None:
+                expression.conditions.append('{} = {}'.format(version, expression.value(expected_version)))
+
+        try:
+            response = self.table.update_item(Key={self.key_attribute: item_id}, ReturnValues='ALL_NEW',
+                                              **expression.build())
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            raise SWAGConflictError('Item does not exist or was changed by another writer. Id: {}'.format(item_id))
+        finally:
+            self._forget_keys([item_id])
+
+        return response['Attributes']
+
+    def _preview_update(self, item_id, apply, expected_version=None):
+        item = self.table.get_item(Key={self.key_attribute: item_id}, ConsistentRead=True).get('Item')
+        if item is None:
+            raise SWAGConflictError('Item does not exist. Id: {}'.format(item_id))
+
+        if self.version_attribute:
+            version = item.get(self.version_attribute, 0)
+            if expected_version is not None and version != expected_version:
+                raise SWAGConflictError('Item was changed by another writer. Id: {}'.format(item_id))
+
+        item = apply(item)
+        if self.version_attribute:
+            item[self.version_attribute] = version + 1
+
+        return item
+
+    def get_writer(self, **kwargs):
+        """Creates a batch writer bound by the table's write capacity.
+
+        Without `write_units` the capacity provisioned for the table is used,
+        starting with the burst DynamoDB keeps of unused capacity. Writes to
+        on-demand tables are not throttled.
+        """
+        kwargs.setdefault('max_workers', self.write_workers)
+        kwargs.setdefault('key_attribute', self.key_attribute)
+
+        write_units = self.write_units
+        if write_units is None:
+            write_units = self.describe_table().get('ProvisionedThroughput', {}).get('WriteCapacityUnits')
+            kwargs.setdefault('burst_units', write_units and write_units * BURST_SECONDS)
+
+        return ThrottledBatchWriter(self.table, write_units, **kwargs)
+
+    def get_items_by_key(self, keys):
+        """Fetches items by key with GetItem or BatchGetItem instead of scanning the table.
+
+        Items, and keys that do not exist, are cached for `cache_expires` seconds
+        on their own, in a region apart from the result of get_all.
+        """
+        keys = list(dict.fromkeys(keys))
+        cached = self.item_region.get_multi([self._item_cache_key(key) for key in keys])
+        items = dict((key, item) for key, item in zip(keys, cached) if item is not NO_VALUE)
+
+        missing = [key for key in keys if key not in items]
+        if missing:
+            logger.debug('Fetching {number_items} items by key. Table: {namespace}'.format(
+                number_items=len(missing),
+                namespace=self.namespace
+            ))
+
+            fetched = dict((key, None) for key in missing)
+            for item in self._get_items(missing):
+                fetched[item[self.key_attribute]] = item
+
+            self.item_region.set_multi(dict((self._item_cache_key(key), item) for key, item in fetched.items()))
+            items.update(fetched)
+
+        return [items[key] for key in keys if items[key] is not None]
+
+    def _get_items(self, keys):
+        if len(keys) == 1:
+            response = self.table.get_item(Key={self.key_attribute: keys[0]})
+            return [response['Item']] if 'Item' in response else []
+
+        client = self.table.meta.client
+        items = []
+        for i in range(0, len(keys), BATCH_GET_SIZE):
+            pending = {self.table.name: {'Keys': [{self.key_attribute: key} for key in keys[i:i + BATCH_GET_SIZE]]}}
+            attempt = 0
+
+            while pending:
+                if attempt >= MAX_READ_ATTEMPTS:
+                    raise SWAGException('Gave up reading from {table} after {attempts} throttled attempts.'.format(
+                        table=self.table.name,
+                        attempts=attempt
+                    ))
+
+                if attempt:
+                    time.sleep(random.uniform(0, min(5.0, 0.05 * 2 ** attempt)))
+                attempt += 1
+
+                try:
+                    response = client.batch_get_item(RequestItems=pending)
+                except ClientError as e:
+                    if e.response['Error']['Code'] not in THROTTLING_ERRORS:
+                        raise
+                    continue
+
+                items += response['Responses'].get(self.table.name, [])
+                pending = response.get('UnprocessedKeys')
+
+        return items
+
+    def get_items_by_filter(self, search_filter):
+        """Fetches the items matching a JMESPath filter with a Query or a filtered Scan.
+
+        The filter is translated with `parse_filter` and evaluated by DynamoDB, a
+        Query is used when it fixes the hash key of the table or of a global
+        secondary index. The items returned may include some that do not match,
+        the filter still has to be applied to them. Returns None when the filter
+        cannot be translated, or when all items are cached already and filtering
+        them is cheaper.
+
+        A filtered Scan still reads, and is billed for, every item of the table,
+        only less data is returned. So only one filtered Scan runs per
+        `cache_expires`: filters needing another one return None, the caller
+        then loads and caches the whole table once and evaluates every later
+        filter against it. Queries, which only read matching items, always run.
+        """
+        if not self.filter_pushdown or self.refresher or self.region.get(self.cache_key) is not NO_VALUE:
+            return
+
+        predicate = parse_filter(search_filter)
+        if predicate is None:
+            return
+
+        key = '{cache_key}?{generation}:{search_filter}'.format(
+            cache_key=self.cache_key,
+            generation=self._generation,
+            search_filter=search_filter
+        )
+        rows = self.region.get(key)
+        if rows is not NO_VALUE:
+            return rows
+
+        index_name, key_conditions, filters = split_key_condition(predicate, self.get_key_schemas())
+        if not key_conditions:
+            scanned = '{cache_key}?scanned'.format(cache_key=self.cache_key)
+            if self.region.get(scanned) is not NO_VALUE:
+                return
+            self.region.set(scanned, True)
+
+        return self.region.get_or_create(key, lambda: self._get_by_predicate(index_name, key_conditions, filters))
+
+    def _get_by_predicate(self, index_name, key_conditions, filters):
+        expression = ExpressionAttributes()
+        kwargs = {}
+        if key_conditions:
+            kwargs['KeyConditionExpression'] = ' AND '.join(expression.render(c) for c in key_conditions)
+            if index_name:
+                kwargs['IndexName'] = index_name
+        if filters:
+            kwargs['FilterExpression'] = ' AND '.join(expression.render(f) for f in filters)
+        kwargs.update(expression.arguments())
+
+        logger.debug('Fetching filtered items. Table: {namespace} Index: {index} Request: {kwargs}'.format(
+            namespace=self.namespace,
+            index=index_name,
+            kwargs=kwargs
+        ))
+
+        if key_conditions:
+            rows = []
+            for page in self._iter_pages(operation='query', **kwargs):
+                rows += page
+            return rows
+
+        return self._scan(**kwargs)
+
+    def describe_table(self):
+        """Fetches the description of the table, empty if it can not be described."""
+        if self._description is None:
+            try:
+                self._description = self.table.meta.client.describe_table(TableName=self.table.name)['Table']
+            except ClientError as e:
+                logger.warning('Unable to describe table, filters are scanned and writes are not throttled. '
+                               'Table: {namespace} Error: {error}'.format(namespace=self.namespace, error=e))
+                self._description = {}
+
+        return self._description
+
+    def get_key_schemas(self):
+        """Fetches the keys of the table and of its global secondary indexes that project every attribute."""
+        if self._key_schemas is None:
+            table = self.describe_table()
+            types = dict((a['AttributeName'], a['AttributeType']) for a in table.get('AttributeDefinitions', []))
+
+            def keys(key_schema):
+                key_schema = sorted(key_schema, key=lambda k: k['KeyType'] != 'HASH')
+                return [(k['AttributeName'], types.get(k['AttributeName'])) for k in key_schema]
+
+            schemas = []
+            if table.get('KeySchema'):
+                schemas.append((None, keys(table['KeySchema'])))
+
+            for index in table.get('GlobalSecondaryIndexes', []):
+                if index['Projection']['ProjectionType'] == 'ALL' and index.get('IndexStatus', 'ACTIVE') == 'ACTIVE':
+                    schemas.append((index['IndexName'], keys(index['KeySchema'])))
+
+            self._key_schemas = schemas
+
+        return self._key_schemas
+
+    def _item_cache_key(self, key):
+        return '{cache_key}#{key}'.format(cache_key=self.cache_key, key=key)
+
+    def _forget(self, items):
+        self._forget_keys([item[self.key_attribute] for item in items])
+
+    def _forget_keys(self, keys):
+        """Drops cached items and filter results, so lookups see writes made through this backend."""
+        self.item_region.delete_multi([self._item_cache_key(key) for key in keys])
+        self._load.invalidate()
+        self._generation += 1
+
     def get_all(self):
         """Gets all items in file."""
+        if self.refresher:
+            return self.refresher.get()
+
+        return self.region.get_or_create(self.cache_key, self._load)
+
+    def iter_items(self):
+        """Yields items page by page as the table is scanned, without caching them."""
+        for page in self._iter_pages():
+            for item in page:
+                yield item
+
+    def invalidate(self):
+        """Drops cached items so the next call to get_all, or lookup by key, reloads them."""
+        self.region.invalidate()
+        self.region.delete(self.cache_key)
+        self.item_region.invalidate()
+        self._load.invalidate()
+
+        if self.refresher:
+            self.refresher.invalidate()
+
+    def _get_all(self):
         logger.debug('Fetching items. Table: {namespace}'.format(
             namespace=self.namespace
         ))
 
+        return self._scan()
+
+    def _scan(self, **kwargs):
+        if self.scan_segments > 1:
+            with ThreadPoolExecutor(max_workers=self.scan_segments) as executor:
+                scan = functools.partial(self._scan_segment, **kwargs)
+                segments = executor.map(scan, range(self.scan_segments))
+
+            # Segments are concatenated in order so the result does not depend on thread timing.
+            rows = []
+            for segment in segments:
+                rows += segment
+
+            return rows
+
+        return self._scan_segment(**kwargs)
+
+    def _scan_segment(self, segment=None, **kwargs):
+        """Pages through the whole table, or through one segment of a parallel scan."""
         rows = []
+        for page in self._iter_pages(segment, **kwargs):
+            rows += page
 
-        result = self.table.scan()
+        return rows
+
+    def _iter_pages(self, segment=None, operation='scan', **kwargs):
+        kwargs['TableName'] = self.table.name
+        if segment is not None:
+            kwargs.update(Segment=segment, TotalSegments=self.scan_segments)
+
+        # The low level client is thread safe, unlike the table resource.
+        request = getattr(self.table.meta.client, operation)
+
+        result = request(**kwargs)
 
         while True:
             next_token = result.get('LastEvaluatedKey', None)
-            rows += result['Items']
+            yield result['Items']
 
             if next_token:
-                result = self.table.scan(ExclusiveStartKey=next_token)
+                result = request(ExclusiveStartKey=next_token, **kwargs)
             else:
                 break
 
-        return rows
-
     def health_check(self):
         """Gets a single item to determine if Dynamo is functioning."""
         logger.debug('Health Check on Table: {namespace}'.format(
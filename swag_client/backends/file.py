@@ -1,13 +1,21 @@
 import os
-import sys
-import simplejson as json
+import hashlib
+import tempfile
+import threading
 import logging
+from contextlib import contextmanager
 from io import open
 
-from dogpile.cache import make_region
+from retrying import retry
 
-from swag_client.backend import SWAGManager
-from swag_client.util import append_item, remove_item
+from swag_client.backend import SWAGManager, one
+from swag_client.exceptions import InvalidSWAGDataException
+from swag_client.jsoncodec import get_codec
+from swag_client.singleflight import single_flight_loader
+from swag_client.snapshot import Snapshot, SnapshotReader, dump_snapshot, is_snapshot
+from swag_client.util import (
+    RefreshAheadCache, append_item, append_items, iter_json_items, make_cache_region, remove_item, remove_items
+)
 
 logger = logging.getLogger(__name__)
 
@@ -16,30 +24,167 @@ try:
 except ImportError:
     JSONDecodeError = ValueError
 
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+CHUNK_SIZE = 64 * 1024
+
+
+@retry(stop_max_attempt_number=3, wait_fixed=100, retry_on_exception=lambda e: isinstance(e, JSONDecodeError))
+def _read_file(data_file, codec):
+    with open(data_file, 'rb') as f:
+        data = f.read()
+
+    if not data.strip():
+        return []
+
+    return codec.loads(data)
+
 
-file_region = make_region()
+def load_file(data_file, codec=None):
+    """Tries to load data from data file, in either the JSON or the binary format.
 
+    An empty file is an empty inventory. A document that cannot be decoded is
+    most likely being rewritten in place by another writer, so it is re-read a
+    few times before giving up with an exception rather than handing back (and
+    caching) an empty inventory. JSON is decoded by `codec`, simplejson
+    unless another one is given.
+    """
+    if is_snapshot(data_file):
+        return Snapshot(data_file).load()
 
-def load_file(data_file):
-    """Tries to load JSON from data file."""
     try:
-        with open(data_file, 'r', encoding='utf-8') as f:
-            return json.loads(f.read())
+        return _read_file(data_file, codec or get_codec())
 
     except JSONDecodeError as e:
-        return []
+        raise InvalidSWAGDataException('Unable to decode data file. Path: {data_file} Error: {error}'.format(
+            data_file=data_file,
+            error=e
+        ))
 
 
-def save_file(data_file, data, dry_run=None):
-    """Writes JSON data to data file."""
+def iter_file(data_file):
+    """Iterates over the accounts in data file.
+
+    Accounts are decoded one at a time as the file is read.
+    """
+    if is_snapshot(data_file):
+        for account in Snapshot(data_file):
+            yield account
+        return
+
+    with open(data_file, 'r', encoding='utf-8') as f:
+        for account in iter_json_items(iter(lambda: f.read(CHUNK_SIZE), '')):
+            yield account
+
+
+def load_account(data_file, account_id):
+    """Loads a single account by id, the binary format only decodes that account."""
+    if is_snapshot(data_file):
+        return one(Snapshot(data_file).index.lookup('id', account_id))
+
+    return one([account for account in iter_file(data_file) if account.get('id') == account_id])
+
+
+def save_file(data_file, data, dry_run=None, file_format=None, codec=None, index_fields=None):
+    """Writes data to data file.
+
+    `file_format` is either `json` or `binary`, by default the format of the
+    existing file is kept. Binary files also index `index_fields`. The data
+    is streamed to a temporary file next to the data file (orjson and ujson
+    encode the whole document first), flushed to disk and then renamed over
+    it, so readers see either the old or the new document.
+    """
     if dry_run:
         return
 
-    with open(data_file, 'w', encoding='utf-8') as f:
-        if sys.version_info > (3, 0):
-            f.write(json.dumps(data))
+    if file_format is None:
+        file_format = 'binary' if is_snapshot(data_file) else 'json'
+
+    directory, name = os.path.split(os.path.abspath(data_file))
+    fd, temp_file = tempfile.mkstemp(dir=directory, prefix='.' + name + '.', suffix='.tmp')
+
+    try:
+        if file_format == 'binary':
+            with open(fd, 'wb') as f:
+                dump_snapshot(f, data, fields=index_fields)
+                f.flush()
+                os.fsync(f.fileno())
         else:
-            f.write(json.dumps(data).decode('utf-8'))
+            with open(fd, 'wb') as f:
+                (codec or get_codec()).dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+
+        if os.path.exists(data_file):
+            os.chmod(temp_file, os.stat(data_file).st_mode)
+        else:
+            os.chmod(temp_file, 0o644)
+
+        os.replace(temp_file, data_file)
+
+    except Exception:
+        os.unlink(temp_file)
+        raise
+
+    _fsync_directory(directory)
+
+
+def _fsync_directory(directory):
+    """Makes a rename durable by flushing the directory entry."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:  # pragma: no cover
+        return
+
+    try:
+        os.fsync(fd)
+    except OSError:  # pragma: no cover
+        pass
+    finally:
+        os.close(fd)
+
+
+def lock_path(data_file, lock_dir=None):
+    """Returns the path of the data file's lock file.
+
+    Lock files are never removed, deleting one while another writer waits on it
+    would let two writers in at once. Without a lock_dir it is kept next to the
+    data file as `<data_file>.lock`.
+    """
+    if not lock_dir:
+        return data_file + '.lock'
+
+    key = os.path.abspath(data_file).encode('utf-8')
+    return os.path.join(lock_dir, 'swag-' + hashlib.sha1(key).hexdigest() + '.lock')
+
+
+@contextmanager
+def lock_file(data_file, lock_dir=None):
+    """Holds an exclusive lock on the data file's lock file while it is modified."""
+    if fcntl is None:
+        yield
+        return
+
+    with open(lock_path(data_file, lock_dir), 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def update_file(data_file, mutate, dry_run=None, file_format=None, codec=None, index_fields=None, lock_dir=None):
+    """Applies mutate to the data file while holding its lock."""
+    if dry_run:
+        return mutate(load_file(data_file, codec=codec))
+
+    with lock_file(data_file, lock_dir):
+        data = mutate(load_file(data_file, codec=codec))
+        save_file(data_file, data, file_format=file_format, codec=codec, index_fields=index_fields)
+        return data
 
 
 class FileSWAGManager(SWAGManager):
@@ -47,24 +192,51 @@ class FileSWAGManager(SWAGManager):
         """Create a file based SWAG backend."""
         self.namespace = namespace
         self.version = kwargs['schema_version']
+        self.cache_mode = kwargs.get('cache_mode', 'ttl')
+        self.file_format = kwargs.get('file_format', 'json')
+        self.codec = get_codec(kwargs.get('json_codec'))
+        self.index_fields = kwargs.get('index_fields')
+        self.lock_dir = kwargs.get('lock_dir')
 
-        if not file_region.is_configured:
-            file_region.configure(
-                'dogpile.cache.memory',
-                expiration_time=kwargs['cache_expires']
-            )
+        self._data = None
+        self._stat_key = None
+        self._lock = threading.Lock()
 
         if not kwargs.get('data_file'):
             self.data_file = os.path.join(kwargs['data_dir'], self.namespace + '.json')
         else:
             self.data_file = kwargs['data_file']
 
+        self.cache_key = 'file:{path}'.format(path=os.path.abspath(self.data_file))
+        self.reader = SnapshotReader(self.data_file)
+        self.region = make_cache_region(kwargs['cache_expires'], kwargs.get('cache_size'))
+        self._load = single_flight_loader(self.cache_key, self._get_all, lock_dir=kwargs.get('single_flight_dir'),
+                                          max_age=kwargs['cache_expires'])
+
+        self.refresher = None
+        if kwargs.get('refresh_ahead'):
+            self.refresher = RefreshAheadCache(self._load, kwargs['cache_expires'], kwargs.get('max_staleness'))
+
         if not os.path.isfile(self.data_file):
             logger.warning(
                 'Backend file does not exist, creating... Path: {data_file}'.format(data_file=self.data_file)
             )
 
-            save_file(self.data_file, [])
+            save_file(self.data_file, [], file_format=self.file_format, codec=self.codec,
+                      index_fields=self.index_fields)
+
+    def _update_file(self, mutate, dry_run=None):
+        data = update_file(self.data_file, mutate, dry_run=dry_run, file_format=self.file_format, codec=self.codec,
+                           index_fields=self.index_fields, lock_dir=self.lock_dir)
+
+        if not dry_run:
+            self._load.invalidate()
+
+            # Coarse mtime resolution must not hide our own write.
+            with self._lock:
+                self._stat_key = None
+
+        return data
 
     def create(self, item, dry_run=None):
         """Creates a new item in file."""
@@ -73,9 +245,7 @@ class FileSWAGManager(SWAGManager):
             data_file=self.data_file
         ))
 
-        items = load_file(self.data_file)
-        items = append_item(self.namespace, self.version, item, items)
-        save_file(self.data_file, items, dry_run=dry_run)
+        self._update_file(lambda data: append_item(self.namespace, self.version, item, data), dry_run=dry_run)
 
         return item
 
@@ -86,9 +256,7 @@ class FileSWAGManager(SWAGManager):
             data_file=self.data_file
         ))
 
-        items = load_file(self.data_file)
-        items = remove_item(self.namespace, self.version, item, items)
-        save_file(self.data_file, items, dry_run=dry_run)
+        self._update_file(lambda data: remove_item(self.namespace, self.version, item, data), dry_run=dry_run)
 
         return item
 
@@ -98,18 +266,99 @@ class FileSWAGManager(SWAGManager):
             item=item,
             data_file=self.data_file
         ))
-        self.delete(item, dry_run=dry_run)
-        return self.create(item, dry_run=dry_run)
 
-    @file_region.cache_on_arguments()
+        return self.update_many([item], dry_run=dry_run)[0]
+
+    def create_many(self, items, dry_run=None):
+        """Creates several new items in file with a single write."""
+        logger.debug('Creating {number_items} new items. Path: {data_file}'.format(
+            number_items=len(items),
+            data_file=self.data_file
+        ))
+
+        self._update_file(lambda data: append_items(self.namespace, self.version, items, data), dry_run=dry_run)
+
+        return items
+
+    def delete_many(self, items, dry_run=None):
+        """Deletes several items in file with a single write."""
+        logger.debug('Deleting {number_items} items. Path: {data_file}'.format(
+            number_items=len(items),
+            data_file=self.data_file
+        ))
+
+        self._update_file(lambda data: remove_items(self.namespace, self.version, items, data), dry_run=dry_run)
+
+        return items
+
+    def update_many(self, items, dry_run=None):
+        """Updates several items in file with a single write."""
+        logger.debug('Updating {number_items} items. Path: {data_file}'.format(
+            number_items=len(items),
+            data_file=self.data_file
+        ))
+
+        def mutate(data):
+            data = remove_items(self.namespace, self.version, items, data)
+            return append_items(self.namespace, self.version, items, data)
+
+        self._update_file(mutate, dry_run=dry_run)
+
+        return items
+
     def get_all(self):
         """Gets all items in file."""
+        if self.cache_mode == 'stat':
+            return self._get_all_if_modified()
+
+        if self.refresher:
+            return self.refresher.get()
+
+        return self.region.get_or_create(self.cache_key, self._load)
+
+    def iter_items(self):
+        """Iterates over the items in file without caching them."""
+        return iter_file(self.data_file)
+
+    def get_index(self):
+        """Fetches the index stored in a binary data file, lookups then only decode matching accounts."""
+        if self.file_format == 'binary' and is_snapshot(self.data_file):
+            return self.reader.get().index
+
+    def invalidate(self):
+        """Drops cached items so the next call to get_all reloads them."""
+        self.region.delete(self.cache_key)
+        self._load.invalidate()
+
+        if self.refresher:
+            self.refresher.invalidate()
+
+        with self._lock:
+            self._stat_key = None
+
+    def _get_all(self):
         logger.debug('Fetching items. Path: {data_file}'.format(
             data_file=self.data_file
         ))
 
-        return load_file(self.data_file)
+        return load_file(self.data_file, codec=self.codec)
+
+    def _get_all_if_modified(self):
+        """Reloads the file only when its modification time, size or inode changed."""
+        stat = os.stat(self.data_file)
+        stat_key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+        with self._lock:
+            if stat_key != self._stat_key:
+                logger.debug('Fetching items. Path: {data_file}'.format(
+                    data_file=self.data_file
+                ))
+
+                # The file is stat'ed before it is read, a change in between only causes one extra reload.
+                self._data = load_file(self.data_file, codec=self.codec)
+                self._stat_key = stat_key
 
+            return self._data
 
     def health_check(self):
         """Checks to make sure the file is there."""
@@ -1,15 +1,20 @@
-import sys
-import simplejson as json
+import random
+import time
+import zlib
 import logging
+from collections import OrderedDict
 
 import boto3
 from botocore.exceptions import ClientError
 from retrying import retry
 
-from dogpile.cache import make_region
-
 from swag_client.backend import SWAGManager
-from swag_client.util import append_item, remove_item
+from swag_client.exceptions import SWAGException
+from swag_client.jsoncodec import get_codec
+from swag_client.singleflight import single_flight_loader
+from swag_client.util import (
+    RefreshAheadCache, append_item, append_items, iter_json_items, make_cache_region, remove_item, remove_items
+)
 
 logger = logging.getLogger(__name__)
 
@@ -18,22 +23,130 @@ try:
 except ImportError:
     JSONDecodeError = ValueError
 
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+
+
+CHUNK_SIZE = 64 * 1024
+NOT_MODIFIED = ('304', 'NotModified')
+CONFLICTS = ('PreconditionFailed', 'ConditionalRequestConflict')
+GENERATION = 'swag-generation'
+DELTA_READ_ATTEMPTS = 3
+
+
+def _is_retryable(exception):
+    """Conditional misses, write conflicts and missing keys are answers from S3, not transient failures."""
+    if isinstance(exception, ClientError):
+        return exception.response['Error']['Code'] not in NOT_MODIFIED + CONFLICTS + ('NoSuchKey',)
+    return True
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise SWAGException('zstd compression requires the zstandard package. Install: pip install swag-client[zstd]')
+
+
+def compress(body, compression=None):
+    """Compresses an object body, returns it with the matching Content-Encoding."""
+    if not compression or compression == 'none':
+        return body, None
+
+    if compression == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush(), 'gzip'
+
+    if compression == 'zstd':
+        _require_zstandard()
+        return zstandard.ZstdCompressor().compress(body), 'zstd'
+
+    raise SWAGException('Compression is not supported. Compression: {}'.format(compression))
+
+
+def _decompressor(content_encoding):
+    encodings = [e.strip() for e in (content_encoding or '').split(',')]
+    encodings = [e for e in encodings if e and e not in ('identity', 'aws-chunked')]
+
+    if not encodings:
+        return None
+
+    if encodings == ['gzip']:
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    if encodings == ['zstd']:
+        _require_zstandard()
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    raise SWAGException('Content encoding is not supported. Encoding: {}'.format(content_encoding))
+
+
+def decompress(body, content_encoding=None):
+    """Decompresses a whole object body according to its Content-Encoding."""
+    decompressor = _decompressor(content_encoding)
+    if not decompressor:
+        return body
+
+    return decompressor.decompress(body) + decompressor.flush()
 
-s3_region = make_region()
 
+def iter_body(response):
+    """Yields the chunks of an object body, decompressing them as they are downloaded."""
+    decompressor = _decompressor(response.get('ContentEncoding'))
 
-@retry(stop_max_attempt_number=3, wait_exponential_multiplier=1000, wait_exponential_max=10000)
+    for chunk in response['Body'].iter_chunks(CHUNK_SIZE):
+        yield decompressor.decompress(chunk) if decompressor else chunk
+
+    if decompressor:
+        yield decompressor.flush()
+
+
+def read_body(response):
+    """Reads a whole object body, only the decompressed document is held in memory."""
+    return b''.join(iter_body(response))
+
+
+@retry(stop_max_attempt_number=3, wait_exponential_multiplier=1000, wait_exponential_max=10000,
+       retry_on_exception=_is_retryable)
 def _get_from_s3(client, bucket, data_file):
-    return client.get_object(Bucket=bucket, Key=data_file)['Body'].read()
+    return read_body(client.get_object(Bucket=bucket, Key=data_file))
+
 
+@retry(stop_max_attempt_number=3, wait_exponential_multiplier=1000, wait_exponential_max=10000,
+       retry_on_exception=_is_retryable)
+def _get_from_s3_if_modified(client, bucket, data_file, etag=None, last_modified=None):
+    kwargs = {}
+    if etag:
+        kwargs['IfNoneMatch'] = etag
+    elif last_modified:
+        kwargs['IfModifiedSince'] = last_modified
+
+    response = client.get_object(Bucket=bucket, Key=data_file, **kwargs)
+    return read_body(response), response.get('ETag'), response.get('LastModified'), get_generation(response)
+
+
+@retry(stop_max_attempt_number=3, wait_exponential_multiplier=1000, wait_exponential_max=10000,
+       retry_on_exception=_is_retryable)
+def _put_to_s3(client, bucket, data_file, body, compression=None, **kwargs):
+    body, content_encoding = compress(body, compression)
+    if content_encoding:
+        kwargs['ContentEncoding'] = content_encoding
 
-@retry(stop_max_attempt_number=3, wait_exponential_multiplier=1000, wait_exponential_max=10000)
-def _put_to_s3(client, bucket, data_file, body):
     return client.put_object(Bucket=bucket, Key=data_file, Body=body, ContentType='application/json',
-                             CacheControl='no-cache, no-store, must-revalidate')
+                             CacheControl='no-cache, no-store, must-revalidate', **kwargs)
+
+
+def _parse(data, codec=None):
+    return (codec or get_codec()).loads(data)
+
 
+def get_generation(response):
+    """Reads the last delta folded into a base object from its metadata."""
+    return int(response.get('Metadata', {}).get(GENERATION, 0))
 
-def load_file(client, bucket, data_file):
+
+def load_file(client, bucket, data_file, codec=None):
     """Tries to load JSON data from S3."""
     logger.debug('Loading item from s3. Bucket: {bucket} Key: {key}'.format(
         bucket=bucket,
@@ -51,22 +164,388 @@ def load_file(client, bucket, data_file):
         else:
             raise ce
 
-    if sys.version_info > (3,):
-        data = data.decode('utf-8')
+    return _parse(data, codec)
+
+
+def iter_file(client, bucket, data_file):
+    """Streams JSON items from S3, decoding them as they are downloaded."""
+    logger.debug('Streaming items from s3. Bucket: {bucket} Key: {key}'.format(
+        bucket=bucket,
+        key=data_file
+    ))
+
+    try:
+        response = client.get_object(Bucket=bucket, Key=data_file)
+
+    except ClientError as ce:
+        if ce.response['Error']['Code'] == 'NoSuchKey':
+            return
 
-    return json.loads(data)
+        raise ce
 
+    for item in iter_json_items(iter_body(response)):
+        yield item
 
-def save_file(client, bucket, data_file, items, dry_run=None):
-    """Tries to write JSON data to data file in S3."""
+
+def load_file_if_modified(client, bucket, data_file, etag=None, last_modified=None, codec=None):
+    """Tries to load JSON data from S3 unless it still matches the given ETag (or modification time).
+
+    Returns a `(data, etag, last_modified)` tuple, data is None when the object has not changed.
+    """
+    return _load_if_modified(client, bucket, data_file, etag=etag, last_modified=last_modified, codec=codec)[:3]
+
+
+def load_base_if_modified(client, bucket, data_file, etag=None, codec=None):
+    """Like load_file_if_modified, for the base object of a delta log.
+
+    Returns a `(data, etag, generation)` tuple, generation is the last delta
+    folded into the base.
+    """
+    data, etag, _, generation = _load_if_modified(client, bucket, data_file, etag=etag, codec=codec)
+    return data, etag, generation
+
+
+def _load_if_modified(client, bucket, data_file, etag=None, last_modified=None, codec=None):
+    logger.debug('Revalidating item from s3. Bucket: {bucket} Key: {key} ETag: {etag}'.format(
+        bucket=bucket,
+        key=data_file,
+        etag=etag
+    ))
+
+    try:
+        data, etag, last_modified, generation = _get_from_s3_if_modified(client, bucket, data_file, etag=etag,
+                                                                         last_modified=last_modified)
+
+    except ClientError as ce:
+        if ce.response['Error']['Code'] in NOT_MODIFIED:
+            return None, etag, last_modified, None
+
+        if ce.response['Error']['Code'] == 'NoSuchKey':
+            return {}, None, None, 0
+
+        raise ce
+
+    return _parse(data, codec), etag, last_modified, generation
+
+
+def save_file(client, bucket, data_file, items, dry_run=None, etag=None, create=False, codec=None, compression=None,
+              metadata=None):
+    """Tries to write JSON data to data file in S3.
+
+    When an ETag is given the write only succeeds if the object still has it,
+    with create the write only succeeds if the object does not exist yet.
+    With compression (`gzip` or `zstd`) the body is stored compressed and
+    tagged with its Content-Encoding, readers decompress it transparently.
+    """
     logger.debug('Writing {number_items} items to s3. Bucket: {bucket} Key: {key}'.format(
         number_items=len(items),
         bucket=bucket,
         key=data_file
     ))
 
+    kwargs = {}
+    if etag:
+        kwargs['IfMatch'] = etag
+    elif create:
+        kwargs['IfNoneMatch'] = '*'
+
+    if metadata:
+        kwargs['Metadata'] = metadata
+
     if not dry_run:
-        return _put_to_s3(client, bucket, data_file, json.dumps(items))
+        return _put_to_s3(client, bucket, data_file, (codec or get_codec()).dumps(items), compression=compression,
+                          **kwargs)
+
+
+def update_file(client, bucket, data_file, mutate, dry_run=None, max_attempts=5, codec=None, compression=None):
+    """Applies mutate to the data stored in S3 with compare-and-swap semantics.
+
+    The write is conditional on the object being unchanged since it was read,
+    when another writer got there first the data is reloaded and mutate is
+    applied again.
+    """
+    for attempt in range(max_attempts):
+        data, etag, _ = load_file_if_modified(client, bucket, data_file, codec=codec)
+        data = mutate(data)
+
+        try:
+            save_file(client, bucket, data_file, data, dry_run=dry_run, etag=etag, create=etag is None, codec=codec,
+                      compression=compression)
+            return data
+
+        except ClientError as ce:
+            if ce.response['Error']['Code'] not in CONFLICTS:
+                raise ce
+
+        logger.debug('Conflicting write, retrying. Bucket: {bucket} Key: {key} Attempt: {attempt}'.format(
+            bucket=bucket,
+            key=data_file,
+            attempt=attempt + 1
+        ))
+        time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+
+    raise SWAGException('Unable to write to s3 after {attempts} conflicting attempts. Bucket: {bucket} Key: {key}'.format(
+        attempts=max_attempts,
+        bucket=bucket,
+        key=data_file
+    ))
+
+
+def delta_key(prefix, sequence):
+    """Builds the key of a delta, zero padded so keys list in sequence order."""
+    return '{prefix}{sequence:020d}.json'.format(prefix=prefix, sequence=sequence)
+
+
+def delta_sequence(prefix, key):
+    """Reads the sequence number of a delta from its key, None for other keys under the prefix."""
+    name = key[len(prefix):]
+    if name.endswith('.json') and name[:-5].isdigit():
+        return int(name[:-5])
+
+
+def follows(deltas, after):
+    """Tells whether `(sequence, key)` deltas directly follow a generation, without gaps."""
+    return [sequence for sequence, _ in deltas] == list(range(after + 1, after + 1 + len(deltas)))
+
+
+def delta_listing(bucket, prefix, after=0):
+    """Builds the list_objects_v2 arguments that list the deltas newer than a generation."""
+    return {'Bucket': bucket, 'Prefix': prefix, 'StartAfter': delta_key(prefix, after)}
+
+
+def collect_deltas(prefix, pages):
+    """Collects `(sequence, key)` of the deltas in list_objects_v2 pages, in order."""
+    deltas = []
+
+    for page in pages:
+        for obj in page.get('Contents', []):
+            sequence = delta_sequence(prefix, obj['Key'])
+            if sequence is not None:
+                deltas.append((sequence, obj['Key']))
+
+    return sorted(deltas)
+
+
+def delta_log_changed(bucket, prefix):
+    """Builds the error raised when deltas keep being compacted away while they are read."""
+    return SWAGException('Delta log kept changing while reading it. Bucket: {bucket} Prefix: {prefix}'.format(
+        bucket=bucket,
+        prefix=prefix
+    ))
+
+
+def list_deltas(client, bucket, prefix, after=0):
+    """Lists `(sequence, key)` of the deltas newer than a generation, in order."""
+    paginator = client.get_paginator('list_objects_v2')
+    return collect_deltas(prefix, paginator.paginate(**delta_listing(bucket, prefix, after)))
+
+
+def load_deltas(client, bucket, prefix, after=0, codec=None):
+    """Loads the deltas newer than a generation.
+
+    Returns None when the deltas do not directly follow the generation,
+    which happens when a compactor removed them after the base was read.
+    """
+    deltas = list_deltas(client, bucket, prefix, after=after)
+
+    if not follows(deltas, after):
+        return None
+
+    return [_parse(_get_from_s3(client, bucket, key), codec) for _, key in deltas]
+
+
+def apply_delta(namespace, version, data, delta):
+    """Applies a delta to a document, upserted items replace any item with the same id."""
+    ids = [item['id'] for item in delta['upsert']] + delta['delete']
+    data = remove_items(namespace, version, [{'id': i} for i in ids], data)
+    return append_items(namespace, version, delta['upsert'], data)
+
+
+class DeltaLog(object):
+    """Keeps a base object up to date with its delta log.
+
+    The S3 backend and its asyncio front end read with their own clients and
+    drive the same steps, up to `DELTA_READ_ATTEMPTS` times:
+
+    1. `set_base` with the base object, loaded if it changed since `etag`.
+    2. `follow` with the pages listing `listing()`, it returns the keys of the
+       deltas to download, or None when they were compacted away after the
+       base was read and the base has to be loaded again.
+    3. `apply` with the downloaded deltas, which returns the document.
+
+    When every attempt raced a compaction, `changed()` is the error to raise.
+    """
+    def __init__(self, bucket, prefix, namespace, version):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.namespace = namespace
+        self.version = version
+        self.data = None
+        self.etag = None
+        self.generation = 0
+
+    def set_base(self, data, etag, generation):
+        """Keeps a base object, data of None means it was not modified."""
+        if data is not None:
+            self.data, self.etag, self.generation = data, etag, generation
+
+    def listing(self):
+        return delta_listing(self.bucket, self.prefix, self.generation)
+
+    def follow(self, pages):
+        """Returns the keys of the listed deltas newer than the base, None if some are missing."""
+        deltas = collect_deltas(self.prefix, pages)
+
+        if not follows(deltas, self.generation):
+            # The deltas we need were compacted away after the base was read.
+            self.etag = None
+            return None
+
+        return [key for _, key in deltas]
+
+    def apply(self, deltas):
+        data = self.data
+        for delta in deltas:
+            data = apply_delta(self.namespace, self.version, data, delta)
+
+        self.data, self.generation = data, self.generation + len(deltas)
+        return data
+
+    def changed(self):
+        return delta_log_changed(self.bucket, self.prefix)
+
+
+def head_generation(client, bucket, data_file):
+    """Reads the generation of a base object without downloading it, 0 when there is no base yet."""
+    try:
+        return get_generation(client.head_object(Bucket=bucket, Key=data_file))
+    except ClientError as ce:
+        if ce.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+            raise ce
+        return 0
+
+
+def put_delta(client, bucket, data_file, prefix, upsert=(), delete=(), codec=None, compression=None, max_attempts=5):
+    """Appends a change to the delta log of a base object.
+
+    The next sequence number is claimed with a conditional write, writers
+    that lose the race pick the following number. Returns the sequence and
+    the generation of the base object at the time of the write.
+
+    Between choosing a sequence and claiming it, another writer may claim it
+    and a compactor may fold and delete that delta, freeing its key again. A
+    delta written there would be older than the base and ignored, so the base
+    is read again after the write and the change retried under a new sequence
+    when the base already covers it.
+    """
+    delta = {'upsert': list(upsert), 'delete': list(delete)}
+
+    for attempt in range(max_attempts):
+        # Deltas are listed before the base is read: a compactor writes the new base before deleting
+        # the deltas it folded, so one of the two always reveals the latest sequence.
+        deltas = list_deltas(client, bucket, prefix)
+        base_generation = head_generation(client, bucket, data_file)
+
+        sequence = max([base_generation] + [sequence for sequence, _ in deltas]) + 1
+        delta['sequence'] = sequence
+
+        try:
+            _put_to_s3(client, bucket, delta_key(prefix, sequence), (codec or get_codec()).dumps(delta),
+                       compression=compression, IfNoneMatch='*')
+
+            # Re-applying a change a compactor did fold is harmless, losing it is not.
+            if head_generation(client, bucket, data_file) < sequence:
+                return sequence, base_generation
+
+            logger.debug('Delta written behind a compaction, retrying. Bucket: {bucket} Prefix: {prefix} '
+                         'Sequence: {sequence}'.format(bucket=bucket, prefix=prefix, sequence=sequence))
+
+        except ClientError as ce:
+            if ce.response['Error']['Code'] not in CONFLICTS:
+                raise ce
+
+            logger.debug('Delta sequence taken, retrying. Bucket: {bucket} Prefix: {prefix} '
+                         'Sequence: {sequence}'.format(bucket=bucket, prefix=prefix, sequence=sequence))
+
+        time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+
+    raise SWAGException('Unable to append to the delta log after {attempts} conflicting attempts. Bucket: {bucket} '
+                        'Prefix: {prefix}'.format(attempts=max_attempts, bucket=bucket, prefix=prefix))
+
+
+def compact(client, bucket, data_file, prefix, namespace, version, codec=None, compression=None):
+    """Folds the delta log into a new base object and removes the folded deltas.
+
+    Returns the generation of the new base. The base is replaced with a
+    conditional write, a concurrent compaction makes this one fail.
+    """
+    data, etag, generation = load_base_if_modified(client, bucket, data_file, codec=codec)
+    deltas = list_deltas(client, bucket, prefix)
+    pending = [(sequence, key) for sequence, key in deltas if sequence > generation]
+
+    if pending:
+        if not follows(pending, generation):
+            raise SWAGException('Delta log has gaps, refusing to compact. Bucket: {bucket} Prefix: {prefix}'.format(
+                bucket=bucket,
+                prefix=prefix
+            ))
+
+        for _, key in pending:
+            data = apply_delta(namespace, version, data, _parse(_get_from_s3(client, bucket, key), codec))
+
+        generation = pending[-1][0]
+        save_file(client, bucket, data_file, data, etag=etag, create=etag is None, codec=codec,
+                  compression=compression, metadata={GENERATION: str(generation)})
+
+        logger.info('Compacted {number_deltas} deltas. Bucket: {bucket} Key: {key} Generation: {generation}'.format(
+            number_deltas=len(pending),
+            bucket=bucket,
+            key=data_file,
+            generation=generation
+        ))
+
+    folded = [{'Key': key} for sequence, key in deltas if sequence <= generation]
+    for i in range(0, len(folded), 1000):
+        client.delete_objects(Bucket=bucket, Delete={'Objects': folded[i:i + 1000], 'Quiet': True})
+
+    return generation
+
+
+def iter_file_with_deltas(client, bucket, data_file, prefix, codec=None):
+    """Streams the items of a base object with its newer deltas applied."""
+    for attempt in range(DELTA_READ_ATTEMPTS):
+        try:
+            response = client.get_object(Bucket=bucket, Key=data_file)
+        except ClientError as ce:
+            if ce.response['Error']['Code'] != 'NoSuchKey':
+                raise ce
+            response = None
+
+        deltas = load_deltas(client, bucket, prefix, after=get_generation(response) if response else 0, codec=codec)
+        if deltas is not None:
+            break
+
+        if response:
+            response['Body'].close()
+    else:
+        raise delta_log_changed(bucket, prefix)
+
+    touched = set()
+    upserts = OrderedDict()
+    for delta in deltas:
+        for item_id in [item['id'] for item in delta['upsert']] + delta['delete']:
+            touched.add(item_id)
+            upserts.pop(item_id, None)
+        for item in delta['upsert']:
+            upserts[item['id']] = item
+
+    if response:
+        for item in iter_json_items(iter_body(response)):
+            if item['id'] not in touched:
+                yield item
+
+    for item in upserts.values():
+        yield item
 
 
 class S3SWAGManager(SWAGManager):
@@ -82,12 +561,65 @@ class S3SWAGManager(SWAGManager):
 
         self.bucket_name = kwargs['bucket_name']
         self.client = boto3.client('s3', region_name=kwargs['region'])
-
-        if not s3_region.is_configured:
-            s3_region.configure(
-                'dogpile.cache.memory',
-                expiration_time=kwargs['cache_expires']
-            )
+        self.codec = get_codec(kwargs.get('json_codec'))
+        self.compression = kwargs.get('compression', 'none')
+        self.write_mode = kwargs.get('write_mode', 'document')
+        self.delta_prefix = kwargs.get('delta_prefix') or self.data_file + '.deltas/'
+        self.compact_threshold = kwargs.get('compact_threshold', 0)
+
+        self._data = None
+        self._etag = None
+        self._last_modified = None
+        self._deltas = DeltaLog(self.bucket_name, self.delta_prefix, self.namespace, self.version)
+
+        self.cache_key = 's3:{bucket}/{key}'.format(bucket=self.bucket_name, key=self.data_file)
+        self.region = make_cache_region(kwargs['cache_expires'], kwargs.get('cache_size'))
+        self._load = single_flight_loader(self.cache_key, self._get_all, lock_dir=kwargs.get('single_flight_dir'),
+                                          max_age=kwargs['cache_expires'])
+
+        self.refresher = None
+        if kwargs.get('refresh_ahead'):
+            self.refresher = RefreshAheadCache(self._load, kwargs['cache_expires'], kwargs.get('max_staleness'))
+
+    def _update_file(self, mutate, dry_run=None):
+        data = update_file(self.client, self.bucket_name, self.data_file, mutate, dry_run=dry_run, codec=self.codec,
+                           compression=self.compression)
+
+        if not dry_run:
+            self._load.invalidate()
+
+        return data
+
+    def _write(self, mutate, upsert=(), delete=(), dry_run=None):
+        """Rewrites the document, or appends the change to the delta log in delta mode."""
+        if self.write_mode != 'delta':
+            return self._update_file(mutate, dry_run=dry_run)
+
+        if dry_run:
+            return
+
+        sequence, base_generation = put_delta(self.client, self.bucket_name, self.data_file, self.delta_prefix,
+                                              upsert=upsert, delete=delete, codec=self.codec,
+                                              compression=self.compression)
+        self._load.invalidate()
+
+        if self.compact_threshold and sequence - base_generation >= self.compact_threshold:
+            try:
+                self.compact()
+            except ClientError as ce:
+                if ce.response['Error']['Code'] not in CONFLICTS:
+                    raise ce
+
+                # The delta is committed, another writer compacted the log first.
+                logger.info('Compaction lost to a concurrent compactor. Bucket: {bucket} Key: {key}'.format(
+                    bucket=self.bucket_name,
+                    key=self.data_file
+                ))
+
+    def compact(self):
+        """Folds the delta log into the base object, returns its new generation."""
+        return compact(self.client, self.bucket_name, self.data_file, self.delta_prefix, self.namespace, self.version,
+                       codec=self.codec, compression=self.compression)
 
     def create(self, item, dry_run=None):
         """Creates a new item in file."""
@@ -96,9 +628,7 @@ class S3SWAGManager(SWAGManager):
             data_file=self.data_file
         ))
 
-        items = load_file(self.client, self.bucket_name, self.data_file)
-        items = append_item(self.namespace, self.version, item, items)
-        save_file(self.client, self.bucket_name, self.data_file, items, dry_run=dry_run)
+        self._write(lambda data: append_item(self.namespace, self.version, item, data), upsert=[item], dry_run=dry_run)
 
         return item
 
@@ -109,9 +639,8 @@ class S3SWAGManager(SWAGManager):
             data_file=self.data_file
         ))
 
-        items = load_file(self.client, self.bucket_name, self.data_file)
-        items = remove_item(self.namespace, self.version, item, items)
-        save_file(self.client, self.bucket_name, self.data_file, items, dry_run=dry_run)
+        self._write(lambda data: remove_item(self.namespace, self.version, item, data), delete=[item['id']],
+                    dry_run=dry_run)
 
     def update(self, item, dry_run=None):
         """Updates item info in file."""
@@ -119,17 +648,111 @@ class S3SWAGManager(SWAGManager):
             item=item,
             data_file=self.data_file
         ))
-        self.delete(item, dry_run=dry_run)
-        return self.create(item, dry_run=dry_run)
 
-    @s3_region.cache_on_arguments()
+        return self.update_many([item], dry_run=dry_run)[0]
+
+    def create_many(self, items, dry_run=None):
+        """Creates several new items in file with a single write."""
+        logger.debug('Creating {number_items} new items. Path: {data_file}'.format(
+            number_items=len(items),
+            data_file=self.data_file
+        ))
+
+        self._write(lambda data: append_items(self.namespace, self.version, items, data), upsert=items, dry_run=dry_run)
+
+        return items
+
+    def delete_many(self, items, dry_run=None):
+        """Deletes several items in file with a single write."""
+        logger.debug('Deleting {number_items} items. Path: {data_file}'.format(
+            number_items=len(items),
+            data_file=self.data_file
+        ))
+
+        self._write(lambda data: remove_items(self.namespace, self.version, items, data),
+                    delete=[item['id'] for item in items], dry_run=dry_run)
+
+        return items
+
+    def update_many(self, items, dry_run=None):
+        """Updates several items in file with a single write."""
+        logger.debug('Updating {number_items} items. Path: {data_file}'.format(
+            number_items=len(items),
+            data_file=self.data_file
+        ))
+
+        def mutate(data):
+            data = remove_items(self.namespace, self.version, items, data)
+            return append_items(self.namespace, self.version, items, data)
+
+        self._write(mutate, upsert=items, dry_run=dry_run)
+
+        return items
+
     def get_all(self):
-        """Gets all items in file."""
+        """Gets all items in file.
+
+        Once the cache expires the object is revalidated against its ETag, when
+        S3 reports it unchanged the previously parsed data is cached again
+        without downloading or parsing the body.
+        """
+        if self.refresher:
+            return self.refresher.get()
+
+        return self.region.get_or_create(self.cache_key, self._load)
+
+    def iter_items(self):
+        """Streams items from S3 as they are downloaded, without caching them."""
+        if self.write_mode == 'delta':
+            return iter_file_with_deltas(self.client, self.bucket_name, self.data_file, self.delta_prefix,
+                                         codec=self.codec)
+
+        return iter_file(self.client, self.bucket_name, self.data_file)
+
+    def invalidate(self):
+        """Drops cached items so the next call to get_all reloads them."""
+        self.region.delete(self.cache_key)
+        self._load.invalidate()
+
+        if self.refresher:
+            self.refresher.invalidate()
+
+    def _get_all(self):
         logger.debug('Fetching items. Path: {data_file}'.format(
             data_file=self.data_file
         ))
 
-        return load_file(self.client, self.bucket_name, self.data_file)
+        if self.write_mode == 'delta':
+            return self._get_all_with_deltas()
+
+        data, etag, last_modified = load_file_if_modified(self.client, self.bucket_name, self.data_file,
+                                                          etag=self._etag, last_modified=self._last_modified,
+                                                          codec=self.codec)
+
+        if data is None:
+            logger.debug('Items not modified. Path: {data_file} ETag: {etag}'.format(
+                data_file=self.data_file,
+                etag=etag
+            ))
+            return self._data
+
+        self._data, self._etag, self._last_modified = data, etag, last_modified
+        return data
+
+    def _get_all_with_deltas(self):
+        """Revalidates the base object and applies only the deltas newer than the generation already held."""
+        log = self._deltas
+        paginator = self.client.get_paginator('list_objects_v2')
+
+        for attempt in range(DELTA_READ_ATTEMPTS):
+            log.set_base(*load_base_if_modified(self.client, self.bucket_name, self.data_file, etag=log.etag,
+                                                codec=self.codec))
+
+            keys = log.follow(paginator.paginate(**log.listing()))
+            if keys is not None:
+                return log.apply([_parse(_get_from_s3(self.client, self.bucket_name, key), self.codec) for key in keys])
+
+        raise log.changed()
 
     def health_check(self):
         """Uses head object to make sure the file exists in S3."""
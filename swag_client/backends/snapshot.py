@@ -0,0 +1,61 @@
+import os
+import threading
+import logging
+
+from swag_client.backend import SWAGManager
+from swag_client.exceptions import SWAGException
+from swag_client.snapshot import SnapshotReader
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotSWAGManager(SWAGManager):
+    def __init__(self, namespace, **kwargs):
+        """Create a read-only SWAG backend over a published snapshot file."""
+        self.namespace = namespace
+        self.version = kwargs['schema_version']
+        self.snapshot_path = kwargs['snapshot_path']
+
+        self.reader = SnapshotReader(self.snapshot_path)
+        self._data = None
+        self._lock = threading.Lock()
+
+    def get_snapshot(self):
+        """Maps the current generation of the snapshot, remapping it once a new one is published."""
+        return self.reader.get()
+
+    def get_index(self):
+        """Fetches the lookup index stored in the current snapshot."""
+        return self.get_snapshot().index
+
+    def get_all(self):
+        """Gets all items in the snapshot, they are decoded once per generation."""
+        snapshot = self.get_snapshot()
+
+        with self._lock:
+            if self._data is None or self._data[0] is not snapshot:
+                self._data = (snapshot, snapshot.load())
+            return self._data[1]
+
+    def iter_items(self):
+        """Iterates over the items in the snapshot, decoding one at a time."""
+        return iter(self.get_snapshot())
+
+    def invalidate(self):
+        """Drops decoded items so the next call to get_all decodes them again."""
+        with self._lock:
+            self._data = None
+
+    def _read_only(self, *args, **kwargs):
+        raise SWAGException('The snapshot backend is read only, write to the backend the snapshot is published from.')
+
+    create = delete = update = _read_only
+    create_many = delete_many = update_many = _read_only
+
+    def health_check(self):
+        """Checks to make sure the snapshot is there."""
+        logger.debug('Health Check on snapshot for: {namespace}'.format(
+            namespace=self.namespace
+        ))
+
+        return os.path.isfile(self.snapshot_path)
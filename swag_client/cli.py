@@ -1,7 +1,6 @@
 import logging
 import os
 import time
-import simplejson as json
 
 import boto3
 import click
@@ -9,8 +8,11 @@ import click_log
 from tabulate import tabulate
 
 from swag_client.backend import SWAGManager
+from swag_client.backends.file import load_file, save_file
 from swag_client.__about__ import __version__
+from swag_client.jsoncodec import get_codec
 from swag_client.migrations import run_migration
+from swag_client.snapshot import publish_snapshot
 from swag_client.util import parse_swag_config_options
 from swag_client.exceptions import InvalidSWAGDataException
 
@@ -47,6 +49,7 @@ def create_swag_from_ctx(ctx):
             'swag.type': 'dynamodb',
             'swag.region': ctx.region
         }
+    swag_opts['swag.json_codec'] = ctx.json_codec
     return SWAGManager(**parse_swag_config_options(swag_opts))
 
 
@@ -59,6 +62,7 @@ class AppContext(object):
         self.data_file = None
         self.bucket_name = None
         self.dry_run = None
+        self.json_codec = None
 
 
 pass_context = click.make_pass_decorator(AppContext, ensure=True)
@@ -67,16 +71,21 @@ pass_context = click.make_pass_decorator(AppContext, ensure=True)
 @click.group()
 @click.option('--namespace', default='accounts')
 @click.option('--dry-run', type=bool, default=False, is_flag=True, help='Run command without persisting anything.')
+@click.option('--json-codec', type=click.Choice(['simplejson', 'json', 'orjson', 'ujson']), default='simplejson',
+              help='Library used to load and dump JSON data.')
 @click_log.simple_verbosity_option(log)
 @click.version_option(version=__version__)
 @pass_context
-def cli(ctx, namespace, dry_run):
+def cli(ctx, namespace, dry_run, json_codec):
     if not ctx.namespace:
         ctx.namespace = namespace
 
     if not ctx.dry_run:
         ctx.dry_run = dry_run
 
+    if not ctx.json_codec:
+        ctx.json_codec = json_codec
+
 
 @cli.group()
 @click.option('--region', default='us-east-1', help='Region the table is located in.')
@@ -94,7 +103,7 @@ def dynamodb(ctx, region):
 @pass_context
 def file(ctx, data_dir, data_file):
     """Use the File SWAG Backend"""
-    if not ctx.file:
+    if not ctx.data_file:
         ctx.data_file = data_file
 
     if not ctx.data_dir:
@@ -164,20 +173,51 @@ def migrate(ctx, start_version, end_version):
         if ctx.data_file:
             file_path = ctx.data_file
         else:
-            file_path = os.path.join(ctx.data_file, ctx.namespace + '.json')
+            file_path = os.path.join(ctx.data_dir, ctx.namespace + '.json')
 
         # todo make this more like alemebic and determine/load versions automatically
-        with open(file_path, 'r') as f:
-            data = json.loads(f.read())
-
+        codec = get_codec(ctx.json_codec)
+        data = load_file(file_path, codec=codec)
         data = run_migration(data, start_version, end_version)
-        with open(file_path, 'w') as f:
-            f.write(json.dumps(data))
+        save_file(file_path, data, dry_run=ctx.dry_run, codec=codec)
 
 
 @cli.command()
+@click.option('--file-format', type=click.Choice(['json', 'binary']), required=True, help='Format to convert to.')
 @pass_context
-def propagate(ctx):
+def convert(ctx, file_format):
+    """Converts the data file between the JSON and binary formats."""
+    if ctx.data_file:
+        file_path = ctx.data_file
+    else:
+        file_path = os.path.join(ctx.data_dir, ctx.namespace + '.json')
+
+    codec = get_codec(ctx.json_codec)
+    save_file(file_path, load_file(file_path, codec=codec), dry_run=ctx.dry_run, file_format=file_format, codec=codec)
+
+
+@cli.command()
+@click.option('--delta-prefix', help='Key prefix of the delta log. Default: <data-file>.deltas/')
+@click.option('--compression', type=click.Choice(['none', 'gzip', 'zstd']), default='none',
+              help='Compression of the new base object.')
+@pass_context
+def compact(ctx, delta_prefix, compression):
+    """Folds the S3 delta log into its base object."""
+    swag = create_swag_from_ctx(ctx)
+    swag.backend.compression = compression
+    if delta_prefix:
+        swag.backend.delta_prefix = delta_prefix
+
+    if not ctx.dry_run:
+        generation = swag.backend.compact()
+        log.info('Compacted delta log. Generation: {generation}'.format(generation=generation))
+
+
+@cli.command()
+@click.option('--write-units', default=None, type=int,
+              help='Write capacity units to consume on the destination table. Defaults to its provisioned capacity.')
+@pass_context
+def propagate(ctx, write_units):
     """Transfers SWAG data from one backend to another"""
     data = []
     if ctx.type == 'file':
@@ -186,18 +226,34 @@ def propagate(ctx):
         else:
             file_path = os.path.join(ctx.data_dir, ctx.namespace + '.json')
 
-        with open(file_path, 'r') as f:
-            data = json.loads(f.read())
+        data = load_file(file_path, codec=get_codec(ctx.json_codec))
 
     swag_opts = {
-        'swag.type': 'dynamodb'
+        'swag.type': 'dynamodb',
+        'swag.write_units': write_units
     }
 
     swag = SWAGManager(**parse_swag_config_options(swag_opts))
+    swag.create_many(data, dry_run=ctx.dry_run)
+
+
+@cli.command()
+@click.option('--path', required=True, help='Path of the snapshot file to publish.')
+@click.option('--interval', default=0, help='Seconds between checks for new data. Default publishes once.')
+@pass_context
+def snapshot(ctx, path, interval):
+    """Publishes a memory mapped snapshot for the snapshot backend."""
+    swag = create_swag_from_ctx(ctx)
+
+    while True:
+        generation = publish_snapshot(path, swag.get_all(), version=swag.version, fields=swag.index_fields)
+        if generation:
+            log.info('Published snapshot. Path: {path} Generation: {generation}'.format(path=path, generation=generation))
 
-    for item in data:
-        time.sleep(2)
-        swag.create(item, dry_run=ctx.dry_run)
+        if not interval:
+            break
+
+        time.sleep(interval)
 
 
 @cli.command()
@@ -206,10 +262,9 @@ def propagate(ctx):
 def create(ctx, data):
     """Create a new SWAG item."""
     swag = create_swag_from_ctx(ctx)
-    data = json.loads(data.read())
+    data = get_codec(ctx.json_codec).loads(data.read())
 
-    for account in data:
-        swag.create(account, dry_run=ctx.dry_run)
+    swag.create_many(data, dry_run=ctx.dry_run)
 
 
 @cli.command()
@@ -218,10 +273,9 @@ def create(ctx, data):
 def update(ctx, data):
     """Updates a given record."""
     swag = create_swag_from_ctx(ctx)
-    data = json.loads(data.read())
+    data = get_codec(ctx.json_codec).loads(data.read())
 
-    for account in data:
-        swag.update(account, dry_run=ctx.dry_run)
+    swag.update_many(data, dry_run=ctx.dry_run)
 
 
 @cli.command()
@@ -251,14 +305,7 @@ def deploy_service(ctx, path, name, regions, disabled):
 
                          }
                     )
-                a['services'].append(
-                    {
-                        'name': name,
-                        'status': status
-                     }
-                )
-
-                swag.update(a, dry_run=ctx.dry_run)
+                swag.set_service(a['id'], {'name': name, 'status': status}, dry_run=ctx.dry_run)
         except InvalidSWAGDataException as e:
             log.warning('Found a data quality issue. AccountName: {name} AccountNumber: {number}'.format(name=a['name'], number=a['id']))
 
@@ -271,7 +318,7 @@ def deploy_service(ctx, path, name, regions, disabled):
 def seed_aws_data(ctx, data):
     """Seeds SWAG from a list of known AWS accounts."""
     swag = create_swag_from_ctx(ctx)
-    for k, v in json.loads(data.read()).items():
+    for k, v in get_codec(ctx.json_codec).loads(data.read()).items():
         for account in v['accounts']:
             data = {
                     'description': 'This is an AWS owned account used for {}'.format(k),
@@ -341,6 +388,7 @@ def seed_aws_organization(ctx, owner):
 # todo perhaps there is a better way of dynamically adding subcommands?
 file.add_command(list)
 file.add_command(migrate)
+file.add_command(convert)
 file.add_command(propagate)
 file.add_command(create)
 file.add_command(seed_aws_data)
@@ -348,6 +396,7 @@ file.add_command(seed_aws_organization)
 file.add_command(update)
 file.add_command(deploy_service)
 file.add_command(list_service)
+file.add_command(snapshot)
 dynamodb.add_command(list)
 dynamodb.add_command(create)
 dynamodb.add_command(update)
@@ -355,6 +404,7 @@ dynamodb.add_command(seed_aws_data)
 dynamodb.add_command(seed_aws_organization)
 dynamodb.add_command(deploy_service)
 dynamodb.add_command(list_service)
+dynamodb.add_command(snapshot)
 s3.add_command(list)
 s3.add_command(create)
 s3.add_command(update)
@@ -362,5 +412,7 @@ s3.add_command(seed_aws_data)
 s3.add_command(seed_aws_organization)
 s3.add_command(deploy_service)
 s3.add_command(list_service)
+s3.add_command(snapshot)
+s3.add_command(compact)
 
 
@@ -15,3 +15,8 @@ class InvalidSWAGBackendError(SWAGException, ImportError):
 
 class MissingSWAGParameter(SWAGException):
     pass
+
+
+class SWAGConflictError(SWAGException):
+    """A conditional write found the item missing or changed by another writer."""
+    pass
@@ -0,0 +1,313 @@
+"""
+.. module:: swag_client.index
+    :platform: Unix
+"""
+import re
+
+from jmespath.exceptions import JMESPathError
+from jmespath.parser import ParsedResult
+
+from swag_client.compat import string_types
+from swag_client.exceptions import InvalidSWAGDataException
+from swag_client.util import BoundedDict, expression_cache
+
+
+EQUALITY_FILTER = re.compile(r"^\s*(?P<root>[A-Za-z_][A-Za-z0-9_]*)?\[\?\s*(?P<field>[A-Za-z_][A-Za-z0-9_]*)"
+                             r"\s*==\s*'(?P<value>[^'\\]*)'\s*\]\s*$")
+
+
+def parse_equality_filter(search_filter, version):
+    """Recognizes filters of the form `[?field=='value']`.
+
+    Returns a `(field, value)` tuple when the filter can be answered from an index,
+    otherwise None.
+    """
+    match = EQUALITY_FILTER.match(search_filter)
+    if not match:
+        return
+
+    if version == 1 and match.group('root') != 'accounts':
+        return
+
+    if version != 1 and match.group('root'):
+        return
+
+    return match.group('field'), match.group('value')
+
+
+def get_index_fields(fields=None, version=2):
+    """Fields to index, the ones lookups by id, name and alias rely on always come first."""
+    alias_field = 'alias' if version == 1 else 'aliases'
+    return list(dict.fromkeys(['id', 'name', alias_field] + list(fields or [])))
+
+
+IDENTITY = {'type': 'identity', 'children': []}
+
+_plans = BoundedDict(256)
+
+
+class QueryPlan(object):
+    """Splits a filter into lookups an index answers and a residual predicate.
+
+    Lookups are `('eq', field, value)`, `('contains', field, value)`,
+    `('and', lookups)` and `('or', lookups)`, they select exactly the accounts
+    their part of the filter does. The residual is the compiled conjunction of
+    everything else, evaluated with JMESPath on the accounts the lookups select.
+    """
+    def __init__(self, lookup, residual=None):
+        self.lookup = lookup
+        self.residual = residual
+
+
+def plan_filter(search_filter, version, fields):
+    """Plans a filter of the form `[?predicate]` against the indexed fields.
+
+    Returns None when no part of the filter can be answered from the index.
+    Plans are cached by filter, version and fields.
+    """
+    key = (search_filter, version, tuple(fields))
+    if key not in _plans:
+        _plans[key] = _plan(search_filter, version, set(fields))
+    return _plans.get(key)
+
+
+def _plan(search_filter, version, fields):
+    try:
+        parsed = expression_cache.get(search_filter).parsed
+    except JMESPathError:
+        return
+
+    if parsed['type'] != 'filter_projection':
+        return
+
+    root, right, predicate = parsed['children']
+    if right['type'] != 'identity':
+        return
+
+    if version == 1:
+        if root != {'type': 'field', 'children': [], 'value': 'accounts'}:
+            return
+    elif root['type'] != 'identity':
+        return
+
+    conjuncts = _conjuncts(predicate)
+    lookups = [_lookup(c, fields) for c in conjuncts]
+    if not any(lookups):
+        return
+
+    residual = [c for c, lookup in zip(conjuncts, lookups) if lookup is None]
+    if residual:
+        node = residual[0]
+        for conjunct in residual[1:]:
+            node = {'type': 'and_expression', 'children': [node, conjunct]}
+        residual = ParsedResult(search_filter, {'type': 'filter_projection', 'children': [IDENTITY, IDENTITY, node]})
+
+    lookups = [lookup for lookup in lookups if lookup is not None]
+    return QueryPlan(lookups[0] if len(lookups) == 1 else ('and', lookups), residual or None)
+
+
+def _conjuncts(node):
+    if node['type'] == 'and_expression':
+        return [c for child in node['children'] for c in _conjuncts(child)]
+    return [node]
+
+
+def _lookup(node, fields):
+    """Translates a predicate into an exact index lookup, None if it needs JMESPath."""
+    if node['type'] in ('and_expression', 'or_expression'):
+        lookups = [_lookup(child, fields) for child in node['children']]
+        if None in lookups:
+            return
+        return ('and' if node['type'] == 'and_expression' else 'or', lookups)
+
+    # JMESPath only finds strings equal to a string, and `contains` matches list
+    # elements or substrings, which is what the index tables hold.
+    if node['type'] == 'comparator' and node['value'] == 'eq':
+        field, value = _field_literal(*node['children'])
+        if field is None:
+            field, value = _field_literal(*reversed(node['children']))
+
+        if field in fields and isinstance(value, string_types):
+            return ('eq', field, value)
+
+    if node['type'] == 'function_expression' and node['value'] == 'contains' and len(node['children']) == 2:
+        field, value = _field_literal(*node['children'])
+        if field in fields and isinstance(value, string_types):
+            return ('contains', field, value)
+
+
+def _field_literal(field, literal):
+    if field['type'] == 'field' and literal['type'] == 'literal':
+        return field['value'], literal['value']
+    return None, None
+
+
+def get_enabled_regions(account, name, version):
+    """Fetches the regions an account has enabled a service in.
+
+    Returns None when the service is not enabled at all. Version 1 data carries
+    no region information, so an enabled v1 service is reported as `all`.
+    """
+    if version == 1:
+        service = (account.get('service') or {}).get(name)
+        if service and service.get('enabled'):
+            return {'all'}
+        return
+
+    services = [s for s in account.get('services') or [] if s.get('name') == name]
+    if not services:
+        return
+
+    if len(services) > 1:
+        raise InvalidSWAGDataException('Attempted to fetch one item, but multiple items found.')
+
+    regions = set(s.get('region') for s in services[0].get('status') or [] if s.get('enabled'))
+    return regions or None
+
+
+def is_service_enabled(account, name, version, region=None):
+    """Determines if a service is enabled for an account, optionally in a specific region."""
+    regions = get_enabled_regions(account, name, version)
+    if not regions:
+        return False
+
+    if not region or version == 1:
+        return True
+
+    return region in regions or 'all' in regions
+
+
+class AccountIndex(object):
+    """Lookup tables built over a single generation of backend data.
+
+    An index is only valid for the exact object it was built from, callers
+    should compare `source` against the latest backend data before using it.
+    """
+    def __init__(self, items, version=2, fields=None):
+        self.source = items
+        self.version = version
+
+        if version == 1:
+            self.accounts = items.get('accounts', []) if items else []
+        else:
+            self.accounts = items or []
+
+        self.alias_field = 'alias' if version == 1 else 'aliases'
+
+        if fields is None:
+            fields = ['id', 'name', self.alias_field]
+
+        self.fields = list(fields)
+        self._equals = {}
+        self._contains = {}
+        for field in fields:
+            self._build(field)
+
+        self._services = None
+        self._service_enabled = {}
+
+    @classmethod
+    def from_tables(cls, accounts, version=2, equals=None, contains=None, services=None):
+        """Restores an index from prebuilt lookup tables, e.g. ones read from a snapshot."""
+        index = cls([], version=version, fields=[])
+        index.source = index.accounts = accounts
+        index._equals = equals or {}
+        index._contains = contains or {}
+        index.fields = list(index._equals)
+        index._services = services
+        return index
+
+    def _build(self, field):
+        equals = self._equals[field] = {}
+        contains = self._contains[field] = {}
+        for position, account in enumerate(self.accounts):
+            value = account.get(field)
+            if isinstance(value, list):
+                for v in set(v for v in value if isinstance(v, string_types)):
+                    contains.setdefault(v, []).append(position)
+            elif isinstance(value, string_types):
+                equals.setdefault(value, []).append(position)
+
+    def has_field(self, field):
+        """Determines if a field is indexed."""
+        return field in self._equals
+
+    def positions(self, field, value, contains=False):
+        """Fetches the storage positions of accounts where field equals (or contains) value."""
+        if contains:
+            return self._contains[field].get(value, [])
+        return self._equals[field].get(value, [])
+
+    def lookup(self, field, value, contains=False):
+        """Fetches all accounts where field equals (or contains) value."""
+        return [self.accounts[p] for p in self.positions(field, value, contains=contains)]
+
+    def search(self, plan):
+        """Fetches the accounts matching a planned filter, in storage order."""
+        accounts = [self.accounts[p] for p in sorted(self._select(plan.lookup))]
+        if plan.residual is not None:
+            accounts = plan.residual.search(accounts)
+        return accounts
+
+    def _select(self, lookup):
+        kind = lookup[0]
+        if kind == 'and':
+            return set.intersection(*[self._select(l) for l in lookup[1]])
+
+        if kind == 'or':
+            return set.union(*[self._select(l) for l in lookup[1]])
+
+        _, field, value = lookup
+        positions = set(self.positions(field, value, contains=kind == 'contains'))
+
+        # Fields holding strings are searched for substrings.
+        if kind == 'contains':
+            for string, string_positions in self._equals[field].items():
+                if value in string:
+                    positions.update(string_positions)
+
+        return positions
+
+    def lookup_any(self, *criteria):
+        """Fetches all accounts matching any of the `(field, value, contains)` criteria, in storage order."""
+        positions = set()
+        for field, value, contains in criteria:
+            positions.update(self.positions(field, value, contains=contains))
+        return [self.accounts[p] for p in sorted(positions)]
+
+    def _build_services(self):
+        services = {}
+        for position, account in enumerate(self.accounts):
+            if self.version == 1:
+                names = (account.get('service') or {}).keys()
+            else:
+                names = set(s.get('name') for s in account.get('services') or [])
+
+            for name in names:
+                try:
+                    regions = get_enabled_regions(account, name, self.version)
+                except InvalidSWAGDataException as e:
+                    regions = e
+
+                if regions:
+                    services.setdefault(name, []).append((position, regions))
+        return services
+
+    def service_enabled(self, name, region=None):
+        """Fetches all accounts where a service has been enabled, optionally in a specific region."""
+        key = (name, region or None)
+        if key not in self._service_enabled:
+            if self._services is None:
+                self._services = self._build_services()
+
+            positions = []
+            for position, regions in self._services.get(name, []):
+                if isinstance(regions, InvalidSWAGDataException):
+                    raise regions
+
+                if not region or self.version == 1 or region in regions or 'all' in regions:
+                    positions.append(position)
+
+            self._service_enabled[key] = positions
+
+        return [self.accounts[p] for p in self._service_enabled[key]]
@@ -0,0 +1,95 @@
+"""
+.. module:: swag_client.jsoncodec
+    :platform: Unix
+
+JSON codecs the backends can use to load and store their documents.
+
+Every codec decodes `bytes` (or `str`) and encodes to UTF-8 `bytes`, so
+callers can hand them raw file or object bodies without a decode step.
+"""
+import decimal
+import json
+
+import simplejson
+
+from swag_client.exceptions import SWAGException
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
+
+def _default(obj):
+    """Encodes the Decimals DynamoDB hands back, which only simplejson supports natively."""
+    if isinstance(obj, decimal.Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+
+class JSONCodec(object):
+    """Loads and dumps JSON documents with a specific library.
+
+    Codecs with an `iterencode` stream documents to files in chunks. orjson
+    and ujson can only encode a whole document at once, so writing with them
+    holds the encoded document in memory next to the data.
+    """
+    def __init__(self, name, loads, dumps, iterencode=None):
+        self.name = name
+        self._loads = loads
+        self._dumps = dumps
+        self._iterencode = iterencode
+
+    def loads(self, data):
+        return self._loads(data)
+
+    def dumps(self, obj):
+        data = self._dumps(obj)
+        if isinstance(data, str):
+            return data.encode('utf-8')
+        return data
+
+    def dump(self, obj, fp):
+        """Writes a document to a binary file."""
+        if self._iterencode is None:
+            fp.write(self.dumps(obj))
+            return
+
+        for chunk in self._iterencode(obj):
+            fp.write(chunk.encode('utf-8'))
+
+
+def _ujson_loads(data):
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return ujson.loads(data)
+
+
+CODECS = {
+    'simplejson': lambda: JSONCodec('simplejson', simplejson.loads, simplejson.dumps,
+                                    simplejson.JSONEncoder().iterencode),
+    'json': lambda: JSONCodec('json', json.loads, lambda obj: json.dumps(obj, default=_default),
+                              json.JSONEncoder(default=_default).iterencode),
+    'orjson': lambda: JSONCodec('orjson', orjson.loads, lambda obj: orjson.dumps(obj, default=_default)),
+    'ujson': lambda: JSONCodec('ujson', _ujson_loads, lambda obj: ujson.dumps(obj, default=_default)),
+}
+
+_MODULES = {'orjson': lambda: orjson, 'ujson': lambda: ujson}
+
+
+def get_codec(name=None):
+    """Fetches a codec by name, defaulting to simplejson."""
+    name = name or 'simplejson'
+
+    if name not in CODECS:
+        raise SWAGException('JSON codec is not supported. Codec: {}'.format(name))
+
+    if name in _MODULES and _MODULES[name]() is None:
+        raise SWAGException('JSON codec is not installed. Codec: {name} Install: pip install swag-client[{name}]'.format(name=name))
+
+    return CODECS[name]()
@@ -6,6 +6,7 @@ from marshmallow.validate import OneOf
 
 PROVIDERS = ['aws', 'gcp', 'azure']
 ACCOUNT_STATUSES = ['created', 'in-progress', 'ready', 'deprecated', 'deleted', 'in-active']
+CONTEXT_FIELDS = ['type', 'environment', 'owner']
 
 
 class NoteSchema(Schema):
@@ -45,6 +46,10 @@ class RegionSchema(Schema):
     az_mapping = fields.Dict()
 
 
+REGION_SCHEMA = RegionSchema()
+SERVICE_SCHEMA = ServiceSchema()
+
+
 class AccountSchema(Schema):
     schemaVersion = fields.Str(missing='2')
     id = fields.Str(required=True)
@@ -76,8 +81,7 @@ class AccountSchema(Schema):
         If the schema context for a given field is empty, then
         we assume any value is valid for the given schema field.
         """
-        fields_to_validate = ['type', 'environment', 'owner']
-        for field in fields_to_validate:
+        for field in CONTEXT_FIELDS:
             value = data.get(field)
             allowed_values = self.context.get(field)
             if allowed_values and value not in allowed_values:
@@ -100,10 +104,9 @@ class AccountSchema(Schema):
         """Performs field validation for regions.  This should be
         a dict with region names as the key and RegionSchema as the value
         """
-        region_schema = RegionSchema()
         supplied_regions = data.get('regions', {})
         for region in supplied_regions.keys():
-            result = region_schema.validate(supplied_regions[region])
+            result = REGION_SCHEMA.validate(supplied_regions[region])
             if len(result.keys()) > 0:
                 raise ValidationError(result)
 
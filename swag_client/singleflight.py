@@ -0,0 +1,163 @@
+"""
+.. module:: swag_client.singleflight
+    :platform: Unix
+"""
+import functools
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import simplejson as json
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Ensures only one call per key is in flight, concurrent callers wait for its result."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        """Calls fn unless a call for key is already running, in which case its result is shared."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if leader:
+            try:
+                call.result = fn()
+            except BaseException as e:
+                # Waiters must not mistake an interrupted call for a result of None.
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.event.set()
+        else:
+            call.event.wait()
+
+        if call.error is not None:
+            raise call.error
+
+        return call.result
+
+
+class FileLockSingleFlight(object):
+    """Ensures only one process at a time loads a key.
+
+    The loading process holds an exclusive lock on a file in `lock_dir` and
+    publishes its result next to it. Processes that were waiting on the lock
+    use that result as long as it is younger than `max_age` seconds instead of
+    loading it again.
+    """
+    def __init__(self, lock_dir, max_age):
+        self.lock_dir = lock_dir
+        self.max_age = max_age
+
+    def _path(self, key):
+        return os.path.join(self.lock_dir, 'swag-' + hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    @contextmanager
+    def _locked(self, path):
+        with open(path + '.lock', 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def do(self, key, fn):
+        """Calls fn while holding the key's lock, unless a fresh enough result was published."""
+        path = self._path(key)
+
+        if fcntl is None:  # pragma: no cover
+            return fn()
+
+        with self._locked(path):
+            try:
+                if time.time() - os.stat(path + '.json').st_mtime < self.max_age:
+                    with open(path + '.json', 'r') as result:
+                        return json.load(result, use_decimal=True)
+            except (OSError, IOError, ValueError):
+                pass
+
+            result = fn()
+            self._publish(path + '.json', result)
+            return result
+
+    def invalidate(self, key):
+        """Removes the published result of key, the next process to load it calls fn again.
+
+        The key's lock is taken first, so a load that is already running cannot
+        publish data read before the caller's write once this returns.
+        """
+        path = self._path(key)
+
+        if fcntl is None:  # pragma: no cover
+            return
+
+        with self._locked(path):
+            try:
+                os.unlink(path + '.json')
+            except OSError:
+                pass
+
+    def _publish(self, path, result):
+        fd, temp_file = tempfile.mkstemp(dir=self.lock_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(result, f)
+            os.replace(temp_file, path)
+
+        except Exception as e:
+            os.unlink(temp_file)
+            logger.warning('Unable to publish loaded data. Path: {path} Error: {error}'.format(path=path, error=e))
+
+
+single_flight = SingleFlight()
+
+
+class SingleFlightLoader(object):
+    """Loads a key through single flight, see `single_flight_loader`."""
+    def __init__(self, key, fn, lock_dir=None, max_age=0):
+        self.key = key
+        self.shared = FileLockSingleFlight(lock_dir, max_age) if lock_dir else None
+
+        if self.shared:
+            fn = functools.partial(self.shared.do, key, fn)
+        self.fn = fn
+
+    def __call__(self):
+        return single_flight.do(self.key, self.fn)
+
+    def invalidate(self):
+        """Drops the result published for other processes, backends call this after writing."""
+        if self.shared:
+            self.shared.invalidate(self.key)
+
+
+def single_flight_loader(key, fn, lock_dir=None, max_age=0):
+    """Wraps a loader so concurrent loads of the same key share one call.
+
+    With a lock_dir the load is also coordinated between processes.
+    """
+    return SingleFlightLoader(key, fn, lock_dir=lock_dir, max_age=max_age)
@@ -0,0 +1,274 @@
+"""
+.. module:: swag_client.snapshot
+    :platform: Unix
+
+Memory mappable snapshots of an account inventory and its lookup indexes.
+
+A snapshot file is laid out as a fixed header, one length prefixed JSON
+record per account and a trailing JSON metadata block holding the record
+offsets and the serialized `AccountIndex` tables. Readers map the file
+read-only and only decode the records they hand out, so the pages of the
+snapshot are shared between every process that maps it.
+"""
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from collections.abc import Sequence
+
+import simplejson as json
+
+from swag_client.exceptions import InvalidSWAGDataException
+from swag_client.index import AccountIndex, get_index_fields
+
+MAGIC = b'SWAGSNP1'
+HEADER = struct.Struct('<8sQQ')
+LENGTH = struct.Struct('<I')
+
+logger = logging.getLogger(__name__)
+
+
+class Records(Sequence):
+    """Accounts stored in a mapped snapshot, decoded on access."""
+    def __init__(self, buffer, offsets):
+        self._buffer = buffer
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[p] for p in range(*position.indices(len(self)))]
+
+        offset = self._offsets[position]
+        length, = LENGTH.unpack_from(self._buffer, offset)
+        start = offset + LENGTH.size
+        return json.loads(self._buffer[start:start + length].decode('utf-8'), use_decimal=True)
+
+
+def _dump_services(services):
+    dumped = {}
+    for name, entries in services.items():
+        dumped[name] = [
+            [position, None if isinstance(regions, InvalidSWAGDataException) else sorted(regions)]
+            for position, regions in entries
+        ]
+    return dumped
+
+
+def _load_services(services):
+    loaded = {}
+    for name, entries in services.items():
+        loaded[name] = [
+            (position, InvalidSWAGDataException('Duplicate service found: {}'.format(name)) if regions is None
+             else set(regions))
+            for position, regions in entries
+        ]
+    return loaded
+
+
+def read_header(path):
+    """Reads the metadata of a snapshot without mapping its records, returns None if there is no snapshot."""
+    try:
+        with open(path, 'rb') as f:
+            magic, offset, length = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                return None
+            f.seek(offset)
+            metadata = json.loads(f.read(length).decode('utf-8'))
+    except (OSError, IOError, struct.error, ValueError):
+        return None
+
+    header = {key: metadata[key] for key in ('generation', 'digest', 'version', 'namespace', 'count')}
+    header['fields'] = metadata.get('fields', list(metadata['equals']))
+    return header
+
+
+def _split(items, version):
+    """Separates the accounts from the namespace they are stored under in version 1 documents."""
+    if version != 1:
+        return None, items or []
+
+    if not items:
+        return 'accounts', []
+
+    if len(items) != 1:
+        raise InvalidSWAGDataException('Snapshots hold a single namespace. Found: {}'.format(', '.join(items)))
+
+    namespace, = items
+    return namespace, items[namespace]
+
+
+def _digest(accounts):
+    digest = hashlib.sha1()
+    for account in accounts:
+        digest.update(json.dumps(account, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def dump_snapshot(f, items, version=None, generation=1, fields=None):
+    """Writes items and their indexes to a seekable binary file.
+
+    Version 1 documents are recognized by their namespace envelope if no
+    version is given. `fields` are indexed in addition to id, name and aliases.
+    """
+    if version is None:
+        version = 1 if isinstance(items, dict) else 2
+
+    namespace, accounts = _split(items, version)
+    index = AccountIndex({'accounts': accounts} if version == 1 else accounts, version=version,
+                         fields=get_index_fields(fields, version))
+
+    start = f.tell()
+    f.write(HEADER.pack(MAGIC, 0, 0))
+
+    offsets = []
+    for account in accounts:
+        record = json.dumps(account, sort_keys=True).encode('utf-8')
+        offsets.append(f.tell() - start)
+        f.write(LENGTH.pack(len(record)))
+        f.write(record)
+
+    metadata = json.dumps({
+        'generation': generation,
+        'digest': _digest(accounts),
+        'version': version,
+        'namespace': namespace,
+        'count': len(offsets),
+        'offsets': offsets,
+        'fields': index.fields,
+        'equals': index._equals,
+        'contains': index._contains,
+        'services': _dump_services(index._build_services())
+    }).encode('utf-8')
+
+    end = f.tell()
+    f.write(metadata)
+    f.seek(start)
+    f.write(HEADER.pack(MAGIC, end - start, len(metadata)))
+    f.seek(end + len(metadata))
+
+
+def write_snapshot(path, items, version=2, generation=1, fields=None):
+    """Writes items and their indexes to a snapshot file.
+
+    The snapshot is written to a temporary file next to `path` and renamed
+    over it, readers that still map the previous generation keep using it
+    until they notice the new inode.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, temp_file = tempfile.mkstemp(dir=directory, prefix='.' + name + '.', suffix='.tmp')
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            dump_snapshot(f, items, version=version, generation=generation, fields=fields)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.chmod(temp_file, 0o644)
+        os.replace(temp_file, path)
+
+    except Exception:
+        os.unlink(temp_file)
+        raise
+
+
+def publish_snapshot(path, items, version=2, fields=None):
+    """Publishes a new generation of the snapshot at path if the items, or the indexed fields, changed.
+
+    Returns the published generation, or None if the current snapshot already
+    holds these items.
+    """
+    header = read_header(path)
+    generation = 1
+
+    if header:
+        if (header['digest'] == _digest(_split(items, version)[1]) and header['version'] == version and
+                header['fields'] == get_index_fields(fields, version)):
+            return None
+
+        generation = header['generation'] + 1
+
+    write_snapshot(path, items, version=version, generation=generation, fields=fields)
+    return generation
+
+
+class Snapshot(object):
+    """A read-only mapping of one generation of a snapshot file."""
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, offset, length = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise InvalidSWAGDataException('Not a SWAG snapshot. Path: {path}'.format(path=path))
+
+        metadata = json.loads(self._map[offset:offset + length].decode('utf-8'))
+
+        self.generation = metadata['generation']
+        self.version = metadata['version']
+        self.namespace = metadata['namespace']
+        self.accounts = Records(self._map, metadata['offsets'])
+        self.index = AccountIndex.from_tables(
+            self.accounts,
+            version=self.version,
+            equals=metadata['equals'],
+            contains=metadata['contains'],
+            services=_load_services(metadata['services'])
+        )
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def __iter__(self):
+        return iter(self.accounts)
+
+    def load(self):
+        """Decodes every account, in the shape the backends return them."""
+        accounts = list(self.accounts)
+        if self.version == 1:
+            return {self.namespace: accounts}
+        return accounts
+
+
+class SnapshotReader(object):
+    """Keeps the current generation of a snapshot file mapped.
+
+    Publishers rename new generations over the file, every call to `get`
+    compares the file's inode with the mapped one and remaps it on change.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Fetches the mapped snapshot, remapping it if a new generation was published."""
+        inode = os.stat(self.path).st_ino
+        snapshot = self._snapshot
+
+        if snapshot is None or snapshot.inode != inode:
+            with self._lock:
+                if self._snapshot is None or self._snapshot.inode != inode:
+                    logger.debug('Mapping snapshot. Path: {path}'.format(path=self.path))
+
+                    # The previous mapping is closed once the last reader lets go of it.
+                    self._snapshot = Snapshot(self.path)
+
+                snapshot = self._snapshot
+
+        return snapshot
+
+
+def is_snapshot(path):
+    """Determines if a file holds a snapshot rather than a JSON document."""
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except (OSError, IOError):
+        return False
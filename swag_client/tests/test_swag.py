@@ -1,3 +1,5 @@
+import json
+
 from deepdiff import DeepDiff
 from marshmallow.exceptions import ValidationError
 import pytest
@@ -862,12 +864,13 @@ def test_get_by_aws_account_number(s3_bucket_name):
     assert not get_by_aws_account_number('thisdoesnotexist', s3_bucket_name)
 
 
-def test_schema_context_validation_type_field():
+def test_schema_context_validation_type_field(tmpdir):
     """Test schema context validation for type field"""
     from swag_client.backend import SWAGManager
     from swag_client.util import parse_swag_config_options
 
     swag_opts = {
+        'swag.data_dir': str(tmpdir),
         'swag.schema_context': {
             'type': ['billing', 'security', 'shared-service', 'service'],
         }
@@ -897,12 +900,13 @@ def test_schema_context_validation_type_field():
     assert account.get('type') == 'billing'
 
 
-def test_schema_context_validation_environment_field():
+def test_schema_context_validation_environment_field(tmpdir):
     """Test schema context validation for environment field"""
     from swag_client.backend import SWAGManager
     from swag_client.util import parse_swag_config_options
 
     swag_opts = {
+        'swag.data_dir': str(tmpdir),
         'swag.schema_context': {
             'environment': ['test', 'prod']
         }
@@ -931,12 +935,13 @@ def test_schema_context_validation_environment_field():
     account = swag.create(data)
     assert account.get('environment') == 'test'
 
-def test_schema_context_validation_owner_field():
+def test_schema_context_validation_owner_field(tmpdir):
     """Test schema context validation for owner field"""
     from swag_client.backend import SWAGManager
     from swag_client.util import parse_swag_config_options
 
     swag_opts = {
+        'swag.data_dir': str(tmpdir),
         'swag.schema_context': {
             'owner': ['netflix', 'dvd', 'aws', 'third-party']
         }
@@ -1053,3 +1058,1820 @@ def test_region_validation_field(s3_bucket_name):
     assert account.get('account_status') == 'created'
 
 
+
+
+def test_backend_index_lookup(vector_path):
+    import jmespath
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.data_dir': vector_path,
+        'swag.namespace': 'valid_accounts_v2',
+        'swag.cache_expires': 0
+    }
+
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+    items = swag.backend.get_all()
+
+    for search_filter in ["[?id=='012345678910']", "[?name=='testaccount2']", "[?id=='nope']", "[?aliases=='test']"]:
+        assert swag.get_all(search_filter) == jmespath.search(search_filter, items)
+
+    assert swag.get_by_name('test2', alias=True) == jmespath.search(
+        "[?name=='test2' || contains(aliases, 'test2')]", items)
+
+
+def test_backend_index_rebuilt_on_new_generation(temp_file_name):
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.data_file': str(temp_file_name),
+        'swag.cache_expires': 0
+    }
+
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+
+    account = {
+        'aliases': ['test'],
+        'contacts': ['admins@test.net'],
+        'description': 'LOL, Test account',
+        'email': 'testaccount@test.net',
+        'environment': 'test',
+        'id': '012345678910',
+        'name': 'testaccount',
+        'owner': 'netflix',
+        'provider': 'aws',
+        'sensitive': False
+    }
+
+    swag.create(account)
+    assert swag.get("[?id=='012345678910']")['name'] == 'testaccount'
+
+    account['name'] = 'renamed'
+    swag.update(account)
+    assert swag.get("[?id=='012345678910']")['name'] == 'renamed'
+    assert not swag.get_by_name('testaccount')
+
+
+def test_backend_get_service_enabled_single_pass(vector_path):
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.data_dir': vector_path,
+        'swag.namespace': 'valid_accounts_v2',
+        'swag.cache_expires': 0
+    }
+
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+    accounts = swag.get_all()
+
+    for name in ['myService', 'myService1', 'myService2', 's3', 'cloudtrail']:
+        for region in [None, 'us-east-1', 'us-west-2']:
+            assert swag.get_service_enabled(name, region=region) == \
+                swag.get_service_enabled(name, accounts_list=accounts, region=region)
+
+    assert [a['name'] for a in swag.get_service_enabled('s3', region='eu-west-1')] == ['testaccount2']
+    assert not swag.get_service_enabled('myService2', region='us-west-2')
+
+
+def test_search_expression_cache():
+    from swag_client.util import ExpressionCache, search, expression_cache
+
+    items = [{'id': '1', 'name': 'a'}, {'id': '2', 'name': 'b'}]
+
+    expression_cache.clear()
+    assert search("[?id==param('id')].name", items, id='1') == ['a']
+    assert search("[?id==param('id')].name", items, id='2') == ['b']
+    assert expression_cache.info()['misses'] == 1
+    assert expression_cache.info()['hits'] == 1
+
+    cache = ExpressionCache(maxsize=1)
+    cache.get('a')
+    cache.get('b')
+    cache.get('a')
+    assert cache.info() == {'hits': 0, 'misses': 3, 'maxsize': 1, 'size': 1}
+
+
+def _batch_accounts(count):
+    return [{
+        'aliases': ['test{}'.format(i)],
+        'contacts': ['admins@test.net'],
+        'description': 'LOL, Test account',
+        'email': 'testaccount@test.net',
+        'environment': 'test',
+        'id': '0123456789{:02d}'.format(i),
+        'name': 'testaccount{}'.format(i),
+        'owner': 'netflix',
+        'provider': 'aws',
+        'sensitive': False
+    } for i in range(count)]
+
+
+def _check_batch_operations(swag):
+    accounts = _batch_accounts(5)
+
+    swag.create_many(accounts)
+    assert len(swag.get_all()) == 5
+
+    for account in accounts[:2]:
+        account['environment'] = 'prod'
+    swag.update_many(accounts[:2])
+    assert len(swag.get_all()) == 5
+    assert len(swag.get_all("[?environment=='prod']")) == 2
+
+    swag.delete_many(accounts[1:4])
+    assert sorted(a['id'] for a in swag.get_all()) == [accounts[0]['id'], accounts[4]['id']]
+
+
+def test_file_backend_batch_operations(temp_file_name):
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.data_file': str(temp_file_name),
+        'swag.cache_expires': 0
+    }
+
+    _check_batch_operations(SWAGManager(**parse_swag_config_options(swag_opts)))
+
+
+def test_s3_backend_batch_operations(s3_bucket_name):
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.type': 's3',
+        'swag.bucket_name': s3_bucket_name,
+        'swag.cache_expires': 0
+    }
+
+    _check_batch_operations(SWAGManager(**parse_swag_config_options(swag_opts)))
+
+
+def test_dynamodb_backend_batch_operations(dynamodb_table):
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.type': 'dynamodb',
+        'swag.namespace': 'accounts',
+        'swag.write_units': 100,
+        'swag.cache_expires': 0
+    }
+
+    _check_batch_operations(SWAGManager(**parse_swag_config_options(swag_opts)))
+
+
+def test_dynamodb_backend_default_write_capacity(dynamodb_table):
+    import time
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.type': 'dynamodb',
+        'swag.cache_expires': 0
+    }
+
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+
+    # The table provisions one write unit, its burst capacity covers a small batch.
+    started = time.monotonic()
+    swag.create_many(_batch_accounts(20))
+    assert time.monotonic() - started < 5
+    assert len(swag.get_all()) == 20
+    assert swag.backend.get_writer().bucket.rate == 1
+
+    # On-demand tables report no write capacity and are not throttled.
+    swag.backend._description['ProvisionedThroughput']['WriteCapacityUnits'] = 0
+    assert swag.backend.get_writer().bucket is None
+
+
+def test_token_bucket():
+    from swag_client.util import TokenBucket
+
+    now = [0.0]
+    slept = []
+
+    def sleep(seconds):
+        slept.append(seconds)
+        now[0] += seconds
+
+    bucket = TokenBucket(10, clock=lambda: now[0], sleep=sleep)
+
+    assert bucket.consume(10) == 0
+    assert bucket.consume(5) == 0.5
+    now[0] += 1.0
+    assert bucket.consume(15) == 0.5
+    assert slept == [0.5, 0.5]
+
+
+def test_dynamodb_throttled_writer_retries(dynamodb_table):
+    from botocore.exceptions import ClientError
+    from swag_client.backends.dynamodb import ThrottledBatchWriter
+
+    import boto3
+    table = boto3.resource('dynamodb', region_name='us-east-1').Table('accounts')
+    batch_write_item = table.meta.client.batch_write_item
+    calls = []
+
+    def throttled_batch_write_item(**kwargs):
+        calls.append(len(kwargs['RequestItems']['accounts']))
+        if len(calls) == 1:
+            raise ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException', 'Message': ''}},
+                              'BatchWriteItem')
+        return batch_write_item(**kwargs)
+
+    table.meta.client.batch_write_item = throttled_batch_write_item
+
+    progress = []
+    writer = ThrottledBatchWriter(table, 1000, max_workers=1, backoff_base=0.001, progress=progress.append)
+    accounts = _batch_accounts(30) + _batch_accounts(1)
+    stats = writer.put_items(accounts)
+
+    assert calls == [25, 25, 5]
+    assert stats['items'] == 30
+    assert stats['retries'] == 1
+    assert progress[-1]['items'] == 30
+    assert table.scan()['Count'] == 30
+
+
+def test_dynamodb_backend_parallel_scan(dynamodb_table):
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.type': 'dynamodb',
+        'swag.namespace': 'accounts',
+        'swag.write_units': 100,
+        'swag.cache_expires': 0
+    }
+
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+    swag.create_many(_batch_accounts(20))
+
+    swag_opts['swag.scan_segments'] = 4
+    parallel = SWAGManager(**parse_swag_config_options(swag_opts))
+
+    # moto ignores Segment/TotalSegments, so split its results the way DynamoDB would.
+    client = parallel.backend.table.meta.client
+    scan = client.scan
+
+    def segmented_scan(Segment, TotalSegments, **kwargs):
+        result = scan(**kwargs)
+        result['Items'] = [i for i in result['Items'] if int(i['id']) % TotalSegments == Segment]
+        return result
+
+    client.scan = segmented_scan
+
+    assert sorted(a['id'] for a in parallel.get_all()) == sorted(a['id'] for a in swag.get_all())
+    assert parallel.get_all() == parallel.get_all()
+
+
+def test_s3_backend_get_all_revalidates_etag(s3_bucket_name):
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.type': 's3',
+        'swag.bucket_name': s3_bucket_name,
+        'swag.cache_expires': 0
+    }
+
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+    swag.create_many(_batch_accounts(2))
+
+    first = swag.backend.get_all()
+    etag = swag.backend._etag
+    assert etag
+
+    # An unchanged object is answered with a 304 and the parsed data is reused.
+    assert swag.backend.get_all() is first
+
+    swag.create(_batch_accounts(3)[2])
+    assert len(swag.backend.get_all()) == 3
+    assert swag.backend._etag != etag
+
+
+def test_file_backend_concurrent_writers(temp_file_name):
+    import threading
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.data_file': str(temp_file_name),
+        'swag.cache_expires': 0
+    }
+
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+    threads = [threading.Thread(target=swag.create, args=(account,)) for account in _batch_accounts(10)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert len(swag.get_all()) == 10
+
+
+def test_file_backend_lock_dir(tmpdir):
+    import os
+    from swag_client.backend import SWAGManager
+    from swag_client.backends.file import lock_path
+    from swag_client.util import parse_swag_config_options
+
+    data_file = str(tmpdir.join('accounts.json'))
+    lock_dir = tmpdir.mkdir('locks')
+
+    swag_opts = {
+        'swag.data_file': data_file,
+        'swag.lock_dir': str(lock_dir),
+        'swag.cache_expires': 0
+    }
+
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+    swag.create(_batch_accounts(1)[0])
+
+    assert not os.path.exists(data_file + '.lock')
+    assert os.path.exists(lock_path(data_file, str(lock_dir)))
+    assert lock_path(data_file) == data_file + '.lock'
+
+
+def test_s3_backend_conflicting_write_is_merged(s3_bucket_name):
+    from botocore.exceptions import ClientError
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.type': 's3',
+        'swag.bucket_name': s3_bucket_name,
+        'swag.cache_expires': 0
+    }
+
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+    first, second, third = _batch_accounts(3)
+    swag.create(first)
+
+    client = swag.backend.client
+    put_object = client.put_object
+    calls = []
+
+    def racing_put_object(**kwargs):
+        calls.append(kwargs.get('IfMatch'))
+        if len(calls) == 1:
+            # Another writer sneaks in between our read and our write.
+            put_object(Bucket=kwargs['Bucket'], Key=kwargs['Key'], Body=json.dumps([first, second]))
+            raise ClientError({'Error': {'Code': 'PreconditionFailed', 'Message': ''}}, 'PutObject')
+        return put_object(**kwargs)
+
+    client.put_object = racing_put_object
+    swag.create(third)
+
+    assert len(calls) == 2 and calls[0] != calls[1]
+    assert sorted(a['id'] for a in swag.get_all()) == sorted(a['id'] for a in [first, second, third])
+
+
+def test_file_backend_partial_read_is_not_cached(temp_file_name):
+    from swag_client.backend import SWAGManager
+    from swag_client.exceptions import InvalidSWAGDataException
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.data_file': str(temp_file_name),
+        'swag.cache_expires': 0
+    }
+
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+    assert swag.get_all() == []
+
+    accounts = _batch_accounts(2)
+    with open(temp_file_name, 'w') as f:
+        f.write(json.dumps(accounts)[:50])
+
+    with pytest.raises(InvalidSWAGDataException):
+        swag.get_all()
+
+    with open(temp_file_name, 'w') as f:
+        f.write(json.dumps(accounts))
+
+    assert len(swag.get_all()) == 2
+
+
+def test_file_backend_stat_cache_mode(temp_file_name):
+    from swag_client.backend import SWAGManager
+    from swag_client.backends.file import save_file
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.data_file': str(temp_file_name),
+        'swag.cache_mode': 'stat',
+        'swag.cache_expires': 3600
+    }
+
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+    accounts = _batch_accounts(3)
+
+    swag.create(accounts[0])
+    first = swag.get_all()
+    assert len(first) == 1
+    assert swag.get_all() is first
+
+    swag.create(accounts[1])
+    assert len(swag.get_all()) == 2
+
+    # Writes from other processes are picked up as soon as the file changes.
+    save_file(temp_file_name, accounts)
+    assert len(swag.get_all()) == 3
+
+
+def test_s3_backend_cache_per_instance(s3_bucket_name):
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.type': 's3',
+        'swag.bucket_name': s3_bucket_name,
+        'swag.cache_expires': 3600
+    }
+
+    first = SWAGManager(**parse_swag_config_options(dict(swag_opts, **{'swag.data_file': 'first.json'})))
+    second = SWAGManager(**parse_swag_config_options(dict(swag_opts, **{'swag.data_file': 'second.json'})))
+
+    first.create_many(_batch_accounts(1))
+    second.create_many(_batch_accounts(2))
+
+    assert len(first.get_all()) == 1
+    assert len(second.get_all()) == 2
+    assert first.backend.region is not second.backend.region
+
+
+def test_bounded_dict():
+    from swag_client.util import BoundedDict
+
+    d = BoundedDict(2)
+    d['a'] = 1
+    d['b'] = 2
+    assert d.get('a') == 1
+    d['c'] = 3
+    assert list(d.keys()) == ['a', 'c']
+    assert d.pop('a') == 1
+    assert d.get('a', 'missing') == 'missing'
+
+
+def test_refresh_ahead_cache():
+    import threading
+    import time
+    from swag_client.util import RefreshAheadCache
+
+    now = [0.0]
+    loads = []
+    fail = [False]
+    refreshed = threading.Event()
+
+    def loader():
+        try:
+            if fail[0]:
+                raise RuntimeError('backend unavailable')
+            loads.append(now[0])
+            return len(loads)
+        finally:
+            refreshed.set()
+
+    cache = RefreshAheadCache(loader, 10, max_staleness=60, clock=lambda: now[0])
+    assert cache.get() == 1
+
+    # Past the refresh interval the stale copy is served while a reload runs in the background.
+    now[0] = 11
+    refreshed.clear()
+    assert cache.get() == 1
+    assert refreshed.wait(5)
+    while cache._refreshing:
+        time.sleep(0.001)
+    assert cache.get() == 2
+
+    # Failed refreshes keep serving the last good copy until it is too stale.
+    fail[0] = True
+    now[0] = 30
+    refreshed.clear()
+    assert cache.get() == 2
+    assert refreshed.wait(5)
+    while cache._refreshing:
+        time.sleep(0.001)
+    assert cache.get() == 2
+
+    now[0] = 100
+    with pytest.raises(RuntimeError):
+        cache.get()
+
+    fail[0] = False
+    assert cache.get() == 3
+
+
+def test_refresh_ahead_cache_drops_loads_across_invalidate():
+    import threading
+    import time
+    from swag_client.util import RefreshAheadCache
+
+    now = [0.0]
+    loads = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def loader():
+        loads.append(now[0])
+        if len(loads) == 2:
+            started.set()
+            release.wait(5)
+        return len(loads)
+
+    cache = RefreshAheadCache(loader, 10, clock=lambda: now[0])
+    assert cache.get() == 1
+
+    # A write invalidates the cache while a refresh is still loading the data from before it.
+    now[0] = 11
+    assert cache.get() == 1
+    assert started.wait(5)
+    cache.invalidate()
+    release.set()
+    while cache._refreshing:
+        time.sleep(0.001)
+
+    assert cache.get() == 3
+    assert cache.get() == 3
+
+
+def test_async_manager(temp_file_name):
+    import asyncio
+    from swag_client.aio import AsyncSWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.data_file': str(temp_file_name),
+        'swag.cache_expires': 60
+    }
+
+    swag = AsyncSWAGManager(**parse_swag_config_options(swag_opts))
+    get_all = swag.backend.backend.get_all
+    loads = []
+
+    def counting_get_all():
+        loads.append(1)
+        return get_all()
+
+    swag.backend.backend.get_all = counting_get_all
+
+    async def run():
+        await swag.create_many(_batch_accounts(3))
+
+        results = await asyncio.gather(*[swag.get_all() for _ in range(10)])
+        assert all(len(r) == 3 for r in results)
+        assert len(loads) == 1
+
+        assert (await swag.get("[?id=='012345678901']"))['name'] == 'testaccount1'
+        assert await swag.get_by_name('test2', alias=True)
+        assert await swag.get_service_enabled('myService') == []
+        assert await swag.health_check()
+
+        await swag.delete(_batch_accounts(1)[0])
+        assert len(await swag.get_all()) == 2
+        assert len(loads) == 2
+
+    asyncio.run(run())
+
+
+def test_async_update_fields(temp_file_name):
+    import asyncio
+    from swag_client.aio import AsyncSWAGManager
+    from swag_client.exceptions import SWAGConflictError, SWAGException
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.data_file': str(temp_file_name),
+        'swag.cache_expires': 60
+    }
+
+    swag = AsyncSWAGManager(**parse_swag_config_options(swag_opts))
+
+    async def run():
+        await swag.create_many(_batch_accounts(2))
+
+        item = await swag.update_fields('012345678901', {'name': 'renamed', 'aliases': ['other']})
+        assert item['name'] == 'renamed'
+        assert item['aliases'] == ['other']
+        assert (await swag.get_by_id('012345678901'))['name'] == 'renamed'
+
+        with pytest.raises(SWAGConflictError):
+            await swag.update_fields('000000000000', {'name': 'missing'})
+
+        with pytest.raises(SWAGException):
+            await swag.update_fields('012345678901', {'name': 'other'}, expected_version=1)
+
+    asyncio.run(run())
+
+
+def test_async_set_service(dynamodb_table):
+    import asyncio
+    from swag_client.aio import AsyncBackend, AsyncSWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.type': 'dynamodb',
+        'swag.version_attribute': 'version',
+        'swag.cache_expires': 60
+    }
+
+    swag = AsyncSWAGManager(**parse_swag_config_options(swag_opts))
+    # Reads go through the executor, the moto mock does not cover aiobotocore.
+    swag.backend = AsyncBackend(swag.backend.backend, cache_expires=60)
+    service = {'name': 'myService', 'status': [{'region': 'all', 'enabled': True}]}
+
+    async def run():
+        await swag.create(_batch_accounts(1)[0])
+        assert (await swag.get_by_id('012345678900'))['services'] == []
+
+        item = await swag.set_service('012345678900', service, expected_version=1)
+        assert [s['name'] for s in item['services']] == ['myService']
+        assert [s['name'] for s in (await swag.get_by_id('012345678900'))['services']] == ['myService']
+
+    asyncio.run(run())
+
+
+def test_async_load_is_not_cached_across_invalidate():
+    import asyncio
+    from swag_client.aio import AsyncBackend
+
+    class Backend(object):
+        def __init__(self):
+            self.data = ['old']
+
+        def get_all(self):
+            return list(self.data)
+
+    backend = AsyncBackend(Backend(), cache_expires=60)
+    started = []
+
+    async def slow_fetch():
+        data = backend.backend.get_all()
+        started.append(1)
+        await asyncio.sleep(0.01)
+        return data
+
+    backend._fetch = slow_fetch
+
+    async def run():
+        load = asyncio.ensure_future(backend.get_all())
+        while not started:
+            await asyncio.sleep(0)
+
+        backend.backend.data = ['new']
+        backend.invalidate()
+        assert await load == ['old']
+        assert await backend.get_all() == ['new']
+
+    asyncio.run(run())
+
+
+class _AsyncBody(object):
+    def __init__(self, body):
+        self.body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.body.close()
+
+    async def read(self):
+        return self.body.read()
+
+
+class _AsyncPaginator(object):
+    def __init__(self, paginator):
+        self.paginator = paginator
+
+    async def _pages(self, kwargs):
+        for page in self.paginator.paginate(**kwargs):
+            yield page
+
+    def paginate(self, **kwargs):
+        return self._pages(kwargs)
+
+
+class _AsyncClient(object):
+    """Stands in for an aiobotocore client, calls are made with a boto3 client."""
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def get_paginator(self, name):
+        return _AsyncPaginator(self.client.get_paginator(name))
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+
+        async def call(**kwargs):
+            self.calls.append((name, kwargs.get('Key')))
+            response = method(**kwargs)
+            if 'Body' in response:
+                response['Body'] = _AsyncBody(response['Body'])
+            return response
+
+        return call
+
+
+def _use_client(backend, client):
+    async def get_client():
+        return client
+
+    backend._client = get_client
+
+
+@pytest.mark.parametrize('write_mode', ['document', 'delta'])
+def test_async_s3_backend(s3_bucket_name, write_mode):
+    import asyncio
+    import boto3
+    from swag_client.aio import AsyncS3Backend
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.type': 's3',
+        'swag.bucket_name': s3_bucket_name,
+        'swag.write_mode': write_mode,
+        'swag.compression': 'gzip',
+        'swag.cache_expires': 0
+    }
+
+    writer = SWAGManager(**parse_swag_config_options(swag_opts))
+    backend = AsyncS3Backend(writer.backend, cache_expires=0)
+    client = _AsyncClient(boto3.client('s3', region_name='us-east-1'))
+    _use_client(backend, client)
+
+    async def run():
+        assert await backend.get_all() == {}
+        assert not await backend.health_check()
+
+        await backend.create_many(_batch_accounts(3))
+        assert [a['id'] for a in await backend.get_all()] == [a['id'] for a in _batch_accounts(3)]
+
+        if write_mode == 'delta':
+            writer.backend.compact()
+        assert await backend.health_check()
+
+        writer.delete(_batch_accounts(1)[0])
+        assert len(await backend.get_all()) == 2
+
+        # Unchanged objects are revalidated, not downloaded again.
+        calls = len(client.calls)
+        assert len(await backend.get_all()) == 2
+        assert ('get_object', 'accounts.json') in client.calls[calls:]
+
+    asyncio.run(run())
+
+
+def test_async_dynamodb_backend(dynamodb_table):
+    import asyncio
+    import boto3
+    from swag_client.aio import AsyncDynamoDBBackend
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.type': 'dynamodb',
+        'swag.scan_segments': 2,
+        'swag.cache_expires': 0
+    }
+
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+    swag.create_many(_batch_accounts(5))
+
+    backend = AsyncDynamoDBBackend(swag.backend, cache_expires=60)
+    _use_client(backend, _AsyncClient(boto3.client('dynamodb', region_name='us-east-1')))
+
+    async def run():
+        items = await backend.get_all()
+        assert sorted(items, key=lambda a: a['id']) == sorted(swag.get_all(), key=lambda a: a['id'])
+        assert await backend.health_check()
+
+    asyncio.run(run())
+
+
+def test_single_flight():
+    import threading
+    import time
+    from swag_client.singleflight import SingleFlight
+
+    flight = SingleFlight()
+    calls = []
+    results = []
+
+    def load():
+        calls.append(1)
+        time.sleep(0.1)
+        return 'items'
+
+    threads = [threading.Thread(target=lambda: results.append(flight.do('key', load))) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == ['items'] * 10
+
+    def fail():
+        raise RuntimeError('backend unavailable')
+
+    with pytest.raises(RuntimeError):
+        flight.do('key', fail)
+
+    assert flight.do('key', load) == 'items'
+
+    # Waiters see an interrupted call fail instead of returning None.
+    entered = threading.Event()
+    errors = []
+
+    def interrupted():
+        entered.set()
+        time.sleep(0.1)
+        raise KeyboardInterrupt()
+
+    def leader():
+        try:
+            flight.do('key', interrupted)
+        except KeyboardInterrupt:
+            pass
+
+    def waiter():
+        try:
+            flight.do('key', load)
+        except KeyboardInterrupt as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=leader)]
+    threads[0].start()
+    entered.wait()
+    threads.append(threading.Thread(target=waiter))
+    threads[1].start()
+    for thread in threads:
+        thread.join()
+
+    assert len(errors) == 1
+
+
+def test_file_lock_single_flight(tmpdir):
+    from swag_client.singleflight import FileLockSingleFlight
+
+    calls = []
+
+    def load():
+        calls.append(1)
+        return _batch_accounts(2)
+
+    assert FileLockSingleFlight(str(tmpdir), 60).do('s3:bucket/accounts.json', load) == _batch_accounts(2)
+    # Another process finds the freshly published result instead of loading again.
+    assert FileLockSingleFlight(str(tmpdir), 60).do('s3:bucket/accounts.json', load) == _batch_accounts(2)
+    assert len(calls) == 1
+
+    assert FileLockSingleFlight(str(tmpdir), 0).do('s3:bucket/accounts.json', load) == _batch_accounts(2)
+    assert len(calls) == 2
+
+    FileLockSingleFlight(str(tmpdir), 60).invalidate('s3:bucket/accounts.json')
+    assert FileLockSingleFlight(str(tmpdir), 60).do('s3:bucket/accounts.json', load) == _batch_accounts(2)
+    assert len(calls) == 3
+
+
+def test_single_flight_dir_sees_own_writes(tmpdir, temp_file_name):
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.data_file': str(temp_file_name),
+        'swag.single_flight_dir': str(tmpdir),
+        'swag.cache_expires': 60
+    }
+
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+    assert swag.get_all() == []
+
+    swag.create(_batch_accounts(1)[0])
+    swag.backend.invalidate()
+    assert len(swag.get_all()) == 1
+
+
+def test_snapshot_backend(tmpdir):
+    from swag_client.backend import SWAGManager
+    from swag_client.exceptions import SWAGException
+    from swag_client.snapshot import publish_snapshot
+    from swag_client.util import parse_swag_config_options
+
+    path = str(tmpdir.join('swag.snapshot'))
+    accounts = _batch_accounts(3)
+    accounts[1]['services'] = [{'name': 'myService', 'status': [{'region': 'us-east-1', 'enabled': True}]}]
+
+    assert publish_snapshot(path, accounts) == 1
+    # Unchanged data does not publish a new generation.
+    assert publish_snapshot(path, accounts) is None
+
+    swag_opts = {
+        'swag.type': 'snapshot',
+        'swag.snapshot_path': path
+    }
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+
+    assert swag.get_all() == accounts
+    assert swag.get("[?id=='012345678901']") == accounts[1]
+    assert swag.get_by_name('test2', alias=True) == [accounts[2]]
+    assert swag.get_service_enabled('myService', region='us-east-1') == [accounts[1]]
+    assert swag.get_service_enabled('myService', region='us-west-2') == []
+    assert swag.get_all("[?environment=='test']") == accounts
+    assert swag.health_check()
+
+    with pytest.raises(SWAGException):
+        swag.create(accounts[0])
+
+    mapped = swag.backend.get_snapshot()
+    assert swag.backend.get_snapshot() is mapped
+
+    assert publish_snapshot(path, accounts[:2]) == 2
+    assert swag.get("[?id=='012345678902']") is None
+    assert swag.get_all() == accounts[:2]
+    assert swag.backend.get_snapshot().generation == 2
+
+    # Readers of the previous generation keep a valid mapping.
+    assert mapped.accounts[2] == accounts[2]
+
+
+def test_file_backend_binary_format(temp_file_name):
+    from swag_client.backend import SWAGManager
+    from swag_client.backends.file import iter_file, load_account, load_file, save_file
+    from swag_client.snapshot import is_snapshot
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.type': 'file',
+        'swag.data_file': str(temp_file_name),
+        'swag.file_format': 'binary',
+        'swag.cache_expires': 0
+    }
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+
+    _check_batch_operations(swag)
+    assert is_snapshot(str(temp_file_name))
+
+    swag.delete_many(swag.get_all())
+    accounts = swag.create_many(_batch_accounts(3))
+    assert swag.get("[?id=='012345678901']") == accounts[1]
+    assert swag.get_by_name('testaccount2') == [accounts[2]]
+    assert load_account(str(temp_file_name), '012345678902') == accounts[2]
+    assert list(iter_file(str(temp_file_name))) == accounts
+
+    # Conversion to JSON and back is lossless.
+    save_file(str(temp_file_name), load_file(str(temp_file_name)), file_format='json')
+    assert not is_snapshot(str(temp_file_name))
+    assert json.load(open(str(temp_file_name))) == accounts
+    assert load_account(str(temp_file_name), '012345678902') == accounts[2]
+
+    save_file(str(temp_file_name), {'accounts': accounts}, file_format='binary')
+    assert load_file(str(temp_file_name)) == {'accounts': accounts}
+    assert list(iter_file(str(temp_file_name))) == accounts
+
+
+def test_iter_json_items():
+    from swag_client.util import iter_json_items
+
+    accounts = _batch_accounts(20)
+    data = json.dumps(accounts).encode('utf-8')
+
+    for size in (1, 7, 4096):
+        chunks = [data[i:i + size] for i in range(0, len(data), size)]
+        assert list(iter_json_items(chunks)) == accounts
+
+    assert list(iter_json_items([])) == []
+    assert list(iter_json_items(['{"accounts": ', json.dumps(accounts[:2]), '}'])) == accounts[:2]
+
+    with pytest.raises(ValueError):
+        list(iter_json_items([data[:-10]]))
+
+
+def _check_iter_all(swag):
+    swag.create_many(_batch_accounts(5))
+
+    assert list(swag.iter_all()) == swag.get_all()
+    assert list(swag.iter_all("[?name=='testaccount3']")) == swag.get_all("[?name=='testaccount3']")
+    assert list(swag.iter_all("[?environment=='prod']")) == []
+
+
+def test_file_backend_iter_all(temp_file_name):
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.data_file': str(temp_file_name),
+        'swag.cache_expires': 0
+    }
+
+    _check_iter_all(SWAGManager(**parse_swag_config_options(swag_opts)))
+
+
+def test_s3_backend_iter_all(s3_bucket_name):
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.type': 's3',
+        'swag.bucket_name': s3_bucket_name,
+        'swag.cache_expires': 0
+    }
+
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+    assert list(swag.iter_all()) == []
+
+    _check_iter_all(swag)
+
+
+def test_dynamodb_backend_iter_all(dynamodb_table):
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.type': 'dynamodb',
+        'swag.namespace': 'accounts',
+        'swag.write_units': 100,
+        'swag.cache_expires': 0
+    }
+
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+    _check_iter_all(swag)
+
+    # Force small pages, the first item is yielded before the second page is requested.
+    client = swag.backend.table.meta.client
+    scan = client.scan
+    calls = []
+
+    def paged_scan(**kwargs):
+        calls.append(kwargs)
+        return scan(Limit=2, **kwargs)
+
+    client.scan = paged_scan
+
+    items = swag.iter_all()
+    next(items)
+    assert len(calls) == 1
+    assert len(list(items)) == 4
+    assert len(calls) == 3
+
+
+def test_validation_schema_cache():
+    from marshmallow.exceptions import ValidationError
+    from swag_client.backend import get_schema, validate
+
+    context = {'owner': ['netflix']}
+    schema = get_schema(2, context)
+    assert get_schema(2, {'owner': ['netflix']}) is schema
+    assert get_schema(2, {'owner': ['aws']}) is not schema
+
+    # Mutating the caller's context does not leak into the cached schema.
+    context['owner'].append('aws')
+    assert schema.context == {'owner': ['netflix']}
+
+    accounts = _batch_accounts(3)
+    assert validate(accounts, many=True) == [validate(a) for a in accounts]
+
+    with pytest.raises(ValidationError) as e:
+        validate(dict(accounts[0], owner='aws'), context={'owner': ['netflix']})
+    assert e.value.messages == {'_schema': ["Must be one of ['netflix']"]}
+
+
+def test_fast_validation():
+    import copy
+    import mock
+    from marshmallow.exceptions import ValidationError
+    from swag_client.backend import validate
+
+    accounts = _batch_accounts(3)
+    del accounts[1]['email']
+    accounts[2]['name'] = 12
+
+    with pytest.raises(ValidationError) as full:
+        validate(accounts, many=True)
+
+    with pytest.raises(ValidationError) as fast:
+        validate(accounts, many=True, fast=True)
+
+    assert fast.value.messages == full.value.messages
+
+    account = _batch_accounts(1)[0]
+    account['services'] = [{'name': 'myService', 'status': [{'region': 'us-east-1', 'enabled': True}]}]
+    account['regions'] = {'us-east-1': {'status': 'ready'}}
+
+    invalid = [
+        dict(account, provider='unknown'),
+        dict(account, unknown='field'),
+        dict(account, email='not an email'),
+        dict(account, account_status='deleted', status=[{'region': 'us-east-1'}]),
+        dict(account, services=[{'name': 'myService'}]),
+        dict(account, regions={'us-east-1': {'status': 'unknown'}}),
+    ]
+    for item in invalid:
+        with pytest.raises(ValidationError) as full:
+            validate(copy.deepcopy(item))
+        with pytest.raises(ValidationError) as fast:
+            validate(copy.deepcopy(item), fast=True)
+        assert fast.value.messages == full.value.messages
+
+    # Values marshmallow coerces take the full schema and load the same.
+    for item in [account, dict(account, name=b'test0'), dict(account, sensitive='true')]:
+        assert validate(copy.deepcopy(item), fast=True) == validate(copy.deepcopy(item))
+
+    with pytest.raises(ValidationError):
+        validate(account, context={'type': ['billing']}, fast=True)
+
+    # Valid items of the common shape never reach the full schema.
+    with mock.patch('marshmallow.Schema.load', side_effect=AssertionError):
+        assert len(validate(_batch_accounts(3) + [account], many=True, fast=True)) == 4
+
+
+@pytest.mark.parametrize('codec', ['simplejson', 'json', 'orjson'])
+def test_json_codecs(codec, temp_file_name, s3_bucket_name):
+    import io
+    from decimal import Decimal
+    from swag_client.backend import SWAGManager
+    from swag_client.jsoncodec import get_codec
+    from swag_client.util import parse_swag_config_options
+
+    pytest.importorskip(codec)
+
+    data = get_codec(codec).dumps([{'id': '012345678910', 'count': Decimal('3'), 'ratio': Decimal('0.5')}])
+    assert isinstance(data, bytes)
+    assert get_codec(codec).loads(data) == [{'id': '012345678910', 'count': 3, 'ratio': 0.5}]
+
+    f = io.BytesIO()
+    get_codec(codec).dump([{'id': '012345678910', 'count': Decimal('3'), 'ratio': Decimal('0.5')}], f)
+    assert f.getvalue() == data
+
+    for swag_opts in ({'swag.data_file': str(temp_file_name)},
+                      {'swag.type': 's3', 'swag.bucket_name': s3_bucket_name}):
+        swag_opts.update({'swag.json_codec': codec, 'swag.cache_expires': 0})
+        _check_batch_operations(SWAGManager(**parse_swag_config_options(swag_opts)))
+
+
+def test_json_codec_unknown():
+    from swag_client.exceptions import SWAGException
+    from swag_client.jsoncodec import get_codec
+
+    with pytest.raises(SWAGException):
+        get_codec('yaml')
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'zstd'])
+def test_s3_backend_compression(compression, s3_bucket_name):
+    import gzip
+    import boto3
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    if compression == 'zstd':
+        pytest.importorskip('zstandard')
+
+    swag_opts = {
+        'swag.type': 's3',
+        'swag.bucket_name': s3_bucket_name,
+        'swag.compression': compression,
+        'swag.cache_expires': 0
+    }
+
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+    _check_batch_operations(swag)
+
+    swag.create_many(_batch_accounts(3))
+    response = boto3.client('s3', region_name='us-east-1').get_object(Bucket=s3_bucket_name, Key='accounts.json')
+    assert response['ContentEncoding'] == compression
+
+    body = response['Body'].read()
+    if compression == 'gzip':
+        assert json.loads(gzip.decompress(body).decode('utf-8')) == swag.get_all()
+
+    assert list(swag.iter_all()) == swag.get_all()
+
+    # Readers decompress whatever the writer chose.
+    del swag_opts['swag.compression']
+    assert SWAGManager(**parse_swag_config_options(swag_opts)).get_all() == swag.get_all()
+
+
+def test_s3_iter_body_streams(monkeypatch):
+    import gzip
+    import io
+    from botocore.response import StreamingBody
+    from swag_client.backends import s3
+
+    data = json.dumps(_batch_accounts(500)).encode('utf-8')
+    compressed = gzip.compress(data)
+    response = {'ContentEncoding': 'gzip', 'Body': StreamingBody(io.BytesIO(compressed), len(compressed))}
+    monkeypatch.setattr(s3, 'CHUNK_SIZE', 256)
+
+    chunks = list(s3.iter_body(response))
+    assert len(chunks) > len(compressed) // 256
+    assert b''.join(chunks) == data
+
+
+def test_s3_backend_delta_log(s3_bucket_name):
+    import boto3
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.type': 's3',
+        'swag.bucket_name': s3_bucket_name,
+        'swag.write_mode': 'delta',
+        'swag.cache_expires': 0
+    }
+
+    writer = SWAGManager(**parse_swag_config_options(swag_opts))
+    reader = SWAGManager(**parse_swag_config_options(swag_opts))
+
+    accounts = writer.create_many(_batch_accounts(4))
+    assert len(reader.get_all()) == 4
+
+    client = boto3.client('s3', region_name='us-east-1')
+    keys = [o['Key'] for o in client.list_objects_v2(Bucket=s3_bucket_name)['Contents']]
+    assert keys == ['accounts.json.deltas/00000000000000000001.json']
+
+    accounts[1]['environment'] = 'prod'
+    writer.update(accounts[1])
+    writer.delete(accounts[2])
+    assert [a['id'] for a in reader.get_all()] == [accounts[0]['id'], accounts[3]['id'], accounts[1]['id']]
+    assert reader.get("[?environment=='prod']")['id'] == accounts[1]['id']
+    assert list(reader.iter_all()) == reader.get_all()
+
+    assert writer.backend.compact() == 3
+    keys = [o['Key'] for o in client.list_objects_v2(Bucket=s3_bucket_name)['Contents']]
+    assert keys == ['accounts.json']
+
+    # Steady state readers revalidate the base and only download new deltas.
+    writer.create(_batch_accounts(6)[5])
+    get_object = reader.backend.client.get_object
+    calls = []
+
+    def counting_get_object(**kwargs):
+        calls.append(kwargs['Key'])
+        return get_object(**kwargs)
+
+    reader.backend.client.get_object = counting_get_object
+    assert len(reader.get_all()) == 4
+    assert len(reader.get_all()) == 4
+    assert calls.count('accounts.json') == 2
+    assert calls.count('accounts.json.deltas/00000000000000000004.json') == 1
+    assert list(reader.iter_all()) == reader.get_all()
+
+
+def test_s3_backend_delta_log_gap(s3_bucket_name, monkeypatch):
+    from swag_client.backend import SWAGManager
+    from swag_client.backends import s3
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.type': 's3',
+        'swag.bucket_name': s3_bucket_name,
+        'swag.write_mode': 'delta',
+        'swag.compact_threshold': 2,
+        'swag.cache_expires': 0
+    }
+
+    writer = SWAGManager(**parse_swag_config_options(swag_opts))
+    reader = SWAGManager(**parse_swag_config_options(swag_opts))
+
+    first, second, third = _batch_accounts(3)
+    writer.create(first)
+    assert len(reader.get_all()) == 1
+
+    # The second write reaches the threshold and compacts the log.
+    writer.create(second)
+    writer.create(third)
+
+    # The compaction lands between the reader's base revalidation and its listing of the deltas.
+    load_base_if_modified = s3.load_base_if_modified
+    stale = [reader.backend._deltas.etag]
+
+    def racing_load_base_if_modified(client, bucket, data_file, etag=None, codec=None):
+        if stale:
+            return None, stale.pop(), None
+        return load_base_if_modified(client, bucket, data_file, etag=etag, codec=codec)
+
+    monkeypatch.setattr(s3, 'load_base_if_modified', racing_load_base_if_modified)
+
+    # The gap in the deltas makes the reader fetch the new base before applying the remaining delta.
+    assert sorted(a['id'] for a in reader.get_all()) == [first['id'], second['id'], third['id']]
+    assert reader.backend._deltas.generation == 3
+
+
+def test_s3_backend_delta_written_behind_compaction(s3_bucket_name):
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.type': 's3',
+        'swag.bucket_name': s3_bucket_name,
+        'swag.write_mode': 'delta',
+        'swag.cache_expires': 0
+    }
+
+    writer = SWAGManager(**parse_swag_config_options(swag_opts))
+    other = SWAGManager(**parse_swag_config_options(swag_opts))
+    zero, first, second = _batch_accounts(3)
+    other.create(zero)
+    other.backend.compact()
+
+    # After the writer picks sequence 2, another writer claims it and compacts the log, freeing the key again.
+    head_object = writer.backend.client.head_object
+    raced = []
+
+    def racing_head_object(**kwargs):
+        response = head_object(**kwargs)
+        if not raced:
+            raced.append(1)
+            other.create(second)
+            other.backend.compact()
+        return response
+
+    writer.backend.client.head_object = racing_head_object
+    writer.create(first)
+
+    ids = [zero['id'], first['id'], second['id']]
+    assert sorted(a['id'] for a in other.get_all()) == ids
+    assert other.backend.compact() == 3
+    assert sorted(a['id'] for a in other.get_all()) == ids
+
+
+def test_s3_backend_delta_compaction_conflict(s3_bucket_name):
+    from botocore.exceptions import ClientError
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.type': 's3',
+        'swag.bucket_name': s3_bucket_name,
+        'swag.write_mode': 'delta',
+        'swag.compact_threshold': 1,
+        'swag.cache_expires': 0
+    }
+
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+    put_object = swag.backend.client.put_object
+
+    def conflicting_put_object(**kwargs):
+        if kwargs['Key'] == 'accounts.json':
+            raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+        return put_object(**kwargs)
+
+    swag.backend.client.put_object = conflicting_put_object
+
+    account = _batch_accounts(1)[0]
+    swag.create(account)
+    assert [a['id'] for a in swag.get_all()] == [account['id']]
+
+
+def _check_partial_updates(swag):
+    account = swag.create_many(_batch_accounts(1))[0]
+    service = {'name': 'myService', 'status': [{'region': 'all', 'enabled': True}]}
+
+    regions = {'us-east-1': {'status': 'ready'}}
+    swag.update_fields(account['id'], {'environment': 'prod', 'domain': 'test.net', 'regions': regions})
+    item = swag.get("[?id=='{}']".format(account['id']))
+    assert item['environment'] == 'prod'
+    assert item['domain'] == 'test.net'
+    assert item['regions'] == regions
+
+    swag.update_fields(account['id'], {'domain': None})
+    assert 'domain' not in swag.get("[?id=='{}']".format(account['id']))
+
+    with pytest.raises(ValidationError):
+        swag.update_fields(account['id'], {'description': None})
+
+    with pytest.raises(ValidationError):
+        swag.update_fields(account['id'], {'account_status': 'nope'})
+
+    with pytest.raises(ValidationError):
+        swag.update_fields(account['id'], {'regions': {'us-east-1': {'status': 'bogus'}}})
+
+    with pytest.raises(ValidationError):
+        swag.update_fields(account['id'], {'id': '999999999999'})
+
+    swag.set_service(account['id'], service)
+    service['status'][0]['enabled'] = False
+    swag.set_service(account['id'], service)
+    swag.set_service(account['id'], dict(service, name='otherService'))
+
+    item = swag.get("[?id=='{}']".format(account['id']))
+    assert [s['name'] for s in item['services']] == ['myService', 'otherService']
+    assert not swag.get_service_enabled('myService', search_filter="[?id=='{}']".format(account['id']))
+
+
+def test_file_backend_partial_updates(temp_file_name):
+    from swag_client.backend import SWAGManager
+    from swag_client.exceptions import SWAGConflictError, SWAGException
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.data_file': str(temp_file_name),
+        'swag.cache_expires': 0
+    }
+
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+    _check_partial_updates(swag)
+
+    with pytest.raises(SWAGConflictError):
+        swag.update_fields('999999999999', {'environment': 'prod'})
+
+    with pytest.raises(SWAGException):
+        swag.update_fields('012345678900', {'environment': 'prod'}, expected_version=1)
+
+
+def test_dynamodb_backend_partial_updates(dynamodb_table):
+    from swag_client.backend import SWAGManager
+    from swag_client.exceptions import SWAGConflictError
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.type': 'dynamodb',
+        'swag.namespace': 'accounts',
+        'swag.write_units': 100,
+        'swag.version_attribute': 'version',
+        'swag.cache_expires': 0
+    }
+
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+
+    # Each change is one UpdateItem, the item is only put when it is created.
+    client = swag.backend.table.meta.client
+    put_item = client.put_item
+    puts = []
+    client.put_item = lambda **kwargs: puts.append(kwargs) or put_item(**kwargs)
+    _check_partial_updates(swag)
+    client.put_item = put_item
+    assert len(puts) == 1
+
+    item = swag.get("[?id=='012345678900']")
+    assert item['version'] == 6
+
+    # Full updates check and increment the version counter too.
+    assert swag.update(item)['version'] == 7
+    assert swag.get("[?id=='012345678900']")['version'] == 7
+
+    with pytest.raises(SWAGConflictError):
+        swag.update(item)
+    assert swag.get("[?id=='012345678900']")['version'] == 7
+
+    with pytest.raises(SWAGConflictError):
+        swag.update(dict((k, v) for k, v in item.items() if k != 'version'))
+
+    with pytest.raises(SWAGConflictError):
+        swag.update_many([dict(item, version=7), dict(_batch_accounts(2)[1], version=3)])
+
+    item = swag.update_fields('012345678900', {'environment': 'test'}, expected_version=8)
+    assert item['version'] == 9
+
+    with pytest.raises(SWAGConflictError):
+        swag.update_fields('012345678900', {'environment': 'prod'}, expected_version=8)
+
+    with pytest.raises(SWAGConflictError):
+        swag.update_fields('999999999999', {'environment': 'prod'})
+
+    # The slot of the service is checked, a service moved by another writer is not overwritten.
+    table = swag.backend.table
+    table.update_item(Key={'id': '012345678900'}, UpdateExpression='REMOVE services[0]')
+    get_item = table.get_item
+    table.get_item = lambda **kwargs: {'Item': {'services': [{'name': 'myService'}, {'name': 'otherService'}]}}
+    with pytest.raises(SWAGConflictError):
+        swag.set_service('012345678900', {'name': 'otherService', 'status': [{'region': 'all', 'enabled': True}]})
+    table.get_item = get_item
+
+    preview = swag.update_fields('012345678900', {'environment': 'prod', 'domain': None}, dry_run=True)
+    item = swag.get("[?id=='012345678900']")
+    assert preview == dict(item, environment='prod', version=item['version'] + 1)
+    assert item['environment'] == 'test'
+
+
+def test_file_backend_get_by_id(temp_file_name):
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.data_file': str(temp_file_name),
+        'swag.cache_expires': 0
+    }
+
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+    accounts = swag.create_many(_batch_accounts(3))
+
+    assert swag.get_by_id(accounts[1]['id']) == accounts[1]
+    assert swag.get_by_id('999999999999') is None
+    assert swag.get_many_by_id([accounts[2]['id'], '999999999999', accounts[0]['id'], accounts[2]['id']]) == \
+        [accounts[2], accounts[0]]
+
+
+def test_dynamodb_backend_get_by_id(dynamodb_table):
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.type': 'dynamodb',
+        'swag.namespace': 'accounts',
+        'swag.write_units': 100,
+        'swag.cache_expires': 60
+    }
+
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+    accounts = swag.create_many(_batch_accounts(3))
+
+    # Lookups by key never scan the table.
+    client = swag.backend.table.meta.client
+    calls = []
+
+    def track(name):
+        method = getattr(client, name)
+
+        def tracked(**kwargs):
+            calls.append(name)
+            return method(**kwargs)
+        return tracked
+
+    client.scan = None
+    client.get_item = track('get_item')
+    client.batch_get_item = track('batch_get_item')
+
+    assert swag.get("[?id=='{}']".format(accounts[0]['id'])) == accounts[0]
+    assert swag.get_by_id('999999999999') is None
+    assert swag.get_many_by_id([accounts[2]['id'], '999999999999', accounts[1]['id']]) == [accounts[2], accounts[1]]
+    assert calls == ['get_item', 'get_item', 'batch_get_item']
+
+    # Items and missing keys are served from the cache.
+    assert swag.get_many_by_id([a['id'] for a in accounts] + ['999999999999']) == accounts
+    assert len(calls) == 3
+
+    # Writes through the backend drop the cached items.
+    accounts[0]['environment'] = 'prod'
+    swag.update(accounts[0])
+    swag.delete(accounts[1])
+    swag.update_fields(accounts[2]['id'], {'environment': 'prod'})
+    assert swag.get_by_id(accounts[0]['id'])['environment'] == 'prod'
+    assert swag.get_by_id(accounts[1]['id']) is None
+    assert swag.get_by_id(accounts[2]['id'])['environment'] == 'prod'
+
+
+def test_dynamodb_backend_get_by_id_keeps_table_cached(dynamodb_table):
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options
+
+    swag_opts = {
+        'swag.type': 'dynamodb',
+        'swag.namespace': 'accounts',
+        'swag.cache_expires': 60,
+        'swag.cache_size': 3
+    }
+
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+    accounts = swag.create_many(_batch_accounts(5))
+    assert len(swag.get_all()) == 5
+
+    # More lookups by key than the cache holds do not evict the table.
+    swag.backend.table.meta.client.scan = None
+    assert swag.get_many_by_id([a['id'] for a in accounts] + ['999999999999']) == accounts
+    assert len(swag.get_all()) == 5
+    assert len(swag.get_all("[?environment=='test']")) == 5
+
+
+def test_parse_filter():
+    from swag_client.backends.dynamodb import ExpressionAttributes, parse_filter, split_key_condition
+
+    assert parse_filter("[?provider=='aws' && environment=='prod']") == \
+        ('and', [('compare', '=', ('provider',), 'aws'), ('compare', '=', ('environment',), 'prod')])
+    assert parse_filter("[?`5` < weight || contains(aliases, 'x')]") == \
+        ('or', [('compare', '>', ('weight',), 5), ('function', 'contains', ('aliases',), 'x')])
+    assert parse_filter("[?meta.team!=`true`]") == ('compare', '<>', ('meta', 'team'), True)
+
+    # Untranslatable conjuncts are left to the client side, anything else is not translated.
+    assert parse_filter("[?provider=='aws' && length(aliases) > `1`]") == ('compare', '=', ('provider',), 'aws')
+    for search_filter in ["[?sensitive]", "[?!(provider=='aws')]", "[?provider=='aws' || length(aliases) > `1`]",
+                          "[?weight > `1.5`]", "[?sensitive > `true`]", "[?provider==null]", "[*].id",
+                          "accounts[?provider=='aws']", "[?provider=='aws'].id", "[?"]:
+        assert parse_filter(search_filter) is None
+
+    predicate = parse_filter("[?name > 'b' && environment=='prod' && contains(aliases, 'x')]")
+    schemas = [(None, [('id', 'S')]), ('environment-name', [('environment', 'S'), ('name', 'S')])]
+    index_name, key_conditions, filters = split_key_condition(predicate, schemas)
+    assert index_name == 'environment-name'
+    assert key_conditions == [('compare', '=', ('environment',), 'prod'), ('compare', '>', ('name',), 'b')]
+    assert filters == [('function', 'contains', ('aliases',), 'x')]
+
+    expression = ExpressionAttributes()
+    assert expression.render(parse_filter("[?a!='x' || a.b=='y']")) == \
+        '((attribute_not_exists(#n0) OR NOT attribute_type(#n0, :v0) OR #n0 <> :v1) OR #n0.#n1 = :v2)'
+    assert expression.arguments() == {'ExpressionAttributeNames': {'#n0': 'a', '#n1': 'b'},
+                                      'ExpressionAttributeValues': {':v0': 'S', ':v1': 'x', ':v2': 'y'}}
+
+
+def test_dynamodb_backend_filter_pushdown(dynamodb):
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options, search
+
+    throughput = {'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1}
+    table = dynamodb.create_table(
+        TableName='accounts',
+        KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'S'},
+                              {'AttributeName': 'environment', 'AttributeType': 'S'}],
+        GlobalSecondaryIndexes=[{
+            'IndexName': 'environment',
+            'KeySchema': [{'AttributeName': 'environment', 'KeyType': 'HASH'}],
+            'Projection': {'ProjectionType': 'ALL'},
+            'ProvisionedThroughput': throughput
+        }],
+        ProvisionedThroughput=throughput)
+
+    items = [
+        {'id': '1', 'name': 'a', 'provider': 'aws', 'environment': 'prod', 'aliases': ['x', 'y'], 'sensitive': True,
+         'weight': 1, 'meta': {'team': 'red'}},
+        {'id': '2', 'name': 'ab', 'provider': 'gcp', 'environment': 'prod', 'aliases': [], 'sensitive': False,
+         'weight': 5},
+        {'id': '3', 'name': 'b', 'provider': 'aws', 'environment': 'test', 'aliases': ['y'], 'sensitive': False,
+         'weight': 10, 'meta': {'team': 'blue'}},
+        {'id': '4', 'name': 'ba', 'provider': 'aws', 'environment': 'test', 'aliases': [], 'sensitive': True},
+        {'id': '5', 'name': 'c', 'environment': 'dev', 'aliases': ['xy'], 'weight': 0},
+        {'id': '6', 'name': 'cab', 'provider': 'aws', 'environment': 'prod', 'aliases': ['x'], 'sensitive': 1,
+         'weight': 1}
+    ]
+    with table.batch_writer() as writer:
+        for item in items:
+            writer.put_item(Item=item)
+
+    swag_opts = {
+        'swag.type': 'dynamodb',
+        'swag.namespace': 'accounts',
+        'swag.cache_expires': 60
+    }
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+
+    client = swag.backend.table.meta.client
+    calls = []
+
+    def track(name):
+        method = getattr(client, name)
+
+        def tracked(**kwargs):
+            calls.append((name, kwargs))
+            return method(**kwargs)
+        return tracked
+
+    client.scan = track('scan')
+    client.query = track('query')
+
+    # Every filter gives the same result as evaluating it on all items.
+    everything = swag.backend._get_all()
+    for search_filter in [
+        "[?provider=='aws' && environment=='prod']",
+        "[?provider=='aws']",
+        "[?provider!='aws']",
+        "[?weight > `1`]",
+        "[?weight <= `1`]",
+        "[?`5` <= weight]",
+        "[?name >= 'b']",
+        "[?sensitive==`true`]",
+        "[?sensitive!=`true`]",
+        "[?weight==`1` && sensitive==`false`]",
+        "[?contains(aliases, 'x') || name=='b']",
+        "[?starts_with(name, 'b') && environment=='test']",
+        "[?meta.team=='red']",
+        "[?provider=='aws' && length(aliases) > `1`]",
+        "[?id=='3' && provider=='aws']",
+        "[?sensitive]",
+    ]:
+        swag.backend.invalidate()
+        del calls[:]
+        assert sorted(swag.get_all(search_filter), key=lambda i: i['id']) == \
+            sorted(search(search_filter, everything), key=lambda i: i['id']), search_filter
+
+        name, kwargs = calls[0]
+        if search_filter == "[?sensitive]":
+            assert 'FilterExpression' not in kwargs
+        elif 'environment==' in search_filter:
+            assert name == 'query' and kwargs['IndexName'] == 'environment'
+        elif "id=='3'" in search_filter:
+            assert name == 'query' and 'IndexName' not in kwargs
+        else:
+            assert name == 'scan' and 'FilterExpression' in kwargs
+
+    # A second filtered Scan would read the whole table again, it is loaded and cached instead.
+    swag.backend.invalidate()
+    del calls[:]
+    assert len(swag.get_all("[?provider=='aws']")) == 4
+    assert len(swag.get_all("[?environment=='test']")) == 2
+    assert len(swag.get_all("[?weight > `1`]")) == 2
+    assert [(name, 'FilterExpression' in kwargs) for name, kwargs in calls] == [
+        ('scan', True), ('query', False), ('scan', False)
+    ]
+    del calls[:]
+    assert len(swag.get_all("[?name >= 'b']")) == 4
+    assert not calls
+
+    # Results are cached until the next write through the backend.
+    swag.backend.invalidate()
+    assert len(swag.get_all("[?provider=='aws']")) == 4
+    del calls[:]
+    assert len(swag.get_all("[?provider=='aws']")) == 4
+    assert not calls
+
+    swag.backend.update(dict(items[1], provider='aws'))
+    assert len(swag.get_all("[?provider=='aws']")) == 5
+
+    # Once all items are cached they are filtered locally.
+    swag.get_all()
+    del calls[:]
+    assert len(swag.get_all("[?provider=='aws']")) == 5
+    assert not calls
+
+
+def test_plan_filter():
+    from swag_client.index import get_index_fields, plan_filter
+
+    fields = get_index_fields(['owner', 'provider'])
+    assert fields == ['id', 'name', 'aliases', 'owner', 'provider']
+
+    plan = plan_filter("[?provider=='aws' && 'netflix'==owner && sensitive]", 2, fields)
+    assert plan.lookup == ('and', [('eq', 'provider', 'aws'), ('eq', 'owner', 'netflix')])
+    assert plan.residual.search([{'sensitive': True}, {'sensitive': False}]) == [{'sensitive': True}]
+
+    plan = plan_filter("[?name=='x' || contains(aliases, 'x')]", 2, fields)
+    assert plan.lookup == ('or', [('eq', 'name', 'x'), ('contains', 'aliases', 'x')])
+    assert plan.residual is None
+
+    assert plan_filter("accounts[?name=='x']", 1, get_index_fields(version=1)).lookup == ('eq', 'name', 'x')
+
+    for search_filter in ["[?environment=='prod']", "[?provider!='aws']", "[?name=='x' || sensitive]",
+                          "[?sensitive==`true`]", "[?name=='x'].id", "accounts[?name=='x']", "[?"]:
+        assert plan_filter(search_filter, 2, fields) is None
+
+
+def test_backend_query_planner(temp_file_name, monkeypatch):
+    import swag_client.backend
+    from swag_client.backend import SWAGManager
+    from swag_client.util import parse_swag_config_options, search
+
+    swag_opts = {
+        'swag.data_file': str(temp_file_name),
+        'swag.cache_expires': 0
+    }
+
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+    accounts = _batch_accounts(6)
+    for i, account in enumerate(accounts):
+        account['provider'] = ['aws', 'gcp'][i % 2]
+        account['environment'] = ['prod', 'test', 'dev'][i % 3]
+        account['owner'] = 'netflix' if i < 4 else 'other'
+    accounts[5]['account_status'] = 'deprecated'
+    accounts = swag.create_many(accounts)
+
+    # Planned filters only evaluate their residual on the accounts the index selects.
+    calls = []
+    monkeypatch.setattr(swag_client.backend, 'search', lambda *args, **kwargs: calls.append(args) or search(*args))
+
+    for search_filter in [
+        "[?provider=='aws' && environment=='prod']",
+        "[?owner=='netflix' && environment!='prod']",
+        "[?account_status=='deprecated' || contains(aliases, 'test1')]",
+        "[?contains(name, 'account1') && sensitive==`false`]",
+        "[?provider=='azure']",
+    ]:
+        assert swag.get_all(search_filter) == search(search_filter, accounts), search_filter
+    assert not calls
+
+    assert swag.get_all("[?sensitive==`false`]") == accounts
+    assert calls
+
+    # Only configured fields are indexed.
+    swag_opts['swag.index_fields'] = ['provider']
+    swag = SWAGManager(**parse_swag_config_options(swag_opts))
+    assert swag.index_fields == ['id', 'name', 'aliases', 'provider']
+
+    del calls[:]
+    assert swag.get_all("[?provider=='aws']") == search("[?provider=='aws']", accounts)
+    assert not calls
+    assert swag.get_all("[?owner=='netflix']") == search("[?owner=='netflix']", accounts)
+    assert calls
+
+
+def test_snapshot_index_fields(tmpdir):
+    from swag_client.snapshot import Snapshot, publish_snapshot, read_header
+
+    path = str(tmpdir.join('swag.snapshot'))
+    accounts = _batch_accounts(3)
+
+    assert publish_snapshot(path, accounts) == 1
+    assert read_header(path)['fields'] == ['id', 'name', 'aliases']
+
+    # Indexing other fields publishes a new generation.
+    assert publish_snapshot(path, accounts, fields=['owner']) == 2
+    assert publish_snapshot(path, accounts, fields=['owner']) is None
+    assert Snapshot(path).index.lookup('owner', 'netflix') == accounts
@@ -1,16 +1,34 @@
 import os
+import codecs
+import logging
+import threading
+import time
 import warnings
+from collections import OrderedDict
+
 import jmespath
+import simplejson as json
+from dogpile.cache import make_region
+from jmespath import functions
 
 from marshmallow import Schema, fields
 from marshmallow.validate import OneOf
 
+logger = logging.getLogger(__name__)
+
 
 class OptionsSchema(Schema):
-    type = fields.String(missing='file', validate=OneOf(['file', 's3', 'dynamodb']))
+    type = fields.String(missing='file', validate=OneOf(['file', 's3', 'dynamodb', 'snapshot']))
     namespace = fields.String(missing='accounts')
     schema_version = fields.Integer(missing=2)  # default version to return data as
     cache_expires = fields.Integer(missing=60)
+    cache_size = fields.Integer(missing=1000)
+    refresh_ahead = fields.Boolean(missing=False)
+    max_staleness = fields.Integer(missing=None, allow_none=True)
+    single_flight_dir = fields.String(missing=None, allow_none=True)
+    fast_validation = fields.Boolean(missing=False)
+    index_fields = fields.List(fields.String(), missing=['owner', 'provider', 'environment', 'account_status'])
+    json_codec = fields.String(missing='simplejson', validate=OneOf(['simplejson', 'json', 'orjson', 'ujson']))
     schema_context = fields.Dict(missing={})
 
 
@@ -18,6 +36,9 @@ class FileOptionsSchema(OptionsSchema):
     """Option schema for the file backend."""
     data_dir = fields.String(missing=os.getcwd())
     data_file = fields.String()
+    cache_mode = fields.String(missing='ttl', validate=OneOf(['ttl', 'stat']))
+    file_format = fields.String(missing='json', validate=OneOf(['json', 'binary']))
+    lock_dir = fields.String(missing=None, allow_none=True)
 
 
 class S3OptionsSchema(OptionsSchema):
@@ -25,6 +46,10 @@ class S3OptionsSchema(OptionsSchema):
     bucket_name = fields.String(required=True)
     data_file = fields.String()
     region = fields.String(missing='us-east-1', validate=OneOf(['us-east-1', 'us-west-2', 'eu-west-1']))
+    compression = fields.String(missing='none', validate=OneOf(['none', 'gzip', 'zstd']))
+    write_mode = fields.String(missing='document', validate=OneOf(['document', 'delta']))
+    delta_prefix = fields.String()
+    compact_threshold = fields.Integer(missing=0)
 
 
 class DynamoDBOptionsSchema(OptionsSchema):
@@ -32,10 +57,19 @@ class DynamoDBOptionsSchema(OptionsSchema):
     key_attribute = fields.String(missing='id')
     key_type = fields.String(missing='HASH')
     read_units = fields.Integer(missing=1)
-    write_units = fields.Integer(missing=1)
+    write_units = fields.Integer(missing=None, allow_none=True)
+    write_workers = fields.Integer(missing=4)
+    scan_segments = fields.Integer(missing=1)
+    version_attribute = fields.String(missing=None, allow_none=True)
+    filter_pushdown = fields.Boolean(missing=True)
     region = fields.String(missing='us-east-1', validate=OneOf(['us-east-1', 'us-west-2', 'eu-west-1']))
 
 
+class SnapshotOptionsSchema(OptionsSchema):
+    """Option schema for the snapshot backend."""
+    snapshot_path = fields.String(required=True)
+
+
 def parse_swag_config_options(config):
     """Ensures that options passed to the backend are valid."""
     options = {}
@@ -49,6 +83,8 @@ def parse_swag_config_options(config):
         return S3OptionsSchema().load(options)
     elif options.get('type') == 'dynamodb':
         return DynamoDBOptionsSchema().load(options)
+    elif options.get('type') == 'snapshot':
+        return SnapshotOptionsSchema().load(options)
     else:
         return FileOptionsSchema().load(options)
 
@@ -66,29 +102,351 @@ def deprecated(message):
     return wrapper
 
 
+class BoundedDict(OrderedDict):
+    """Thread safe dictionary that evicts its least recently used keys beyond max_size."""
+    def __init__(self, max_size):
+        OrderedDict.__init__(self)
+        self.max_size = max_size
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self:
+                return default
+            self.move_to_end(key)
+            return OrderedDict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            OrderedDict.__setitem__(self, key, value)
+            self.move_to_end(key)
+            while len(self) > self.max_size:
+                self.popitem(last=False)
+
+    def pop(self, key, *args):
+        with self._lock:
+            return OrderedDict.pop(self, key, *args)
+
+
+def make_cache_region(expiration_time, max_size=None):
+    """Creates a memory cache region owned by a single backend instance."""
+    arguments = {}
+    if max_size:
+        arguments['cache_dict'] = BoundedDict(max_size)
+
+    return make_region().configure(
+        'dogpile.cache.memory',
+        expiration_time=expiration_time,
+        arguments=arguments
+    )
+
+
+class RefreshAheadCache(object):
+    """Serves the last good copy of a value while a background thread reloads it.
+
+    Once a value is older than `refresh_interval` the next caller starts a
+    background reload and still gets the current copy. If that reload fails the
+    copy keeps being served, until it is older than `max_staleness` at which
+    point callers block on a synchronous reload and see its errors.
+    """
+    def __init__(self, loader, refresh_interval, max_staleness=None, clock=time.monotonic):
+        self.loader = loader
+        self.refresh_interval = refresh_interval
+        self.max_staleness = max_staleness
+        self._clock = clock
+        self._value = None
+        self._loaded_at = None
+        self._refreshing = False
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def get(self):
+        """Fetches the current value, loading it synchronously only if there is no usable copy."""
+        with self._lock:
+            value, loaded_at = self._value, self._loaded_at
+
+        if loaded_at is None:
+            return self._load()
+
+        age = self._clock() - loaded_at
+        if self.max_staleness is not None and age > self.max_staleness:
+            return self._load(loaded_at)
+
+        if age >= self.refresh_interval:
+            self._refresh_in_background()
+
+        return value
+
+    def invalidate(self):
+        """Drops the current copy so the next caller loads synchronously."""
+        with self._lock:
+            self._generation += 1
+            self._value = None
+            self._loaded_at = None
+
+    def _set(self, value, generation):
+        with self._lock:
+            # A load that started before an invalidation may return data older than it, it is not kept.
+            if generation == self._generation:
+                self._value = value
+                self._loaded_at = self._clock()
+
+    def _load(self, stale_loaded_at=None):
+        with self._load_lock:
+            # Another caller may have finished a load while we waited.
+            with self._lock:
+                if self._loaded_at is not None and self._loaded_at != stale_loaded_at:
+                    return self._value
+                generation = self._generation
+
+            value = self.loader()
+            self._set(value, generation)
+            return value
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        thread = threading.Thread(target=self._refresh, name='swag-refresh')
+        thread.daemon = True
+        thread.start()
+
+    def _refresh(self):
+        with self._lock:
+            generation = self._generation
+
+        try:
+            self._set(self.loader(), generation)
+
+        except Exception as e:
+            logger.exception(e)
+            logger.error('Unable to refresh backend data, serving the last good copy.')
+
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+
+class ExpressionCache(object):
+    """Thread safe LRU cache of compiled JMESPath expressions."""
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._expressions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, expression):
+        """Fetches the compiled form of an expression, compiling it on a miss."""
+        with self._lock:
+            compiled = self._expressions.pop(expression, None)
+            if compiled is not None:
+                self.hits += 1
+                self._expressions[expression] = compiled
+                return compiled
+            self.misses += 1
+
+        compiled = jmespath.compile(expression)
+
+        with self._lock:
+            self._expressions[expression] = compiled
+            while len(self._expressions) > self.maxsize:
+                self._expressions.popitem(last=False)
+
+        return compiled
+
+    def info(self):
+        """Reports cache statistics."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'maxsize': self.maxsize, 'size': len(self._expressions)}
+
+    def clear(self):
+        """Drops all compiled expressions and resets statistics."""
+        with self._lock:
+            self._expressions.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+expression_cache = ExpressionCache()
+
+
+class ParameterFunctions(functions.Functions):
+    """Exposes query parameters to expressions as `param('name')`."""
+    def __init__(self, params):
+        self.params = params
+
+    @functions.signature({'types': ['string']})
+    def _func_param(self, name):
+        return self.params[name]
+
+
+def search(expression, data, **params):
+    """Evaluates a JMESPath expression using the compiled expression cache.
+
+    Values that vary between calls should be passed as keyword arguments and
+    referenced as `param('name')` rather than formatted into the expression,
+    so that every call shares one compiled expression.
+    """
+    compiled = expression_cache.get(expression)
+
+    if params:
+        return compiled.search(data, options=jmespath.Options(custom_functions=ParameterFunctions(params)))
+
+    return compiled.search(data)
+
+
+class TokenBucket(object):
+    """Thread safe token bucket used to stay within a provisioned capacity.
+
+    Callers reserve tokens up front and sleep off any deficit, so concurrent
+    consumers are served in the order they asked and the long run rate never
+    exceeds `rate` tokens per second.
+    """
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def consume(self, tokens=1):
+        """Takes tokens from the bucket, blocking until they are available. Returns the time spent waiting."""
+        with self._lock:
+            now = self._clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self.tokens -= tokens
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            self._sleep(wait)
+
+        return wait
+
+
+JSON_WHITESPACE = ' \t\n\r'
+
+
+def iter_json_items(chunks):
+    """Incrementally decodes the accounts of a JSON document from an iterable of text or byte chunks.
+
+    Items of a top level array are yielded as soon as they have been read.
+    Version 1 documents wrap their accounts in an object, they are decoded
+    once fully read. An empty document has no items.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer, position, eof = '', 0, False
+
+    def read():
+        nonlocal buffer, position, eof
+        chunk = next(chunks, None)
+        if chunk is None:
+            chunk, eof = utf8.decode(b'', final=True), True
+        elif isinstance(chunk, bytes):
+            chunk = utf8.decode(chunk)
+
+        buffer, position = buffer[position:] + chunk, 0
+
+    expect = 'start'
+    while True:
+        while True:
+            while position < len(buffer) and buffer[position] in JSON_WHITESPACE:
+                position += 1
+            if position < len(buffer) or eof:
+                break
+            read()
+
+        if position == len(buffer):
+            if expect == 'start':
+                return
+            raise ValueError('Unexpected end of JSON document.')
+
+        char = buffer[position]
+
+        if expect == 'start':
+            if char == '{':
+                while not eof:
+                    read()
+                for accounts in json.loads(buffer[position:]).values():
+                    for account in accounts:
+                        yield account
+                return
+
+            if char != '[':
+                raise ValueError('Expected a JSON array or object, found: {}'.format(char))
+
+            position += 1
+            expect = 'first'
+
+        elif expect == 'separator':
+            position += 1
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError('Expected , or ] in JSON array, found: {}'.format(char))
+            expect = 'item'
+
+        elif char == ']' and expect == 'first':
+            return
+
+        else:
+            while True:
+                try:
+                    # A value running up to the end of the buffer may continue in the next chunk.
+                    item, end = decoder.raw_decode(buffer, position)
+                    if end < len(buffer) or eof:
+                        break
+                except ValueError:
+                    if eof:
+                        raise
+                read()
+
+            position = end
+            expect = 'separator'
+            yield item
+
+
 def append_item(namespace, version, item, items):
+    return append_items(namespace, version, [item], items)
+
+
+def append_items(namespace, version, new_items, items):
     if version == 1:
         if items:
-            items[namespace].append(item)
+            items[namespace].extend(new_items)
         else:
-            items = {namespace: [item]}
+            items = {namespace: list(new_items)}
 
     else:
         if items:
-            items.append(item)
+            items.extend(new_items)
         else:
-            items = [item]
+            items = list(new_items)
 
     return items
 
 
 def remove_item(namespace, version, item, items):
+    return remove_items(namespace, version, [item], items)
+
+
+def remove_items(namespace, version, old_items, items):
+    ids = [item['id'] for item in old_items]
+
     if version == 1:
         # NOTE only supports aws providers
-        path = "{namespace}[?id!='{id}']".format(id=item['id'], namespace=namespace)
-        return jmespath.search(path, items)
+        path = "{namespace}[?!contains(param('ids'), id)]".format(namespace=namespace)
+        return {namespace: search(path, items, ids=ids) or []}
     else:
-        return jmespath.search("[?id!='{id}']".format(id=item['id']), items)
+        return search("[?!contains(param('ids'), id)]", items, ids=ids)
 
 
 def is_sub_dict(sub_dict, dictionary):